@@ -5,15 +5,14 @@ from django.core.exceptions import ObjectDoesNotExist
 from django.db import transaction
 from django.shortcuts import render
 from django.urls import path, resolve, reverse
+from django.utils import timezone
 from django.utils.safestring import mark_safe
 from django import forms
 
 from datetime import datetime
 
-from convention import get_convention_model
-Convention = get_convention_model()
-
 from . import models
+from .catalog import get_current_convention
 
 class RegistrationAdminForm(ActionForm):
     amount = forms.FloatField(widget=forms.NumberInput(attrs={'style': 'width:auto'}), required=False)
@@ -48,14 +47,15 @@ class PaymentInline(admin.TabularInline):
 
 class RegistrationAdmin(RegistrationModelAdmin):
     list_display = ('badge_name', 'first_name', 'last_name', 'registration_level', 'shirt_size', 'checked_in', 'status', 'badge_number')
-    list_filter = ('registration_level__convention', 'registration_level__title', 'checked_in', 'needs_print', 'status', 'shirt_size', 'volunteer', 'payment__payment_received', 'payment__payment_method')
+    list_filter = ('convention', 'registration_level__title', 'checked_in', 'needs_print', 'status', 'verified', 'shirt_size', 'volunteer', 'payment__payment_received', 'payment__payment_method')
     search_fields = ['first_name', 'last_name', 'badge_name', 'email', 'badgeassignment__id', 'external_id']
     autocomplete_fields = ['user']
     actions = ['mark_checked_in', 'apply_payment', 'refund_payment', 'undo_refund_payment', 'print_badge', 'link_as_staff', 'download_registration_detail']
     action_form = RegistrationAdminForm
     ordering = ('id',)
     inlines = [PaymentInline]
-    readonly_fields = ( 'external_id', 'confirmation_link', 'avatar_preview', )
+    readonly_fields = ( 'external_id', 'confirmation_link', 'avatar_preview',
+                        'amount_paid', 'discount_applied', 'amount_due', 'verified', )
 
     filter_convention = None
 
@@ -97,8 +97,9 @@ class RegistrationAdmin(RegistrationModelAdmin):
         return mark_safe(html)
 
     def mark_checked_in(self, request, queryset):
+        current_convention = get_current_convention()
         for id in queryset:
-            if id.registration_level.convention != Convention.objects.current():
+            if id.convention_id != current_convention.pk:
                 self.message_user(request, 'Cannot check in reg %s from a different year' % (id))
             else:
                 id.checked_in = True
@@ -115,8 +116,9 @@ class RegistrationAdmin(RegistrationModelAdmin):
         except ObjectDoesNotExist:
             method = None
         if (method and amount):
+            current_convention = get_current_convention()
             for id in queryset:
-                if id.registration_level.convention != Convention.objects.current():
+                if id.convention_id != current_convention.pk:
                     self.message_user(request, 'Cannot apply payment to reg %s from a different year' % (id))
                     continue
                 payment = models.Payment(registration=id,
@@ -130,8 +132,9 @@ class RegistrationAdmin(RegistrationModelAdmin):
             self.message_user(request, 'Must specify an amount and payment method!', messages.ERROR)
 
     def refund_payment(self, request, queryset):
+        current_convention = get_current_convention()
         for id in queryset:
-            if id.registration_level.convention != Convention.objects.current():
+            if id.convention_id != current_convention.pk:
                 self.message_user(request, 'Cannot refund reg %s from a different year' % (id))
                 continue
             if id.checked_in:
@@ -185,8 +188,9 @@ class RegistrationAdmin(RegistrationModelAdmin):
         printable = True
         ac = transaction.get_autocommit()
         transaction.set_autocommit(False)
+        current_convention = get_current_convention()
         for reg in queryset:
-            if reg.registration_level.convention != Convention.objects.current():
+            if reg.convention_id != current_convention.pk:
                 self.message_user(request, 'Cannot print badge %s from a different year' % (reg))
                 printable = False
             elif not reg.paid():
@@ -214,12 +218,12 @@ class RegistrationAdmin(RegistrationModelAdmin):
             transaction.set_autocommit(ac)
 
     def print_badge_list(self, request):
-        badges = self.model.objects.filter(checked_in=False).order_by('last_name', 'first_name')
+        badges = self.model.objects.filter(checked_in=False).exclude(assigned_badge_number=None) \
+            .select_related('registration_level').order_by('last_name', 'first_name')
         split_badges = []
         temp_list = []
         for badge in badges:
-            if badge.badge_number():
-                temp_list.append({'name': badge._get_full_name(last_first=True), 'badge_name': badge.badge_name, 'badge_number': badge.badge_number(), 'registration_level': badge.registration_level.title})
+            temp_list.append({'name': badge._get_full_name(last_first=True), 'badge_name': badge.badge_name, 'badge_number': badge.badge_number(), 'registration_level': badge.registration_level.title})
             if len(temp_list) == 25:
                 split_badges.append({'list': temp_list, 'last': False})
                 temp_list = []
@@ -236,7 +240,7 @@ class RegistrationAdmin(RegistrationModelAdmin):
                 self.message_user(request, '{} already linked to Staff Registration'.format(reg), messages.WARNING)
                 continue
             sr = models.StaffRegistration.objects.create(
-                convention=reg.registration_level.convention,
+                convention_id=reg.convention_id,
                 registration=reg,
             )
             self.log_change(request, reg, 'Staff registration link created')
@@ -246,64 +250,48 @@ class RegistrationAdmin(RegistrationModelAdmin):
 
     def download_registration_detail(self, request, queryset):
         registration_list = []
+        queryset = queryset.with_current_price().select_related(
+            'registration_level', 'dealer_registration_level',
+        ).prefetch_related(
+            'payment_set__payment_method', 'payment_set__created_by', 'payment_set__refunded_by',
+            'couponuse_set__coupon',
+        )
         for badge in queryset:
-            payments = models.Payment.objects.filter(registration=badge)
-            for payment in payments:
-                discount_amount = ''
-                try:
-                    coupon = models.CouponUse.objects.get(registration=badge)
-                    if coupon.coupon.percent:
-                        discount_amount = '%.02f' % ((coupon.coupon.discount / 100) * badge.registration_level.price)
-                    else:
-                        discount_amount = '%.02f' % (coupon.coupon.discount)
-                except ObjectDoesNotExist:
-                    pass
-                registration_list.append({'name': badge._get_full_name(last_first=True),
-                                          'email': badge.email,
-                                          'address': badge.address,
-                                          'city': badge.city,
-                                          'state': badge.state,
-                                          'postal_code': badge.postal_code,
-                                          'country': badge.country,
-                                          'badge_name': badge.badge_name.replace('"', '""'),
-                                          'badge_number': badge.badge_number(),
-                                          'registration_level': badge.registration_level.title.replace('"', '""'),
-                                          'payment_registration_level': payment.payment_level_comment.replace('"', '""') if payment.payment_level_comment else '',
-                                          'dealer_registration_level': badge.dealer_registration_level.number_tables if badge.dealer_registration_level else '',
-                                          'payment_amount': '%.02f' % payment.payment_amount,
-                                          'payment_created': payment.payment_received,
-                                          'received_by': payment.created_by.username.replace('"', '""') if payment.created_by else '',
-                                          'refunded_by': payment.refunded_by.username.replace('"', '""') if payment.refunded_by else '',
-                                          'discount_amount': discount_amount,
-                                          'payment_method': payment.payment_method})
-        if not payments:
             discount_amount = ''
-            try:
-                coupon = models.CouponUse.objects.get(registration=badge)
+            for coupon in badge.couponuse_set.all():
                 if coupon.coupon.percent:
-                    discount_amount = '%.02f' % ((coupon.coupon.discount / 100) * badge.registration_level.price)
+                    discount_amount = '%.02f' % ((coupon.coupon.discount / 100) * badge.registration_level_price)
                 else:
                     discount_amount = '%.02f' % (coupon.coupon.discount)
-            except ObjectDoesNotExist:
-                pass
-            registration_list.append({'name': badge._get_full_name(last_first=True),
-                                      'email': badge.email,
-                                      'address': badge.address,
-                                      'city': badge.city,
-                                      'state': badge.state,
-                                      'postal_code': badge.postal_code,
-                                      'country': badge.country,
-                                      'badge_name': badge.badge_name.replace('"', '""'),
-                                      'badge_number': badge.badge_number(),
-                                      'registration_level': badge.registration_level.title.replace('"', '""'),
-                                      'payment_registration_level': '',
-                                      'dealer_registration_level': badge.dealer_registration_level.number_tables if badge.dealer_registration_level else '',
-                                      'payment_amount': '0.00',
-                                      'payment_created': '',
-                                      'received_by': '',
-                                      'refunded_by': '',
-                                      'discount_amount': discount_amount,
-                                      'payment_method': ''})
+            detail = {'name': badge._get_full_name(last_first=True),
+                      'email': badge.email,
+                      'address': badge.address,
+                      'city': badge.city,
+                      'state': badge.state,
+                      'postal_code': badge.postal_code,
+                      'country': badge.country,
+                      'badge_name': badge.badge_name.replace('"', '""'),
+                      'badge_number': badge.badge_number(),
+                      'registration_level': badge.registration_level.title.replace('"', '""'),
+                      'dealer_registration_level': badge.dealer_registration_level.number_tables if badge.dealer_registration_level else '',
+                      'discount_amount': discount_amount}
+            payments = badge.payment_set.all()
+            for payment in payments:
+                registration_list.append(dict(detail,
+                                              payment_registration_level=payment.payment_level_comment.replace('"', '""') if payment.payment_level_comment else '',
+                                              payment_amount='%.02f' % payment.payment_amount,
+                                              payment_created=payment.payment_received,
+                                              received_by=payment.created_by.username.replace('"', '""') if payment.created_by else '',
+                                              refunded_by=payment.refunded_by.username.replace('"', '""') if payment.refunded_by else '',
+                                              payment_method=payment.payment_method))
+            if not payments:
+                registration_list.append(dict(detail,
+                                              payment_registration_level='',
+                                              payment_amount='0.00',
+                                              payment_created='',
+                                              received_by='',
+                                              refunded_by='',
+                                              payment_method=''))
         response = render(request, 'register/regdetail.csv', {'badges': registration_list}, content_type='text/csv')
         response['Content-Disposition'] = 'attachment; filename="regdetail.csv"'
         return response
@@ -358,6 +346,9 @@ class RegistrationLevelAdmin(RegistrationModelAdmin):
     list_filter = ( 'convention', )
     readonly_fields = ( 'price', )
 
+    def get_queryset(self, request):
+        return super().get_queryset(request).with_current_price()
+
     def price(self, object):
         return object.price
 
@@ -377,6 +368,9 @@ class RegistrationUpgradeAdmin(RegistrationModelAdmin):
     list_display = ( '__str__', 'price', )
     readonly_fields = ( 'price', )
 
+    def get_queryset(self, request):
+        return super().get_queryset(request).with_current_price()
+
     def price(self, object):
         return object.price
 
@@ -400,6 +394,83 @@ class CouponCodeAdmin(admin.ModelAdmin):
 admin.site.register(models.CouponCode, CouponCodeAdmin)
 
 
+class InventoryHoldAdmin(admin.ModelAdmin):
+    list_display = ( '__str__', 'registration_level', 'dealer_registration_level', 'created', 'expires', )
+    list_filter = ( 'registration_level__convention', )
+
+admin.site.register(models.InventoryHold, InventoryHoldAdmin)
+
+
+class DuplicateClusterAdmin(admin.ModelAdmin):
+    list_display = ( '__str__', 'convention', 'found', 'reviewed', )
+    list_filter = ( 'convention', 'reviewed', )
+    list_editable = ( 'reviewed', )
+    raw_id_fields = ( 'registrations', )
+    readonly_fields = ( 'found', )
+
+admin.site.register(models.DuplicateCluster, DuplicateClusterAdmin)
+
+
+class JobAdmin(admin.ModelAdmin):
+    list_display = ( '__str__', 'kind', 'status', 'attempts', 'run_after', 'created', 'finished', )
+    list_filter = ( 'kind', 'status', )
+    readonly_fields = ( 'created', 'finished', 'last_error', )
+    actions = [ 'retry_jobs', ]
+
+    def retry_jobs(self, request, queryset):
+        # With a fresh set of attempts, or one that ran out would fail again at once
+        count = queryset.exclude(status=1).update(status=0, attempts=0, last_error=None, run_after=timezone.now())
+        self.message_user(request, '{} job(s) queued to run again.'.format(count))
+    retry_jobs.short_description = 'Retry selected jobs'
+
+admin.site.register(models.Job, JobAdmin)
+
+
+class PendingPaymentAdmin(admin.ModelAdmin):
+    list_display = ( '__str__', 'amount', 'charge_id', 'status', 'created', 'updated', 'finalized', )
+    list_filter = ( 'status', )
+    search_fields = ( 'charge_id', 'registration__email', )
+    raw_id_fields = ( 'registration', )
+    exclude = ( 'token', )
+    readonly_fields = ( 'created', 'updated', 'finalized', 'error', )
+
+admin.site.register(models.PendingPayment, PendingPaymentAdmin)
+
+
+class OutboxMessageAdmin(admin.ModelAdmin):
+    list_display = ( 'subject', 'to', 'status', 'attempts', 'send_after', 'created', 'sent', )
+    list_filter = ( 'status', )
+    search_fields = ( 'subject', 'to', )
+    readonly_fields = ( 'created', 'sent', 'last_error', )
+    actions = [ 'retry_messages', ]
+
+    def retry_messages(self, request, queryset):
+        # As with retry_jobs, with a fresh set of attempts
+        count = queryset.exclude(status=1).update(status=0, attempts=0, last_error=None, send_after=timezone.now())
+        self.message_user(request, '{} message(s) queued to send again.'.format(count))
+    retry_messages.short_description = 'Retry selected messages'
+
+admin.site.register(models.OutboxMessage, OutboxMessageAdmin)
+
+
+class AnnouncementAdmin(admin.ModelAdmin):
+    list_display = ( 'subject', 'convention', 'status', 'recipient_count', 'sent_count', 'failed_count', 'finished', )
+    list_filter = ( 'convention', 'status', )
+    readonly_fields = ( 'status', 'recipient_count', 'sent_count', 'failed_count', 'last_error', 'started', 'finished', )
+    actions = [ 'queue_announcements', ]
+
+    def recipient_count(self, obj):
+        return obj.recipients().count()
+
+    def queue_announcements(self, request, queryset):
+        # Sent by the send_announcements command, not in this request
+        count = queryset.filter(status=0).update(status=1)
+        self.message_user(request, '{} announcement(s) queued to send.'.format(count))
+    queue_announcements.short_description = 'Queue selected announcements to send'
+
+admin.site.register(models.Announcement, AnnouncementAdmin)
+
+
 # Other models that don't need customization
 admin.site.register(models.DealerRegistrationLevel)
 admin.site.register(models.PaymentMethod)
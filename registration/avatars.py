@@ -0,0 +1,208 @@
+from django.conf import settings
+from django.core.cache import caches
+
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+from PIL import Image, features
+import hashlib
+import logging
+import multiprocessing
+import threading
+import time
+
+from .utils import AvatarError
+
+logger = logging.getLogger(__name__)
+
+# Sized copies made of every registration avatar, by name: the size,
+# and whether to resize to it outright (as badge and staff page
+# compositing always has) rather than fit within it
+AVATAR_DERIVATIVES = {
+    'preview': ((200, 200), False),
+    'checkin': ((400, 400), False),
+    'badge': ((240, 240), True),
+    'staff': ((150, 150), True),
+}
+
+if features.check('webp'):
+    DERIVATIVE_FORMAT, DERIVATIVE_EXTENSION, DERIVATIVE_OPTIONS = 'WEBP', 'webp', {'quality': 85, 'method': 4}
+else:
+    DERIVATIVE_FORMAT, DERIVATIVE_EXTENSION, DERIVATIVE_OPTIONS = 'PNG', 'png', {'optimize': True}
+
+# Most pixels an upload may decode to (JPEGs count at the reduced
+# resolution they can be decoded at), and most bytes it may be
+MAX_AVATAR_PIXELS = 24 * 1000 * 1000
+MAX_AVATAR_BYTES = 10 * 1024 * 1024
+# Cropped uploads are stored no larger than this
+STORED_AVATAR_SIZE = (1024, 1024)
+# Smallest scale JPEG decoding can reduce to
+JPEG_MIN_SCALE = 8
+
+# Sizes avatar_thumbnail will make, as asked for by the templates, so
+# made-up sizes can't fill the thumbnail cache
+THUMBNAIL_SIZES = {(100, 100), (120, 120)} | {size for size, exact in AVATAR_DERIVATIVES.values()}
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def render_derivatives(data):
+    """
+    Decode an original avatar once and encode each derivative from it.
+    Runs in the process pool, so it takes and returns plain bytes:
+    {name: (encoded image, (width, height))}.
+    """
+    largest = max(size for size, exact in AVATAR_DERIVATIVES.values())
+    image, peak = open_avatar(BytesIO(data), largest)
+    image = image.convert('RGBA')
+    derivatives = {}
+    for name, (size, exact) in AVATAR_DERIVATIVES.items():
+        if exact:
+            derivative = image.resize(size, Image.LANCZOS)
+        else:
+            derivative = image.copy()
+            derivative.thumbnail(size, Image.LANCZOS)
+        output = BytesIO()
+        derivative.save(output, format=DERIVATIVE_FORMAT, **DERIVATIVE_OPTIONS)
+        derivatives[name] = (output.getvalue(), derivative.size)
+    return derivatives
+
+
+def decoded_bytes(image):
+    return image.width * image.height * len(image.getbands())
+
+
+def check_avatar(upload):
+    """
+    Raise AvatarError unless upload is an image within the byte and
+    pixel budgets, going by its size and header alone.
+    """
+    max_bytes = getattr(settings, 'REGISTRATION_AVATAR_MAX_BYTES', MAX_AVATAR_BYTES)
+    if upload.size > max_bytes:
+        raise AvatarError('Please use an image under {} MB.'.format(max_bytes // (1024 * 1024)))
+    image = _open(upload)
+    width, height = image.size
+    if image.format == 'JPEG':
+        width, height = -(-width // JPEG_MIN_SCALE), -(-height // JPEG_MIN_SCALE)
+    _check_pixels(width, height)
+    upload.seek(0)
+
+
+def open_avatar(source, target=None, box=None):
+    """
+    Open an image for resizing to target, optionally cropped to box,
+    without decoding more of it than needed. Only the header is read
+    until the pixel budget is checked. JPEGs are decoded at the least
+    resolution that still covers target, and box is cropped before any
+    conversion, so the full image is never held as RGBA. Returns the
+    image and the most bytes its decoded pixels took along the way.
+    """
+    image = _open(source)
+    original = image.size
+    box = box or (0, 0) + original
+    if target and image.format == 'JPEG':
+        # Whole-image size at which the crop still covers the target
+        crop_width, crop_height = max(box[2] - box[0], 1), max(box[3] - box[1], 1)
+        image.draft(None, (max(original[0] * target[0] // crop_width, 1),
+                           max(original[1] * target[1] // crop_height, 1)))
+    _check_pixels(*image.size)
+    if image.size != original:
+        box = (box[0] * image.width // original[0], box[1] * image.height // original[1],
+               box[2] * image.width // original[0], box[3] * image.height // original[1])
+    image.load()
+    peak = decoded_bytes(image)
+    if box != (0, 0) + image.size:
+        image = image.crop(box)
+        peak += decoded_bytes(image)
+    return image, peak
+
+
+def _open(source):
+    try:
+        return Image.open(source)
+    except (Image.UnidentifiedImageError, Image.DecompressionBombError, OSError):
+        raise AvatarError('That file is not an image we can use.')
+
+
+def _check_pixels(width, height):
+    max_pixels = getattr(settings, 'REGISTRATION_AVATAR_MAX_PIXELS', MAX_AVATAR_PIXELS)
+    if width * height > max_pixels:
+        raise AvatarError('That image is too large, please use one under {} megapixels.'.format(
+            max_pixels // (1000 * 1000)))
+
+
+def get_pool():
+    """
+    The shared pool avatars are processed in, with
+    settings.REGISTRATION_AVATAR_WORKERS processes (default one per
+    CPU). Workers are spawned fresh rather than forked, so they don't
+    inherit database connections or threads.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=getattr(settings, 'REGISTRATION_AVATAR_WORKERS', None),
+                                        mp_context=multiprocessing.get_context('spawn'))
+        return _pool
+
+
+def process_avatars(originals):
+    """render_derivatives() over an iterable of original images, in the pool. Results come back in order."""
+    return get_pool().map(render_derivatives, originals)
+
+
+def derivative_name(registration_id, avatar_name, name):
+    # Named for the original too, so a new avatar gets new URLs
+    digest = hashlib.sha1(avatar_name.encode('utf-8')).hexdigest()[:8]
+    return 'reg_avatars/derivatives/{0}_{1}_{2}.{3}'.format(registration_id, name, digest, DERIVATIVE_EXTENSION)
+
+
+def thumbnail_sizes():
+    return {tuple(size) for size in getattr(settings, 'REGISTRATION_AVATAR_THUMBNAIL_SIZES', THUMBNAIL_SIZES)}
+
+
+def thumbnail_key(avatar_type, object_id, size, source_name):
+    # The source's storage name changes whenever the image is replaced
+    return 'avatar_thumbnail_{}'.format(hashlib.sha1('{0}:{1}:{2}x{3}:{4}'.format(
+        avatar_type, object_id, size[0], size[1], source_name
+    ).encode('utf-8')).hexdigest())
+
+
+def render_thumbnail(source, size):
+    image, peak = open_avatar(source, size)
+    image.thumbnail(size, Image.BICUBIC)
+    output = BytesIO()
+    image.convert('RGBA').save(output, format='png')
+    return output.getvalue()
+
+
+def get_thumbnail(key, source, size):
+    """
+    Thumbnail PNG for the cache key, made from source if it isn't in
+    the settings.REGISTRATION_THUMBNAIL_CACHE cache (default 'default').
+    Returns (image bytes, when it was made as a timestamp). Eviction is
+    left to the cache backend, memcached for one does so by size.
+    """
+    cache = caches[getattr(settings, 'REGISTRATION_THUMBNAIL_CACHE', 'default')]
+    entry = cache.get(key)
+    if entry is None:
+        entry = (render_thumbnail(source, size), int(time.time()))
+        cache.set(key, entry, getattr(settings, 'REGISTRATION_THUMBNAIL_CACHE_SECONDS', 60 * 60 * 24 * 7))
+    return entry
+
+
+def crop_avatar(source, box):
+    """
+    The box of an uploaded image, reduced to fit STORED_AVATAR_SIZE, as
+    PNG bytes. The peak memory its decoding took is logged.
+    """
+    started = time.monotonic()
+    image, peak = open_avatar(source, STORED_AVATAR_SIZE, box)
+    image.thumbnail(STORED_AVATAR_SIZE, Image.LANCZOS)
+    image = image.convert('RGBA')
+    peak = max(peak, decoded_bytes(image))
+    output = BytesIO()
+    image.save(output, format='png')
+    logger.info('Cropped avatar to %dx%d in %.2fs, peak decoded image memory %.1f MB',
+                image.width, image.height, time.monotonic() - started, peak / (1024 * 1024))
+    return output.getvalue()
@@ -0,0 +1,224 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ObjectDoesNotExist
+from django.db import transaction
+from django.utils import timezone
+
+import copy
+import uuid
+
+from .models import (
+    Convention, RegistrationLevel, RegistrationLevelPrice, RegistrationUpgrade,
+    RegistrationUpgradePrice, DealerRegistrationLevel, PaymentMethod, ShirtSize,
+)
+
+# Generation markers in the shared cache, so a change saved by one
+# process retires the snapshots held by every other process
+GLOBAL_GENERATION_KEY = 'registration_catalog'
+CONVENTION_GENERATION_KEY = 'registration_catalog_{}'
+CURRENT_CONVENTION_GENERATION_KEY = 'registration_current_convention'
+
+_catalogs = {}
+_current_conventions = {}
+
+
+class Catalog(object):
+    """
+    Snapshot of what a convention has on sale: its levels and their
+    current prices, the upgrade paths between them, dealer levels,
+    payment methods and shirt sizes.
+
+    The snapshot is only good until the next level opens or closes or
+    the next price takes effect, and expires exactly then. Objects are
+    handed out as copies, so callers are free to cache things on them.
+    """
+
+    def __init__(self, convention_id, generation=None):
+        self.convention_id = convention_id
+        self.generation = generation
+        now = timezone.now()
+        boundaries = []
+
+        levels = list(RegistrationLevel.objects.filter(convention_id=convention_id).select_related('convention').order_by('seq'))
+        self._levels = {level.id: level for level in levels}
+        self._current_levels = []
+        for level in levels:
+            if level.opens and level.opens > now:
+                boundaries.append(level.opens)
+            if level.deadline and level.deadline >= now:
+                boundaries.append(level.deadline)
+            if level.active and not (level.opens and level.opens > now) \
+                    and not (level.deadline and level.deadline < now):
+                self._current_levels.append(level)
+
+        self._level_prices = self._current_prices(
+            RegistrationLevelPrice.objects.filter(registration_level__convention_id=convention_id),
+            'registration_level_id', now, boundaries,
+        )
+
+        upgrades = RegistrationUpgrade.objects.filter(
+            active=True,
+            current_registration_level__convention_id=convention_id,
+            upgrade_registration_level__convention_id=convention_id,
+        )
+        self._upgrades = {}
+        for upgrade in upgrades:
+            upgrade.current_registration_level = self._levels[upgrade.current_registration_level_id]
+            upgrade.upgrade_registration_level = self._levels[upgrade.upgrade_registration_level_id]
+            self._upgrades.setdefault(upgrade.current_registration_level_id, []).append(upgrade)
+        for options in self._upgrades.values():
+            options.sort(key=lambda upgrade: upgrade.upgrade_registration_level.seq)
+        self._upgrade_prices = self._current_prices(
+            RegistrationUpgradePrice.objects.filter(
+                registration_upgrade__current_registration_level__convention_id=convention_id,
+            ),
+            'registration_upgrade_id', now, boundaries,
+        )
+
+        self._dealer_levels = list(
+            DealerRegistrationLevel.objects.filter(convention_id=convention_id)
+            .select_related('convention').order_by('number_tables')
+        )
+        self._payment_methods = list(PaymentMethod.objects.filter(active=True).order_by('seq'))
+        self._shirt_sizes = list(ShirtSize.objects.order_by('seq'))
+
+        self.expires = min(boundaries) if boundaries else None
+
+    @staticmethod
+    def _current_prices(prices, key, now, boundaries):
+        # Latest price already in effect for each object, same as the
+        # price properties on the models
+        current = {}
+        for price in prices.order_by('active_date'):
+            if price.active_date < now:
+                current[getattr(price, key)] = price.price
+            else:
+                boundaries.append(price.active_date)
+        return current
+
+    def expired(self):
+        return self.expires is not None and timezone.now() >= self.expires
+
+    def level(self, level_id):
+        return copy.copy(self._levels.get(level_id))
+
+    def levels(self):
+        return [copy.copy(level) for level in self._levels.values()]
+
+    def current_levels(self):
+        return [copy.copy(level) for level in self._current_levels]
+
+    def level_price(self, level_id):
+        return self._level_prices.get(level_id)
+
+    def upgrades_from(self, level_id):
+        """Active upgrades out of a level whose target hasn't closed."""
+        now = timezone.now()
+        options = []
+        for upgrade in self._upgrades.get(level_id, []):
+            deadline = upgrade.upgrade_registration_level.deadline
+            if deadline and deadline < now:
+                continue
+            option = copy.copy(upgrade)
+            option.current_registration_level = copy.copy(upgrade.current_registration_level)
+            option.upgrade_registration_level = copy.copy(upgrade.upgrade_registration_level)
+            options.append(option)
+        return options
+
+    def upgrade_price(self, upgrade_id):
+        return self._upgrade_prices.get(upgrade_id)
+
+    def dealer_levels(self):
+        return [copy.copy(level) for level in self._dealer_levels]
+
+    def payment_methods(self, is_credit=None):
+        return [copy.copy(method) for method in self._payment_methods
+                if is_credit is None or method.is_credit == is_credit]
+
+    def shirt_sizes(self):
+        return [copy.copy(size) for size in self._shirt_sizes]
+
+
+def get_catalog(convention):
+    """Return the catalog for a convention (or convention id), building it if needed."""
+    convention_id = getattr(convention, 'pk', convention)
+    generation_key = CONVENTION_GENERATION_KEY.format(convention_id)
+    generations = cache.get_many([GLOBAL_GENERATION_KEY, generation_key])
+    generation = (generations.get(GLOBAL_GENERATION_KEY), generations.get(generation_key))
+
+    catalog = _catalogs.get(convention_id)
+    if catalog is None or catalog.generation != generation or catalog.expired():
+        catalog = Catalog(convention_id, generation)
+        _catalogs[convention_id] = catalog
+    return catalog
+
+
+def invalidate_catalog(convention_id=None):
+    """
+    Retire the catalog for one convention, or for all of them. Other
+    processes are only told once the change commits, since one built
+    before that would hold the old rows under the new generation.
+    """
+    def retire():
+        if convention_id is None:
+            _catalogs.clear()
+            cache.set(GLOBAL_GENERATION_KEY, uuid.uuid4().hex, None)
+        else:
+            _catalogs.pop(convention_id, None)
+            cache.set(CONVENTION_GENERATION_KEY.format(convention_id), uuid.uuid4().hex, None)
+
+    # Dropped here straight away too, so this process sees its own change
+    if convention_id is None:
+        _catalogs.clear()
+    else:
+        _catalogs.pop(convention_id, None)
+    transaction.on_commit(retire)
+
+
+def get_current_convention():
+    """
+    Convention.objects.current() with its RegistrationSettings already
+    attached, remembered until a Convention or RegistrationSettings is
+    saved in any process. Returns a copy each call.
+    """
+    generation = cache.get(CURRENT_CONVENTION_GENERATION_KEY)
+    site_id = getattr(settings, 'SITE_ID', None)
+    cached = _current_conventions.get(site_id)
+    if cached is None or cached[0] != generation:
+        convention = Convention.objects.current()
+        if convention is not None:
+            try:
+                convention.registrationsettings
+            except ObjectDoesNotExist:
+                pass
+        cached = (generation, convention)
+        _current_conventions[site_id] = cached
+
+    convention = cached[1]
+    if convention is None:
+        return None
+    current = copy.copy(convention)
+    try:
+        current.registrationsettings = copy.copy(convention.registrationsettings)
+    except ObjectDoesNotExist:
+        pass
+    return current
+
+
+def get_current_settings():
+    """RegistrationSettings for the current convention, or None."""
+    convention = get_current_convention()
+    try:
+        return convention.registrationsettings if convention else None
+    except ObjectDoesNotExist:
+        return None
+
+
+def invalidate_current_convention():
+    # As with invalidate_catalog(), published once the change commits
+    def retire():
+        _current_conventions.clear()
+        cache.set(CURRENT_CONVENTION_GENERATION_KEY, uuid.uuid4().hex, None)
+
+    _current_conventions.clear()
+    transaction.on_commit(retire)
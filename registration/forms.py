@@ -1,12 +1,15 @@
 from django import forms
 from django.core.exceptions import ValidationError, ObjectDoesNotExist
+from django.forms.models import ModelChoiceIterator
 from django.forms.widgets import SelectDateWidget
 from django.utils import timezone
 from .models import (
     Convention, Registration, PaymentMethod, RegistrationUpgrade,
     RegistrationLevel, DealerRegistrationLevel, ShirtSize,
-    CouponCode, CouponUse
+    CouponCode, CouponUse,
+    RegistrationLevelInventory, DealerRegistrationLevelInventory,
 )
+from .catalog import get_catalog, get_current_convention
 from .widgets import BootstrapChoiceWidget
 from datetime import date
 import codecs
@@ -42,7 +45,51 @@ def build_countries():
     return [(x,x) for x in countries]
 
 
-class RegistrationLevelChoiceField(forms.ModelChoiceField):
+class CatalogChoiceIterator(ModelChoiceIterator):
+    def __iter__(self):
+        if self.field.empty_label is not None:
+            yield ("", self.field.empty_label)
+        for obj in self.field.catalog_objects:
+            yield self.choice(obj)
+
+    def __len__(self):
+        return len(self.field.catalog_objects) + (1 if self.field.empty_label is not None else 0)
+
+    def __bool__(self):
+        return self.field.empty_label is not None or bool(self.field.catalog_objects)
+
+
+class CatalogChoiceField(forms.ModelChoiceField):
+    """ModelChoiceField that can take its choices from a catalog snapshot
+        instead of a queryset. Falls back to the queryset until
+        catalog_objects is set."""
+
+    def _get_catalog_objects(self):
+        return self._catalog_objects
+
+    def _set_catalog_objects(self, objects):
+        self._catalog_objects = list(objects)
+        self.iterator = CatalogChoiceIterator
+        self.widget.choices = self.choices
+
+    _catalog_objects = None
+    catalog_objects = property(_get_catalog_objects, _set_catalog_objects)
+
+    def to_python(self, value):
+        if self.catalog_objects is None:
+            return super(CatalogChoiceField, self).to_python(value)
+        if value in self.empty_values:
+            return None
+        key = self.to_field_name or 'pk'
+        if isinstance(value, self.queryset.model):
+            value = getattr(value, key)
+        for obj in self.catalog_objects:
+            if str(getattr(obj, key)) == str(value):
+                return obj
+        raise ValidationError(self.error_messages['invalid_choice'], code='invalid_choice', params={'value': value})
+
+
+class RegistrationLevelChoiceField(CatalogChoiceField):
     def label_from_instance(self, obj):
         if hasattr(obj, 'upgrade_registration_level'):
             return '{0} [${1:.02f}]'.format(obj.upgrade_registration_level.title, float(obj.price))
@@ -81,6 +128,8 @@ class CIEditForm(forms.ModelForm):
                 }
 
     registration_level = RegistrationLevelChoiceField(widget=BootstrapChoiceWidget(), empty_label=None, queryset=RegistrationLevel.objects.none())
+    dealer_registration_level = CatalogChoiceField(widget=BootstrapChoiceWidget(), required=False, label='Dealer Tables', queryset=DealerRegistrationLevel.objects.none())
+    shirt_size = CatalogChoiceField(widget=BootstrapChoiceWidget(), empty_label=None, queryset=ShirtSize.objects.none())
 
     def clean_birthday(self):
         data = self.cleaned_data['birthday']
@@ -100,14 +149,14 @@ class CIEditForm(forms.ModelForm):
         data = self.cleaned_data['registration_level']
         if ( (data.deadline and data.deadline <= timezone.now()) or
            data.active == False or
-           (data.limit and len(Registration.objects.filter(registration_level=data)) >= data.limit)):
+           data.sold_out()):
             raise ValidationError("That registration level is no longer available.")
 
         return data
 
     def clean_dealer_registration_level(self):
         data = self.cleaned_data['dealer_registration_level']
-        if data and data.convention.dealer_limit and len(Registration.objects.filter(dealer_registration_level=data)) + data.number_tables > data.convention.dealer_limit:
+        if data and data.sold_out():
             raise ValidationError("That dealer registration level is no longer available.")
 
         return data
@@ -121,15 +170,15 @@ class CIEditForm(forms.ModelForm):
 
     def __init__(self, *args, **kwargs):
         super(CIEditForm, self).__init__(*args, **kwargs)
-        current_convention = Convention.objects.current()
+        catalog = get_catalog(get_current_convention())
         self.fields['registration_level'].empty_label = None
-        self.fields['registration_level'].queryset=RegistrationLevel.current.all().order_by('seq')
+        self.fields['registration_level'].catalog_objects = catalog.current_levels()
 
         self.fields['dealer_registration_level'].empty_label = 'None'
-        self.fields['dealer_registration_level'].queryset=DealerRegistrationLevel.objects.filter(convention=current_convention).order_by('number_tables')
+        self.fields['dealer_registration_level'].catalog_objects = catalog.dealer_levels()
 
         self.fields['shirt_size'].empty_label = None
-        self.fields['shirt_size'].queryset=ShirtSize.objects.order_by('seq')
+        self.fields['shirt_size'].catalog_objects = catalog.shirt_sizes()
 
 
 class CIPaymentForm(forms.Form):
@@ -145,12 +194,12 @@ class CIPaymentForm(forms.Form):
         else:
             registration_levels = None
         super(CIPaymentForm, self).__init__(*args, **kwargs)
-        current_convention = Convention.objects.current()
         self.fields['registration_level'].empty_label = None
         if registration_levels:
             self.fields['registration_level'].queryset=registration_levels
         else:
-            self.fields['registration_level'].queryset=RegistrationLevel.current.all().order_by('seq')
+            catalog = get_catalog(get_current_convention())
+            self.fields['registration_level'].catalog_objects = catalog.current_levels()
 
 
 class RegistrationForm(forms.ModelForm):
@@ -183,11 +232,17 @@ class RegistrationForm(forms.ModelForm):
             'shirt_size': BootstrapChoiceWidget(),
         }
 
-    payment_method = forms.ModelChoiceField(widget=BootstrapChoiceWidget(), empty_label=None, queryset=PaymentMethod.objects.filter(active=True).order_by('seq'))
+    payment_method = CatalogChoiceField(widget=BootstrapChoiceWidget(), empty_label=None, queryset=PaymentMethod.objects.filter(active=True).order_by('seq'))
     registration_level = RegistrationLevelChoiceField(widget=BootstrapChoiceWidget(), empty_label=None, queryset=RegistrationLevel.objects.none())
+    dealer_registration_level = CatalogChoiceField(widget=BootstrapChoiceWidget(), required=False, label='Dealer Tables', queryset=DealerRegistrationLevel.objects.none())
+    shirt_size = CatalogChoiceField(widget=BootstrapChoiceWidget(), empty_label=None, queryset=ShirtSize.objects.none())
     coupon_code = forms.CharField(required=False)
     tos = forms.BooleanField(required=True, label='I agree to the Motor City Furry Convention <a href="/tos/" target="_blank">Code of Conduct</a>.')
 
+    # The buyer's own InventoryHold, set at the confirm step so it
+    # isn't counted against them
+    inventory_hold = None
+
     def clean_birthday(self):
         data = self.cleaned_data['birthday']
         validate_birthday(data)
@@ -206,16 +261,18 @@ class RegistrationForm(forms.ModelForm):
         data = self.cleaned_data['registration_level']
         if ( (data.deadline and data.deadline <= timezone.now()) or
            data.active == False or
-           (data.limit and len(Registration.objects.filter(registration_level=data)) >= data.limit)):
+           data.sold_out(self.inventory_hold)):
             raise ValidationError("That registration level is no longer available.")
 
         return data
 
     def clean_dealer_registration_level(self):
         data = self.cleaned_data['dealer_registration_level']
-        if data and len(Registration.objects.filter(dealer_registration_level=data)) + data.number_tables > data.convention.dealer_limit:
+        if data and data.sold_out(self.inventory_hold):
             raise ValidationError("That dealer registration level is no longer available.")
 
+        return data
+
     def clean_payment_method(self):
         data = self.cleaned_data['payment_method']
         if data.active == False:
@@ -247,7 +304,7 @@ class RegistrationForm(forms.ModelForm):
         data = self.cleaned_data['coupon_code']
         if data:
             try:
-                code = CouponCode.objects.get(code=data, convention=Convention.objects.current())
+                code = CouponCode.objects.get(code=data, convention=get_current_convention())
             except ObjectDoesNotExist:
                 code = None
 
@@ -262,19 +319,24 @@ class RegistrationForm(forms.ModelForm):
 
     def __init__(self, *args, **kwargs):
         super(RegistrationForm, self).__init__(*args, **kwargs)
-        current_convention = Convention.objects.current()
+        catalog = get_catalog(get_current_convention())
+        self.fields['payment_method'].catalog_objects = catalog.payment_methods()
+
+        # Level details come from the catalog, sold counts are always fresh
+        levels = RegistrationLevelInventory.objects.attach(catalog.current_levels())
         self.fields['registration_level'].empty_label = None
-        self.fields['registration_level'].queryset=RegistrationLevel.current.all().order_by('seq')
+        self.fields['registration_level'].catalog_objects = levels
 
-        for level in self.fields['registration_level'].queryset:
-            if level.limit and len(Registration.objects.filter(registration_level=level)) >= level.limit:
+        for level in levels:
+            if level.sold_out():
                 self.fields['registration_level'].widget.disable_option(level.id, 'Sold Out')
 
         self.fields['dealer_registration_level'].empty_label = 'None'
-        self.fields['dealer_registration_level'].queryset=DealerRegistrationLevel.objects.filter(convention=current_convention).order_by('number_tables')
+        self.fields['dealer_registration_level'].catalog_objects = \
+            DealerRegistrationLevelInventory.objects.attach(catalog.dealer_levels())
 
         self.fields['shirt_size'].empty_label = None
-        self.fields['shirt_size'].queryset=ShirtSize.objects.order_by('seq')
+        self.fields['shirt_size'].catalog_objects = catalog.shirt_sizes()
 
 
 class UserRegUpdateForm(forms.Form):
@@ -292,7 +354,7 @@ class UserRegUpdateForm(forms.Form):
         return data
 
 
-class UpgradeChoiceField(forms.ModelChoiceField):
+class UpgradeChoiceField(CatalogChoiceField):
     def label_from_instance(self, obj):
         return '{0} [+ ${1:.02f}]'.format(obj.upgrade_registration_level.title, float(obj.price))
 
@@ -301,10 +363,13 @@ class UpgradeForm(forms.Form):
 
     # Will populate upgrade_level on initialization
     upgrade = UpgradeChoiceField(widget=BootstrapChoiceWidget(), empty_label=None, queryset=RegistrationUpgrade.objects.none())
-    payment_method = forms.ModelChoiceField(widget=BootstrapChoiceWidget(), empty_label=None, queryset=PaymentMethod.objects.filter(active=True, is_credit=True).order_by('seq'))
+    payment_method = CatalogChoiceField(widget=BootstrapChoiceWidget(), empty_label=None, queryset=PaymentMethod.objects.filter(active=True, is_credit=True).order_by('seq'))
     coupon_code = forms.CharField(required=False)
     tos = forms.BooleanField(required=True, label='I agree to the Motor City Furry Convention <a href="/tos/" target="_blank">Code of Conduct &amp; Terms and Conditions</a>.')
 
+    # As on RegistrationForm
+    inventory_hold = None
+
     def clean_payment_method(self):
         data = self.cleaned_data['payment_method']
         if data.active == False:
@@ -316,7 +381,7 @@ class UpgradeForm(forms.Form):
         data = self.cleaned_data['upgrade']
         level = data.upgrade_registration_level
         if ( (level.deadline and level.deadline <= timezone.now()) or
-                (level.limit and len(Registration.objects.filter(registration_level=level)) >= level.limit)):
+                level.sold_out(self.inventory_hold)):
             raise ValidationError("That registration level is no longer available.")
 
         return data
@@ -328,7 +393,7 @@ class UpgradeForm(forms.Form):
                 raise ValidationError("This registration has previously used a coupon code, a second code can not currently be used.")
 
             try:
-                code = CouponCode.objects.get(code=data, convention=Convention.objects.current())
+                code = CouponCode.objects.get(code=data, convention=get_current_convention())
             except ObjectDoesNotExist:
                 code = None
 
@@ -349,22 +414,23 @@ class UpgradeForm(forms.Form):
             self.selected_registration = Registration.objects.get(id=args[0]['registration'])
 
         super(UpgradeForm, self).__init__(*args, **kwargs)
+        catalog = get_catalog(get_current_convention())
+        self.fields['payment_method'].catalog_objects = catalog.payment_methods(is_credit=True)
 
         if self.selected_registration:
             self.allow_coupon_code = self.selected_registration.couponuse_set.count() == 0
             # Calculate upgrade options given the selected registration
-            upgrade_options = RegistrationUpgrade.objects.filter(active=True,
-                                                                 current_registration_level=self.selected_registration.registration_level,
-                                                                 #upgrade_registration_level__active=True,
-            ).exclude(
-                                                                 upgrade_registration_level__deadline__lt=timezone.now(),
-            ).order_by('upgrade_registration_level__seq')
+            registration_level = self.selected_registration.registration_level
+            upgrade_options = get_catalog(registration_level.convention_id).upgrades_from(registration_level.id)
+            RegistrationLevelInventory.objects.attach(
+                [upgrade.upgrade_registration_level for upgrade in upgrade_options]
+            )
             self.fields['upgrade'].empty_label = None
-            self.fields['upgrade'].queryset = upgrade_options
+            self.fields['upgrade'].catalog_objects = upgrade_options
 
-            for upgrade in self.fields['upgrade'].queryset:
+            for upgrade in upgrade_options:
                 level = upgrade.upgrade_registration_level
-                if level.limit and len(Registration.objects.filter(registration_level=level)) >= level.limit:
+                if level.sold_out():
                     self.fields['upgrade'].widget.disable_option(upgrade.id, 'Sold Out')
 
 
@@ -373,7 +439,7 @@ class DealerUpgradeForm(forms.Form):
     """Simplified RegistrationForm for dealer upgrades."""
 
     # Will populate upgrade_level on initialization
-    payment_method = forms.ModelChoiceField(widget=BootstrapChoiceWidget(), empty_label=None, queryset=PaymentMethod.objects.filter(active=True, is_credit=True).order_by('seq'))
+    payment_method = CatalogChoiceField(widget=BootstrapChoiceWidget(), empty_label=None, queryset=PaymentMethod.objects.filter(active=True, is_credit=True).order_by('seq'))
     coupon_code = forms.CharField(required=True)
     tos = forms.BooleanField(required=True, label='I agree to the Motor City Furry Convention <a href="/tos/" target="_blank">Code of Conduct &amp; Terms and Conditions</a>.')
 
@@ -388,7 +454,7 @@ class DealerUpgradeForm(forms.Form):
         data = self.cleaned_data['coupon_code']
         if data:
             try:
-                code = CouponCode.objects.get(code=data, convention=Convention.objects.current())
+                code = CouponCode.objects.get(code=data, convention=get_current_convention())
             except ObjectDoesNotExist:
                 code = None
 
@@ -412,3 +478,5 @@ class DealerUpgradeForm(forms.Form):
             self.selected_registration = Registration.objects.get(id=args[0]['registration'])
 
         super(DealerUpgradeForm, self).__init__(*args, **kwargs)
+        catalog = get_catalog(get_current_convention())
+        self.fields['payment_method'].catalog_objects = catalog.payment_methods(is_credit=True)
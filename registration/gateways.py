@@ -0,0 +1,231 @@
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.module_loading import import_string
+
+import json
+import random
+import re
+import threading
+import time
+import uuid
+
+from .utils import PaymentError
+
+DEFAULT_GATEWAY = 'registration.gateways.StripeGateway'
+
+
+class PaymentGateway(object):
+    """
+    Where card payments go. charge() returns an object whose id is kept
+    as Payment.payment_extra, and raises PaymentError with a message
+    fit for the user if the payment is declined. refund() and
+    retrieve() take that id back.
+
+    Charges carry a status of 'succeeded', 'failed' or 'pending', the
+    last settled later by a webhook call that parse_webhook() reads as
+    a (charge id, status) pair. A charge repeated with the same
+    idempotency_key returns the original rather than charging again.
+    """
+
+    def __init__(self, **options):
+        pass
+
+    def charge(self, amount, token, description, idempotency_key=None):
+        raise NotImplementedError
+
+    def refund(self, charge_id, idempotency_key=None):
+        raise NotImplementedError
+
+    def retrieve(self, charge_id):
+        raise NotImplementedError
+
+    def parse_webhook(self, request):
+        """
+        Returns (charge id, status) from a webhook request, or None for
+        events that don't settle a charge. Raises PaymentError if the
+        request can't be verified.
+        """
+        raise NotImplementedError
+
+
+class StripeGateway(PaymentGateway):
+    def __init__(self, secret_key=None, currency='USD', webhook_secret=None, **options):
+        # Passed per call rather than set on the stripe module, so
+        # conventions with their own keys don't trample each other
+        self.secret_key = secret_key or settings.STRIPE_SECRET_KEY
+        self.currency = currency
+        self.webhook_secret = webhook_secret or getattr(settings, 'STRIPE_WEBHOOK_SECRET', None)
+
+    def charge(self, amount, token, description, idempotency_key=None):
+        import stripe
+        try:
+            return stripe.Charge.create(amount=int(amount * 100),
+                                        currency=self.currency,
+                                        card=token,
+                                        description=description,
+                                        api_key=self.secret_key,
+                                        idempotency_key=idempotency_key)
+        except stripe.error.CardError as e:
+            # Pass a "Payment Declined" error to the user
+            raise PaymentError('A payment error has occurred: {}'.format(e.json_body['error']['message']))
+
+    def refund(self, charge_id, idempotency_key=None):
+        import stripe
+        try:
+            return stripe.Refund.create(charge=charge_id, api_key=self.secret_key,
+                                        idempotency_key=idempotency_key)
+        except stripe.error.StripeError as e:
+            raise PaymentError(e.json_body['error']['message'] if e.json_body else str(e))
+
+    def retrieve(self, charge_id):
+        import stripe
+        try:
+            return stripe.Charge.retrieve(charge_id, api_key=self.secret_key)
+        except stripe.error.StripeError as e:
+            raise PaymentError(e.json_body['error']['message'] if e.json_body else str(e))
+
+    def parse_webhook(self, request):
+        import stripe
+        try:
+            event = stripe.Webhook.construct_event(request.body,
+                                                   request.META.get('HTTP_STRIPE_SIGNATURE', ''),
+                                                   self.webhook_secret)
+        except (ValueError, stripe.error.SignatureVerificationError) as e:
+            raise PaymentError(str(e))
+        if event['type'] in ('charge.succeeded', 'charge.failed'):
+            charge = event['data']['object']
+            return charge['id'], charge['status']
+        return None
+
+
+class FakeCharge(object):
+    def __init__(self, amount, description, status='succeeded', id=None):
+        self.id = id or 'fake_ch_{}'.format(uuid.uuid4().hex)
+        self.amount = amount
+        self.description = description
+        self.refunded = False
+        self.status = status
+
+
+class FakeGateway(PaymentGateway):
+    """
+    In-process stand-in for load testing and development. Takes latency
+    seconds (give or take jitter) per call, and declines failure_rate of
+    charges at random, as well as any made with the token 'decline'.
+    With pending, charges are left for a webhook to settle: a POST of
+    {"charge": id, "status": "succeeded" or "failed"} as JSON.
+
+    Charges and refunds are kept in the named Django cache, so with a
+    shared cache backend the web workers and refund_payments see the
+    same ones. A well-formed charge id the cache doesn't have (evicted,
+    or from a process-local cache) is taken as a succeeded charge.
+    """
+
+    ID_PATTERN = re.compile(r'^fake_ch_[0-9a-f]{32}$')
+
+    def __init__(self, latency=0, jitter=0, failure_rate=0, pending=False, cache='default', **options):
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.pending = pending
+        self.cache = caches[cache]
+
+    def _wait(self):
+        delay = self.latency + random.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+    def _get(self, charge_id):
+        charge = self.cache.get('fake_gateway_charge_{}'.format(charge_id))
+        if charge is None:
+            if not self.ID_PATTERN.match(charge_id or ''):
+                raise PaymentError('No such charge: {}'.format(charge_id))
+            charge = FakeCharge(None, '', id=charge_id)
+        charge.refunded = bool(self.cache.get('fake_gateway_refunded_{}'.format(charge_id)))
+        return charge
+
+    def _remember(self, idempotency_key, result):
+        # Whichever call got there first wins
+        if not idempotency_key:
+            return result
+        key = 'fake_gateway_idempotent_{}'.format(idempotency_key)
+        if self.cache.add(key, result, None):
+            return result
+        return self.cache.get(key, result)
+
+    def charge(self, amount, token, description, idempotency_key=None):
+        self._wait()
+        if idempotency_key:
+            previous = self.cache.get('fake_gateway_idempotent_{}'.format(idempotency_key))
+            if previous is not None:
+                return previous
+        if token == 'decline' or random.random() < self.failure_rate:
+            raise PaymentError('A payment error has occurred: Your card was declined.')
+        charge = FakeCharge(amount, description, 'pending' if self.pending else 'succeeded')
+        self.cache.set('fake_gateway_charge_{}'.format(charge.id), charge, None)
+        return self._remember(idempotency_key, charge)
+
+    def refund(self, charge_id, idempotency_key=None):
+        self._wait()
+        if idempotency_key:
+            previous = self.cache.get('fake_gateway_idempotent_{}'.format(idempotency_key))
+            if previous is not None:
+                return previous
+        charge = self._get(charge_id)
+        if random.random() < self.failure_rate:
+            raise PaymentError('The refund could not be processed.')
+        # Only one refund per charge, across processes
+        if not self.cache.add('fake_gateway_refunded_{}'.format(charge_id), True, None):
+            raise PaymentError('Charge {} has already been refunded.'.format(charge_id))
+        charge.refunded = True
+        return self._remember(idempotency_key, charge)
+
+    def retrieve(self, charge_id):
+        self._wait()
+        return self._get(charge_id)
+
+    def parse_webhook(self, request):
+        try:
+            event = json.loads(request.body)
+            charge_id, status = event['charge'], event['status']
+        except (ValueError, TypeError, KeyError) as e:
+            raise PaymentError('Malformed webhook: {}'.format(e))
+        self.settle(charge_id, status)
+        return charge_id, status
+
+    def settle(self, charge_id, status):
+        """Settle a pending charge as 'succeeded' or 'failed', as the card network would."""
+        charge = self._get(charge_id)
+        charge.status = status
+        self.cache.set('fake_gateway_charge_{}'.format(charge_id), charge, None)
+
+
+class RateLimiter(object):
+    """Spaces out calls from any number of threads to at most rate a second."""
+
+    def __init__(self, rate=None):
+        self.interval = 1.0 / rate if rate else 0
+        self.next_call = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            call_at = max(now, self.next_call)
+            self.next_call = call_at + self.interval
+        if call_at > now:
+            time.sleep(call_at - now)
+
+
+def get_gateway(**options):
+    """
+    The gateway named by settings.REGISTRATION_PAYMENT_GATEWAY, set up
+    with settings.REGISTRATION_PAYMENT_GATEWAY_OPTIONS plus any options
+    given here.
+    """
+    gateway_class = import_string(getattr(settings, 'REGISTRATION_PAYMENT_GATEWAY', DEFAULT_GATEWAY))
+    gateway_options = dict(getattr(settings, 'REGISTRATION_PAYMENT_GATEWAY_OPTIONS', {}))
+    gateway_options.update(options)
+    return gateway_class(**gateway_options)
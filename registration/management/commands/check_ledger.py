@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from convention import get_convention_model
+
+from ...models import Registration
+
+class Command(BaseCommand):
+    help = 'Report registrations whose payment ledger has drifted from their payments and coupon uses'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--convention', type=int, help='Convention ID, defaults to the current convention')
+        parser.add_argument('--all', action='store_true', help='Check every convention')
+
+    def handle(self, *args, **options):
+        registrations = Registration.all_registrations.all()
+        if not options['all']:
+            convention_id = options['convention']
+            if not convention_id:
+                convention = get_convention_model().objects.current()
+                if not convention:
+                    raise CommandError('No current convention, use --convention or --all')
+                convention_id = convention.id
+            registrations = registrations.filter(convention_id=convention_id)
+
+        drifted = 0
+        for registration, computed in registrations.ledger_drift():
+            drifted += 1
+            changes = ', '.join(
+                '{}: {} != {}'.format(field, getattr(registration, field), value)
+                for field, value in computed.items() if getattr(registration, field) != value
+            )
+            self.stdout.write('Registration {}: {}'.format(registration.id, changes))
+
+        if drifted:
+            raise CommandError('{} registration ledger(s) drifted, run recompute_ledger to repair'.format(drifted))
+        self.stdout.write('No ledger drift found')
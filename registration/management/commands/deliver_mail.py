@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand
+
+import time
+
+from ...models import OutboxMessage
+
+class Command(BaseCommand):
+    help = 'Send queued email from the outbox'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Send what is due now and exit')
+        parser.add_argument('--batch-size', type=int, default=50, help='Messages claimed per transaction')
+        parser.add_argument('--rate', type=float, help='Most messages to send per second')
+        parser.add_argument('--sleep', type=float, default=5, help='Seconds to wait when the outbox is empty')
+        parser.add_argument('--keep-days', type=int, default=7, help='Days to keep sent messages')
+
+    def handle(self, *args, **options):
+        while True:
+            started = time.monotonic()
+            stats = OutboxMessage.objects.deliver(batch_size=options['batch_size'], rate=options['rate'])
+            if any(stats.values()):
+                self.stdout.write('Sent {sent}, retrying {retrying}, failed {failed} in {seconds:.1f}s, {queued} still queued'.format(
+                    seconds=time.monotonic() - started,
+                    queued=OutboxMessage.objects.filter(status=0).count(),
+                    **stats
+                ))
+            if options['once']:
+                break
+            if not any(stats.values()):
+                OutboxMessage.objects.purge(options['keep_days'])
+                time.sleep(options['sleep'])
@@ -17,7 +17,7 @@ class Command(BaseCommand):
             fieldnames = ['first_name', 'last_name', 'badge_name', 'badge_id', 'paid', 'checked_in']
             regwriter = csv.DictWriter(csvfile, fieldnames=fieldnames)
             regwriter.writeheader()
-            for row in Registration.objects.filter(registration_level__convention=convention):
+            for row in Registration.objects.filter(convention=convention):
 
                 first_name = row.first_name.encode('utf-8')
                 last_name = row.last_name.encode('utf-8')
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from convention import get_convention_model
+
+from ...models import DuplicateCluster
+
+class Command(BaseCommand):
+    help = 'Sweep a convention for likely duplicate registrations and list them for review'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--convention', type=int, help='Convention ID, defaults to the current convention')
+
+    def handle(self, *args, **options):
+        Convention = get_convention_model()
+        if options['convention']:
+            convention = Convention.objects.filter(id=options['convention']).first()
+        else:
+            convention = Convention.objects.current()
+        if not convention:
+            raise CommandError('No such convention, use --convention')
+
+        clusters = DuplicateCluster.objects.sweep(convention)
+        self.stdout.write('Found {} cluster(s) of likely duplicates to review'.format(len(clusters)))
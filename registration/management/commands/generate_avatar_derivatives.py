@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand
+
+from ...avatars import process_avatars
+from ...models import Registration
+
+class Command(BaseCommand):
+    help = 'Make the sized copies of registration avatars that are missing them'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help='Remake them for every avatar')
+        parser.add_argument('--batch-size', type=int, default=50, help='Avatars handed to the process pool at once')
+
+    def handle(self, *args, **options):
+        registrations = Registration.all_registrations.exclude(avatar='').exclude(avatar__isnull=True).order_by('id')
+        if not options['all']:
+            registrations = registrations.filter(avatar_derivatives='')
+
+        count = 0
+        last_id = 0
+        while True:
+            batch = list(registrations.filter(id__gt=last_id)[:options['batch_size']])
+            if not batch:
+                break
+            last_id = batch[-1].id
+            originals = []
+            for registration in batch:
+                with registration.avatar.open('rb') as original:
+                    originals.append(original.read())
+            for registration, rendered in zip(batch, process_avatars(originals)):
+                registration.update_avatar_derivatives(rendered)
+                count += 1
+            if options['verbosity'] > 1:
+                self.stdout.write('Processed {} avatar(s)'.format(count))
+        self.stdout.write('Made derivatives for {} avatar(s)'.format(count))
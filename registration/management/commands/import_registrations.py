@@ -1,11 +1,11 @@
 from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
 
 import csv
-import re
 from datetime import datetime
 
-from convention.models import Convention
-from .models import (
+from convention import get_convention_model
+from ...models import (
     Registration, Payment, CouponCode, CouponUse, PaymentMethod,
     RegistrationLevel, ShirtSize
 )
@@ -13,19 +13,22 @@ from .models import (
 class Command(BaseCommand):
     help = 'Import registrations from a CSV file'
 
+    def add_arguments(self, parser):
+        parser.add_argument('csv_file', help='CSV file to import')
+
     def handle(self, *args, **options):
         # XXX: The CSV parser may need to be edited depending on the source
-        if len(args) != 1:
-            raise CommandError('Need CSV file as single argument')
-
-        convention = Convention.objects.current()
+        convention = get_convention_model().objects.current()
+        if not convention:
+            raise CommandError('No current convention to import into')
         level = RegistrationLevel.objects.get(convention=convention, title='Sponsor')
         shirt_size = ShirtSize.objects.first()
 
         payment_method = PaymentMethod.objects.get(name='Complimentary')
         coupon = CouponCode.objects.get(code='Staff2016')
 
-        with open(args[0], 'rb') as staff:
+        registrations = []
+        with open(options['csv_file'], newline='') as staff:
             for row in csv.DictReader(staff):
                 if row['Imported'] == 'Yes':
                     continue
@@ -34,8 +37,8 @@ class Command(BaseCommand):
                 last_name = row['Name'].split(' ')[-1]
                 birthday = datetime.strptime(row['Birthday'], '%m/%d/%Y')
 
-                # Import main registration entry
-                reg = Registration(
+                # Main registration entry
+                registrations.append(Registration(
                     first_name=first_name,
                     last_name=last_name,
                     badge_name=row['Badge Name'],
@@ -50,19 +53,28 @@ class Command(BaseCommand):
                     shirt_size=shirt_size,
                     status=1,
                     ip='127.0.0.1',
-                )
-                reg.save()
+                ))
 
-                # Create coupon usage and 0-amount payment records
-                payment = Payment(
+        with transaction.atomic():
+            registrations = Registration.all_registrations.bulk_create(registrations)
+
+            # Coupon usage and 0-amount payment records
+            Payment.objects.bulk_create([
+                Payment(
                     registration=reg,
+                    convention_id=reg.convention_id,
                     payment_method=payment_method,
                     payment_level_comment='Imported registration',
                     payment_amount=0,
-                )
-                payment.save()
-                couponuse = CouponUse(
+                ) for reg in registrations
+            ])
+            CouponUse.objects.bulk_create([
+                CouponUse(
                     registration=reg,
                     coupon=coupon,
-                )
-                couponuse.save()
+                ) for reg in registrations
+            ])
+            # Bulk inserts skip the ledger signals
+            Registration.all_registrations.filter(id__in=[reg.id for reg in registrations]).recompute_ledger()
+
+        self.stdout.write('Imported {} registration(s)'.format(len(registrations)))
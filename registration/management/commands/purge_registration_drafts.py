@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from ...models import RegistrationDraft
+
+class Command(BaseCommand):
+    help = 'Delete registration drafts that have lapsed'
+
+    def handle(self, *args, **options):
+        purged, per_model = RegistrationDraft.objects.expired().delete()
+        if options['verbosity'] > 1:
+            self.stdout.write('Purged {} lapsed draft(s)'.format(purged))
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from convention import get_convention_model
+
+from ...models import Registration
+
+class Command(BaseCommand):
+    help = 'Rebuild the payment ledger on registrations from their payments and coupon uses'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--convention', type=int, help='Convention ID, defaults to the current convention')
+        parser.add_argument('--all', action='store_true', help='Rebuild for every convention')
+
+    def handle(self, *args, **options):
+        registrations = Registration.all_registrations.all()
+        if not options['all']:
+            convention_id = options['convention']
+            if not convention_id:
+                convention = get_convention_model().objects.current()
+                if not convention:
+                    raise CommandError('No current convention, use --convention or --all')
+                convention_id = convention.id
+            registrations = registrations.filter(convention_id=convention_id)
+
+        fixed = registrations.recompute_ledger()
+        self.stdout.write('Updated the ledger on {} registration(s)'.format(fixed))
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from ...models import PendingPayment
+
+class Command(BaseCommand):
+    help = 'Settle registrations stuck with a payment in progress'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--minutes', type=int, default=30,
+                            help='Leave payments touched more recently than this to the worker')
+
+    def handle(self, *args, **options):
+        stats = PendingPayment.objects.reconcile(minutes=options['minutes'])
+        self.stdout.write('Paid {paid}, released {released}, still waiting on {waiting}'.format(**stats))
@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from ...models import RegistrationLevelInventory, DealerRegistrationLevelInventory
+
+class Command(BaseCommand):
+    help = 'Rebuild the registration and dealer level inventory counters'
+
+    def handle(self, *args, **options):
+        RegistrationLevelInventory.objects.recount()
+        DealerRegistrationLevelInventory.objects.recount()
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from convention import get_convention_model
+
+from ...models import Registration
+
+class Command(BaseCommand):
+    help = 'Recompute the stored badge number on registrations'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--convention', type=int, help='Convention ID, defaults to the current convention')
+        parser.add_argument('--all', action='store_true', help='Recompute for every convention')
+
+    def handle(self, *args, **options):
+        registrations = Registration.all_registrations.all()
+        if not options['all']:
+            convention_id = options['convention']
+            if not convention_id:
+                convention = get_convention_model().objects.current()
+                if not convention:
+                    raise CommandError('No current convention, use --convention or --all')
+                convention_id = convention.id
+            registrations = registrations.filter(convention_id=convention_id)
+
+        registrations.refresh_badge_numbers()
+        self.stdout.write('Badge numbers recomputed')
@@ -1,63 +1,47 @@
-from django.core.management.base import BaseCommand, CommandError
+from django.core.management.base import BaseCommand
 
 from datetime import timedelta
-from django.core.mail import send_mail
 from django.utils import timezone
-import stripe
 
-from .models import Payment
+from ...models import OutboxMessage, Payment
 
 class Command(BaseCommand):
     help = 'Process payments that have had refunds requested'
 
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Look up the charges and report, without refunding or emailing')
+        parser.add_argument('--workers', type=int, default=4, help='Concurrent payment gateway calls')
+        parser.add_argument('--rate', type=float, help='Most payment gateway calls per second')
+
     def handle(self, *args, **options):
-        payment_refund_requested = 2
-        payment_refunded = 3
         delay_days = 3
         warning_days = 1
         cutoff = timezone.now() - timedelta(days=delay_days)
         warning = timezone.now() - timedelta(days=delay_days-warning_days)
 
-        refunds_processed = []
+        results = Payment.objects.process_refunds(cutoff, workers=options['workers'],
+                                                  rate=options['rate'], dry_run=options['dry_run'])
+        refunds_processed = results['refunded']
         refunds_errors = []
-
-        # Want to confirm production output before giving this teeth
-        REALLY_PROCESS = True
-
-        refunds = Payment.objects.filter(payment_state=payment_refund_requested,
-                                         refund_requested__lt=cutoff)
-        for payment in refunds:
-            if payment.payment_method.is_credit and payment.payment_extra:
-                try:
-                    stripe.api_key = payment.registration.registration_level.convention.stripe_secret_key
-                    charge = stripe.Charge.retrieve(payment.payment_extra)
-                    if REALLY_PROCESS:
-                        refund = charge.refunds.create()
-                        payment.refund_processed = timezone.now()
-                        payment.payment_state = payment_refunded
-                        payment.save()
-                        refunds_processed.append(payment)
-                except stripe.error.StripeError as e:
-                    print('Failed to refund %.02f payment by Stripe to payment ID %s (%s)' % (payment.payment_amount, payment.id, e.json_body['error']['message']), messages.ERROR)
-                    refunds_errors.append('Failed to refund %.02f payment by Stripe to payment ID %s (%s)' % (payment.payment_amount, payment.id, e.json_body['error']['message']), messages.ERROR)
+        for payment, message in results['errors']:
+            error = 'Failed to refund %.02f payment to payment ID %s (%s)' % (payment.payment_amount, payment.id, message)
+            self.stderr.write(error)
+            refunds_errors.append(error)
 
         # Gather future refunds to report to teasurer
-        refunds_soon = Payment.objects.filter(payment_state=payment_refund_requested,
-                                              refund_requested__lt=warning)
-
+        refunds_soon = Payment.objects.refunds_requested(warning) \
+            .exclude(pk__in=[payment.pk for payment in refunds_processed])
 
         if refunds_processed or refunds_errors or refunds_soon:
             body = 'This is a report detailing the delayed refund process.\n\n'
             if refunds_processed:
-                body += 'These refunds have been processed with the payment provider:\n'
+                if options['dry_run']:
+                    body += 'These refunds would be processed with the payment provider:\n'
+                else:
+                    body += 'These refunds have been processed with the payment provider:\n'
                 for payment in refunds_processed:
-                    body += "{last}, {first} ({badge}) - {level}, reason: {reason}\n".format(
-                        last = payment.registration.last_name,
-                        first = payment.registration.first_name,
-                        badge = payment.registration.badge_name,
-                        level = payment.registration.registration_level.title,
-                        reason = payment.refund_reason
-                    )
+                    body += self.describe(payment)
                 body += '\n'
 
             if refunds_errors:
@@ -71,19 +55,26 @@ class Command(BaseCommand):
                     warning_days=warning_days
                 )
                 for payment in refunds_soon:
-                    body += "{last}, {first} ({badge}) - {level}, reason: {reason}\n".format(
-                        last = payment.registration.last_name,
-                        first = payment.registration.first_name,
-                        badge = payment.registration.badge_name,
-                        level = payment.registration.registration_level.title,
-                        reason = payment.refund_reason
-                    )
+                    body += self.describe(payment)
                 body += '\n'
 
-            send_mail('Refund report for {date}'.format(
+            if options['dry_run']:
+                self.stdout.write(body)
+                return
+
+            OutboxMessage.objects.queue('Refund report for {date}'.format(
                     date=timezone.now().strftime('%x')
                 ),
                 body,
                 'registration@motorcityfurrycon.org',
                 ['registration@motorcityfurrycon.org', 'treasurer@motorcityfurrycon.org']
             )
+
+    def describe(self, payment):
+        return "{last}, {first} ({badge}) - {level}, reason: {reason}\n".format(
+            last = payment.registration.last_name,
+            first = payment.registration.first_name,
+            badge = payment.registration.badge_name,
+            level = payment.registration.registration_level.title,
+            reason = payment.refund_reason
+        )
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from ...models import InventoryHold
+
+class Command(BaseCommand):
+    help = 'Release registration level holds that have lapsed'
+
+    def handle(self, *args, **options):
+        released, per_model = InventoryHold.objects.expired().delete()
+        if options['verbosity'] > 1:
+            self.stdout.write('Released {} lapsed hold(s)'.format(released))
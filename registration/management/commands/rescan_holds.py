@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from convention import get_convention_model
+
+from ...models import RegistrationHold
+
+class Command(BaseCommand):
+    help = 'Apply registration holds to registrations made before the hold was added'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--hold', type=int, action='append', help='Hold ID, defaults to every hold')
+        parser.add_argument('--convention', type=int, help='Convention ID, defaults to the current convention')
+
+    def handle(self, *args, **options):
+        Convention = get_convention_model()
+        if options['convention']:
+            convention = Convention.objects.filter(id=options['convention']).first()
+        else:
+            convention = Convention.objects.current()
+        if not convention:
+            raise CommandError('No such convention, use --convention')
+
+        holds = RegistrationHold.objects.order_by('id')
+        if options['hold']:
+            holds = holds.filter(id__in=options['hold'])
+
+        for hold in holds:
+            flagged = hold.rescan(convention)
+            if flagged:
+                self.stdout.write('Hold {} flagged {} registration(s)'.format(hold.id, len(flagged)))
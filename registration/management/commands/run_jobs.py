@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+import time
+
+from ...models import Job
+
+class Command(BaseCommand):
+    help = 'Run queued background jobs, such as registration hold checks'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Run the jobs due now and exit')
+        parser.add_argument('--sleep', type=float, default=5, help='Seconds to wait when the queue is empty')
+        parser.add_argument('--keep-days', type=int, default=7, help='Days to keep finished jobs')
+
+    def handle(self, *args, **options):
+        while True:
+            count = Job.objects.run_pending()
+            if count:
+                self.stdout.write('Ran {} job(s)'.format(count))
+            if options['once']:
+                break
+            if not count:
+                Job.objects.purge(options['keep_days'])
+                time.sleep(options['sleep'])
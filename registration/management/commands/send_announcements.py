@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from ...models import Announcement
+
+class Command(BaseCommand):
+    help = 'Send queued announcements to registrations that opted in to email'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--announcement', type=int, action='append',
+                            help='Announcement ID to send, defaults to any queued or interrupted')
+        parser.add_argument('--batch-size', type=int, default=100, help='Messages between checkpoints')
+        parser.add_argument('--rate', type=float, default=10, help='Most messages to send per second')
+
+    def handle(self, *args, **options):
+        if options['announcement']:
+            announcements = Announcement.objects.filter(id__in=options['announcement']).exclude(status=3)
+            if not announcements:
+                raise CommandError('No such unsent announcement')
+        else:
+            # Interrupted sends carry on from their checkpoint
+            announcements = Announcement.objects.filter(status__in=[1, 2])
+
+        for announcement in announcements.order_by('id'):
+            self.stdout.write('Sending "{}"'.format(announcement.subject))
+            finished = announcement.send(batch_size=options['batch_size'], rate=options['rate'])
+            if finished is None:
+                self.stdout.write('Already being sent by another run, skipped')
+            elif finished:
+                self.stdout.write('Sent {0}, failed {1}'.format(announcement.sent_count, announcement.failed_count))
+            else:
+                self.stderr.write('Stopped after sending {0}, will resume from there: {1}'.format(
+                    announcement.sent_count, announcement.last_error))
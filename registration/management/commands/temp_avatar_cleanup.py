@@ -3,7 +3,7 @@ from django.core.management.base import BaseCommand, CommandError
 from datetime import timedelta
 from django.utils import timezone
 
-from .models import RegistrationTempAvatar
+from ...models import RegistrationTempAvatar
 
 class Command(BaseCommand):
     help = 'Remove uploaded avatars that never made it into a registration'
@@ -0,0 +1,71 @@
+from django.core.management.base import BaseCommand, CommandError
+
+import csv
+import json
+
+from convention import get_convention_model
+
+from ...models import Registration
+
+class Command(BaseCommand):
+    help = 'Audit paid registrations against their payments and coupons, listing any not fully covered'
+
+    FIELDS = ['convention', 'id', 'external_id', 'name', 'badge_name', 'registration_level',
+              'price', 'paid', 'discount', 'due']
+
+    def add_arguments(self, parser):
+        parser.add_argument('--convention', type=int, action='append', dest='conventions',
+                            help='Convention ID to audit, may be given more than once. Defaults to the current convention')
+        parser.add_argument('--all', action='store_true', help='Audit every convention')
+        parser.add_argument('--format', choices=['csv', 'jsonl'], default='csv')
+        parser.add_argument('--output', help='Write to this file instead of standard output')
+
+    def handle(self, *args, **options):
+        registrations = Registration.all_registrations.filter(status=1)
+        if not options['all']:
+            conventions = options['conventions']
+            if not conventions:
+                convention = get_convention_model().objects.current()
+                if not convention:
+                    raise CommandError('No current convention, use --convention or --all')
+                conventions = [convention.id]
+            registrations = registrations.filter(convention_id__in=conventions)
+
+        # Totals are worked out from the payments and coupon uses
+        # themselves, not the stored ledger
+        registrations = registrations.with_ledger_totals() \
+            .select_related('convention', 'registration_level') \
+            .order_by('convention', 'id')
+
+        output = open(options['output'], 'w', newline='') if options['output'] else self.stdout
+        try:
+            if options['format'] == 'csv':
+                writer = csv.DictWriter(output, fieldnames=self.FIELDS, lineterminator='\n')
+                writer.writeheader()
+                write = writer.writerow
+            else:
+                write = lambda row: output.write(json.dumps(row, default=str) + '\n')
+
+            mismatches = 0
+            for registration in registrations.iterator():
+                ledger = registration.computed_ledger()
+                if ledger['verified']:
+                    continue
+                mismatches += 1
+                write({
+                    'convention': registration.convention.name,
+                    'id': registration.id,
+                    'external_id': registration.external_id,
+                    'name': registration.name,
+                    'badge_name': registration.badge_name,
+                    'registration_level': registration.registration_level.title,
+                    'price': registration.registration_level_price,
+                    'paid': ledger['amount_paid'],
+                    'discount': ledger['discount_applied'],
+                    'due': ledger['amount_due'],
+                })
+        finally:
+            if options['output']:
+                output.close()
+
+        self.stderr.write('{} paid registration(s) not covered by payments'.format(mismatches))
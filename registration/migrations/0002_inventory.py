@@ -0,0 +1,52 @@
+# Generated by Django 3.2.25 on 2026-10-17 02:23
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def count_inventory(apps, schema_editor):
+    Registration = apps.get_model('registration', 'Registration')
+    for model_name, level_model_name, field in (
+            ('RegistrationLevelInventory', 'RegistrationLevel', 'registration_level'),
+            ('DealerRegistrationLevelInventory', 'DealerRegistrationLevel', 'dealer_registration_level')):
+        inventory = apps.get_model('registration', model_name)
+        counts = dict(
+            # Registration.INVENTORY_STATUSES: paid, or with the gateway
+            Registration.objects.filter(status__in=(1, 2), **{field + '__isnull': False})
+            .values_list(field).annotate(models.Count('id')).order_by()
+        )
+        inventory.objects.bulk_create([
+            inventory(level_id=level_id, sold=counts.get(level_id, 0))
+            for level_id in apps.get_model('registration', level_model_name).objects.values_list('id', flat=True)
+        ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('registration', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='registrationsettings',
+            options={'verbose_name': 'Registration Settings', 'verbose_name_plural': 'Registration Settings'},
+        ),
+        migrations.CreateModel(
+            name='RegistrationLevelInventory',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sold', models.IntegerField(default=0)),
+                ('level', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='inventory', to='registration.registrationlevel')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='DealerRegistrationLevelInventory',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sold', models.IntegerField(default=0)),
+                ('level', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='inventory', to='registration.dealerregistrationlevel')),
+            ],
+        ),
+        migrations.RunPython(count_inventory, migrations.RunPython.noop),
+    ]
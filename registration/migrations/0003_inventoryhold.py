@@ -0,0 +1,34 @@
+# Generated by Django 3.2.25 on 2026-10-17 02:25
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('registration', '0002_inventory'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dealerregistrationlevelinventory',
+            name='held',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='registrationlevelinventory',
+            name='held',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name='InventoryHold',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('expires', models.DateTimeField(db_index=True)),
+                ('dealer_registration_level', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='registration.dealerregistrationlevel')),
+                ('registration_level', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='registration.registrationlevel')),
+            ],
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 3.2.25 on 2026-10-17 02:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('registration', '0003_inventoryhold'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='registration',
+            name='amount_due',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=10),
+        ),
+        migrations.AddField(
+            model_name='registration',
+            name='amount_paid',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=10),
+        ),
+        migrations.AddField(
+            model_name='registration',
+            name='discount_applied',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=10),
+        ),
+        migrations.AddField(
+            model_name='registration',
+            name='verified',
+            field=models.BooleanField(default=False, verbose_name='Payments verified'),
+        ),
+    ]
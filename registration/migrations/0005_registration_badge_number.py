@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-17 02:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('registration', '0004_payment_ledger'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='registration',
+            name='assigned_badge_number',
+            field=models.IntegerField(blank=True, db_index=True, editable=False, null=True),
+        ),
+    ]
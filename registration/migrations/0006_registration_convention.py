@@ -0,0 +1,54 @@
+# Generated by Django 3.2.25 on 2026-10-17 02:40
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def copy_convention(apps, schema_editor):
+    Registration = apps.get_model('registration', 'Registration')
+    Payment = apps.get_model('registration', 'Payment')
+    RegistrationLevel = apps.get_model('registration', 'RegistrationLevel')
+    Registration.objects.update(convention=models.Subquery(
+        RegistrationLevel.objects.filter(pk=models.OuterRef('registration_level')).values('convention')[:1]
+    ))
+    Payment.objects.update(convention=models.Subquery(
+        Registration.objects.filter(pk=models.OuterRef('registration')).values('convention')[:1]
+    ))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('convention', '0001_initial'),
+        ('registration', '0005_registration_badge_number'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='payment',
+            name='convention',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.PROTECT, to='convention.convention'),
+        ),
+        migrations.AddField(
+            model_name='registration',
+            name='convention',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.PROTECT, to='convention.convention'),
+        ),
+        migrations.RunPython(copy_convention, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(fields=['convention', 'payment_state'], name='registratio_convent_82886d_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='registration',
+            index=models.Index(fields=['convention', 'status'], name='registratio_convent_2ae42e_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='registration',
+            index=models.Index(fields=['convention', 'checked_in'], name='registratio_convent_af5034_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='registration',
+            index=models.Index(fields=['convention', 'needs_print'], name='registratio_convent_fde9bb_idx'),
+        ),
+    ]
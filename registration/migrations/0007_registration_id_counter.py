@@ -0,0 +1,20 @@
+# Generated by Django 3.2.25 on 2026-10-17 02:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('registration', '0006_registration_convention'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RegistrationIdCounter',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_id', models.BigIntegerField(default=0)),
+            ],
+        ),
+    ]
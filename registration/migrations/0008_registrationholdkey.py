@@ -0,0 +1,46 @@
+# Generated by Django 3.2.25 on 2026-10-17 02:45
+
+from django.db import migrations, models
+import django.db.models.deletion
+import hashlib
+
+CI_FIELDS = ['first_name', 'last_name', 'badge_name', 'email',
+             'address', 'city', 'state', 'postal_code']
+EXACT_FIELDS = ['birthday', 'ip']
+
+
+def index_holds(apps, schema_editor):
+    # Same keys as RegistrationHold.match_key()
+    RegistrationHold = apps.get_model('registration', 'RegistrationHold')
+    RegistrationHoldKey = apps.get_model('registration', 'RegistrationHoldKey')
+    keys = []
+    for hold in RegistrationHold.objects.all():
+        for field in CI_FIELDS + EXACT_FIELDS:
+            value = getattr(hold, field)
+            if not value:
+                continue
+            value = str(value)
+            if field in CI_FIELDS:
+                value = value.lower()
+            key = hashlib.sha1('{}:{}'.format(field, value).encode('utf-8')).hexdigest()
+            keys.append(RegistrationHoldKey(hold=hold, field=field, key=key))
+    RegistrationHoldKey.objects.bulk_create(keys)
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('registration', '0007_registration_id_counter'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RegistrationHoldKey',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('field', models.CharField(max_length=32)),
+                ('key', models.CharField(db_index=True, max_length=40)),
+                ('hold', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='keys', to='registration.registrationhold')),
+            ],
+        ),
+        migrations.RunPython(index_holds, migrations.RunPython.noop),
+    ]
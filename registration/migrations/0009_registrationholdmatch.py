@@ -0,0 +1,48 @@
+# Generated by Django 3.2.25 on 2026-10-17 02:47
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.db.models.functions.text
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('registration', '0008_registrationholdkey'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RegistrationHoldMatch',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('matched', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='registration',
+            index=models.Index(django.db.models.functions.text.Lower('last_name'), name='registration_last_name_ci'),
+        ),
+        migrations.AddIndex(
+            model_name='registration',
+            index=models.Index(django.db.models.functions.text.Lower('badge_name'), name='registration_badge_name_ci'),
+        ),
+        migrations.AddIndex(
+            model_name='registration',
+            index=models.Index(django.db.models.functions.text.Lower('email'), name='registration_email_ci'),
+        ),
+        migrations.AddField(
+            model_name='registrationholdmatch',
+            name='hold',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='matches', to='registration.registrationhold'),
+        ),
+        migrations.AddField(
+            model_name='registrationholdmatch',
+            name='registration',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='hold_matches', to='registration.registration'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='registrationholdmatch',
+            unique_together={('hold', 'registration')},
+        ),
+    ]
@@ -0,0 +1,96 @@
+# Generated by Django 3.2.25 on 2026-10-17 02:51
+
+from django.db import migrations, models
+import django.db.models.deletion
+import unicodedata
+
+
+# Copied from registration.utils as they were when this migration was
+# written, so later changes there don't change what it writes
+def normalize_name(value):
+    value = unicodedata.normalize('NFKD', value or '')
+    return ''.join(c for c in value if c.isalnum() and not unicodedata.combining(c)).casefold()
+
+
+def email_local_part(value):
+    local = (value or '').rpartition('@')[0] if '@' in (value or '') else ''
+    return local.split('+')[0].lower()
+
+
+def duplicate_keys(first_name, last_name, birthday, email):
+    last_name = normalize_name(last_name)
+    first_name = normalize_name(first_name)
+    birthday = str(birthday)[:10] if birthday else ''
+    return (
+        '{}:{}'.format(last_name, first_name[:1]) if last_name else '',
+        '{}:{}'.format(last_name, birthday) if last_name and birthday else '',
+        email_local_part(email),
+    )
+
+
+def compute_duplicate_keys(apps, schema_editor):
+    Registration = apps.get_model('registration', 'Registration')
+    registrations = list(Registration.objects.only('id', 'first_name', 'last_name', 'birthday', 'email'))
+    for registration in registrations:
+        registration.name_key, registration.birthday_key, registration.email_key = duplicate_keys(
+            registration.first_name, registration.last_name, registration.birthday, registration.email
+        )
+    Registration.objects.bulk_update(registrations, ['name_key', 'birthday_key', 'email_key'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('convention', '0001_initial'),
+        ('registration', '0009_registrationholdmatch'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DuplicateCluster',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('found', models.DateTimeField(auto_now_add=True)),
+                ('reviewed', models.BooleanField(default=False)),
+                ('notes', models.TextField(blank=True, null=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='registration',
+            name='birthday_key',
+            field=models.CharField(blank=True, default='', editable=False, max_length=255),
+        ),
+        migrations.AddField(
+            model_name='registration',
+            name='email_key',
+            field=models.CharField(blank=True, default='', editable=False, max_length=255),
+        ),
+        migrations.AddField(
+            model_name='registration',
+            name='name_key',
+            field=models.CharField(blank=True, default='', editable=False, max_length=255),
+        ),
+        migrations.RunPython(compute_duplicate_keys, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='registration',
+            index=models.Index(fields=['convention', 'name_key'], name='registratio_convent_c3c217_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='registration',
+            index=models.Index(fields=['convention', 'birthday_key'], name='registratio_convent_1f90c5_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='registration',
+            index=models.Index(fields=['convention', 'email_key'], name='registratio_convent_27ea44_idx'),
+        ),
+        migrations.AddField(
+            model_name='duplicatecluster',
+            name='convention',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='convention.convention'),
+        ),
+        migrations.AddField(
+            model_name='duplicatecluster',
+            name='registrations',
+            field=models.ManyToManyField(related_name='duplicate_clusters', to='registration.Registration'),
+        ),
+    ]
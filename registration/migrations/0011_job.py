@@ -0,0 +1,33 @@
+# Generated by Django 3.2.25 on 2026-10-17 02:53
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('registration', '0010_duplicate_keys'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Job',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('check_holds', 'Check registration against holds'), ('rescan_hold', 'Apply hold to existing registrations')], max_length=50)),
+                ('object_id', models.IntegerField()),
+                ('payload', models.TextField(blank=True, default='{}')),
+                ('status', models.IntegerField(choices=[(0, 'Pending'), (1, 'Done'), (2, 'Failed')], default=0)),
+                ('attempts', models.IntegerField(default=0)),
+                ('run_after', models.DateTimeField(default=django.utils.timezone.now)),
+                ('last_error', models.TextField(blank=True, null=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('finished', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='job',
+            index=models.Index(fields=['status', 'run_after'], name='registratio_status_0ebf91_idx'),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 3.2.25 on 2026-10-17 02:57
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('convention', '0001_initial'),
+        ('registration', '0012_outboxmessage'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Announcement',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('subject', models.CharField(max_length=255)),
+                ('body', models.TextField()),
+                ('from_email', models.CharField(blank=True, help_text='Defaults to the convention contact email', max_length=255)),
+                ('status', models.IntegerField(choices=[(0, 'Draft'), (1, 'Queued'), (2, 'Sending'), (3, 'Sent')], default=0)),
+                ('last_registration_id', models.IntegerField(default=0, editable=False)),
+                ('sent_count', models.IntegerField(default=0, editable=False)),
+                ('failed_count', models.IntegerField(default=0, editable=False)),
+                ('last_error', models.TextField(blank=True, editable=False, null=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('started', models.DateTimeField(blank=True, editable=False, null=True)),
+                ('finished', models.DateTimeField(blank=True, editable=False, null=True)),
+                ('convention', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='convention.convention')),
+            ],
+        ),
+    ]
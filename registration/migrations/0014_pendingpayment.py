@@ -0,0 +1,38 @@
+# Generated by Django 3.2.25 on 2026-10-17 03:04
+
+from django.db import migrations, models
+import django.db.models.deletion
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('registration', '0013_announcement'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='job',
+            name='kind',
+            field=models.CharField(choices=[('check_holds', 'Check registration against holds'), ('rescan_hold', 'Apply hold to existing registrations'), ('submit_payment', 'Charge a pending payment'), ('finalize_payment', 'Finalize a pending payment')], max_length=50),
+        ),
+        migrations.CreateModel(
+            name='PendingPayment',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('description', models.CharField(max_length=255)),
+                ('token', models.CharField(blank=True, max_length=255)),
+                ('charge_id', models.CharField(blank=True, db_index=True, max_length=255, null=True)),
+                ('idempotency_key', models.UUIDField(default=uuid.uuid4, editable=False, unique=True)),
+                ('status', models.IntegerField(choices=[(0, 'Submitting'), (1, 'Awaiting Result'), (2, 'Succeeded'), (3, 'Failed')], default=0)),
+                ('error', models.TextField(blank=True, null=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('finalized', models.DateTimeField(blank=True, null=True)),
+                ('payment_method', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to='registration.paymentmethod')),
+                ('registration', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='pending_payments', to='registration.registration')),
+            ],
+        ),
+    ]
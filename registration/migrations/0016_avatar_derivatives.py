@@ -0,0 +1,23 @@
+# Generated by Django 3.2.25 on 2026-10-17 03:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('registration', '0015_registrationdraft'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='registration',
+            name='avatar_derivatives',
+            field=models.TextField(blank=True, default='', editable=False),
+        ),
+        migrations.AlterField(
+            model_name='job',
+            name='kind',
+            field=models.CharField(choices=[('check_holds', 'Check registration against holds'), ('rescan_hold', 'Apply hold to existing registrations'), ('submit_payment', 'Charge a pending payment'), ('finalize_payment', 'Finalize a pending payment'), ('avatar_derivatives', 'Make avatar derivatives')], max_length=50),
+        ),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 3.2.25 on 2026-10-17 03:17
+
+from django.db import migrations, models
+import registration.storage
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('registration', '0016_avatar_derivatives'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AvatarBlob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('digest', models.CharField(max_length=64, unique=True)),
+                ('name', models.CharField(max_length=255, unique=True)),
+                ('size', models.PositiveIntegerField(default=0)),
+                ('references', models.PositiveIntegerField(default=0)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='registration',
+            name='avatar',
+            field=models.ImageField(blank=True, null=True, storage=registration.storage.AvatarStorage(), upload_to='reg_avatars/'),
+        ),
+        migrations.AlterField(
+            model_name='registrationtempavatar',
+            name='avatar',
+            field=models.ImageField(blank=True, null=True, storage=registration.storage.AvatarStorage(), upload_to='tmp_avatars/'),
+        ),
+        migrations.AlterField(
+            model_name='staffregistration',
+            name='avatar',
+            field=models.ImageField(blank=True, null=True, storage=registration.storage.AvatarStorage(), upload_to='staff_avatars/'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-17 03:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('registration', '0017_avatar_blobs'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='announcement',
+            name='lease_expires',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+    ]
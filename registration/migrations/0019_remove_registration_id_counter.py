@@ -0,0 +1,16 @@
+# Generated by Django 3.2.25 on 2026-10-17 03:52
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('registration', '0018_announcement_lease'),
+    ]
+
+    operations = [
+        migrations.DeleteModel(
+            name='RegistrationIdCounter',
+        ),
+    ]
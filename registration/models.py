@@ -1,13 +1,33 @@
-from django.db import models
+from django.db import IntegrityError, connections, models, transaction
+from django.db.models import Q
+from django.db.models.functions import Coalesce, Concat, Lower
+from django.db.models.signals import post_init
 
 from django.core.exceptions import ObjectDoesNotExist, ValidationError
+from django.core.files.base import ContentFile
+from django.core.mail import EmailMessage, get_connection
+from django.template import Context, Template, loader
 from django.urls import reverse
 from django.utils import timezone
 from django.utils.safestring import mark_safe
 
 from convention import get_convention_model
 from django.contrib.auth import get_user_model
+from datetime import timedelta
+from decimal import Decimal
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import hashlib
 import json
+import os
+import smtplib
+import time
+import uuid
+from PIL import Image
+
+from .avatars import AVATAR_DERIVATIVES, derivative_name, process_avatars
+from .gateways import RateLimiter, get_gateway
+from .storage import avatar_storage, promote
+from .utils import PaymentError, SoldOut, cluster_duplicates, compact_form_data, duplicate_keys, simple_feistel, stringify_integer
 
 Convention = get_convention_model()
 
@@ -29,7 +49,192 @@ class RegistrationSettings(models.Model):
         verbose_name_plural = 'Registration Settings'
 
 
-class RegistrationActiveManager(models.Manager):
+def current_price(price_model, field, outer_ref='pk', when=None):
+    """
+    Subquery for the price from price_model in effect at a point in time
+    (now if not given), matched on field against outer_ref.
+    """
+    prices = price_model.objects.filter(
+        active_date__lt=when or timezone.now(),
+        **{field: models.OuterRef(outer_ref)}
+    ).order_by('-active_date').values('price')[:1]
+    return models.Subquery(prices, output_field=models.DecimalField(max_digits=10, decimal_places=2))
+
+
+def total(queryset, group, field):
+    """Subquery summing field over queryset's rows for each group, zero if none."""
+    output_field = models.DecimalField(max_digits=10, decimal_places=2)
+    totals = queryset.order_by().values(group).annotate(total=models.Sum(field)).values('total')
+    return Coalesce(models.Subquery(totals, output_field=output_field), models.Value(Decimal('0.00')),
+                    output_field=output_field)
+
+
+class RegistrationQuerySet(models.QuerySet):
+    def with_current_price(self, when=None):
+        """Annotate current_price, the level's price in effect at when (default now)."""
+        return self.annotate(current_price=current_price(
+            RegistrationLevelPrice, 'registration_level', 'registration_level', when
+        ))
+
+    def with_ledger_totals(self, when=None):
+        """
+        Annotate the raw totals the payment ledger is built from: the
+        level price, payments standing, and fixed and percent coupon
+        discounts. Registration.computed_ledger() turns them into ledger
+        values. The price is the one in effect when each registration
+        was made, unless when is given, so the stored ledger doesn't go
+        stale as prices change.
+        """
+        registration = models.OuterRef('pk')
+        if when is None:
+            when = Coalesce(models.OuterRef('registration_date'), models.Value(timezone.now()),
+                            output_field=models.DateTimeField())
+        return self.with_current_price(when).annotate(
+            payments_total=total(
+                # Refunded or up for refund, they no longer count, as in the old verify()
+                Payment.objects.filter(registration=registration, payment_state=1, refunded_by=None),
+                'registration', 'payment_amount',
+            ),
+            fixed_discount_total=total(
+                CouponUse.objects.filter(registration=registration, coupon__percent=False),
+                'registration', 'coupon__discount',
+            ),
+            percent_discount_total=total(
+                CouponUse.objects.filter(registration=registration, coupon__percent=True),
+                'registration', 'coupon__discount',
+            ),
+        )
+
+    def ledger_drift(self, chunk_size=2000):
+        """
+        Compare the stored ledger with one rebuilt from the raw payments
+        and coupon uses, yielding (registration, computed) where they differ.
+        """
+        registrations = self.with_ledger_totals().only('id', 'registration_level', *self.model.LEDGER_FIELDS)
+        for registration in registrations.iterator(chunk_size=chunk_size):
+            computed = registration.computed_ledger()
+            if any(getattr(registration, field) != value for field, value in computed.items()):
+                yield registration, computed
+
+    def recompute_ledger(self, batch_size=500):
+        """Rebuild the stored ledger wherever it has drifted, returns the number fixed."""
+        fixed = 0
+        batch = []
+        for registration, computed in self.ledger_drift():
+            for field, value in computed.items():
+                setattr(registration, field, value)
+            batch.append(registration)
+            if len(batch) >= batch_size:
+                self.model.all_registrations.bulk_update(batch, self.model.LEDGER_FIELDS)
+                fixed += len(batch)
+                batch = []
+        if batch:
+            self.model.all_registrations.bulk_update(batch, self.model.LEDGER_FIELDS)
+            fixed += len(batch)
+        return fixed
+
+    def can_reserve_ids(self):
+        """Whether the database has a sequence to take IDs from ahead of inserting."""
+        return connections[self.db].vendor == 'postgresql'
+
+    def reserve_ids(self, count):
+        """
+        Take count registration IDs ahead of inserting, so derived fields
+        can go in with the insert. Only where can_reserve_ids(); other
+        databases hand out IDs as rows are inserted.
+        """
+        if not count:
+            return []
+        with connections[self.db].cursor() as cursor:
+            cursor.execute(
+                "SELECT nextval(pg_get_serial_sequence(%s, 'id')) FROM generate_series(1, %s)",
+                [self.model._meta.db_table, count]
+            )
+            return [row[0] for row in cursor.fetchall()]
+
+    def bulk_create(self, objs, *args, **kwargs):
+        """
+        Insert registrations with everything prepare_insert() fills in,
+        then catch up the inventory counters and queue hold checks the
+        way saving them one at a time would. Without a sequence to take
+        their IDs from, they're saved one at a time instead.
+        """
+        objs = list(objs)
+        if not self.can_reserve_ids():
+            with transaction.atomic(using=self.db):
+                for obj in objs:
+                    obj.save(using=self.db)
+            return objs
+        ids = iter(self.reserve_ids(len([obj for obj in objs if obj.pk is None])))
+        badge_settings = {}
+        for obj in objs:
+            if obj.pk is None:
+                obj.id = next(ids)
+            obj.prepare_insert(badge_settings=badge_settings)
+        objs = super(RegistrationQuerySet, self).bulk_create(objs, *args, **kwargs)
+
+        for inventory, field in ((RegistrationLevelInventory, 'registration_level_id'),
+                                 (DealerRegistrationLevelInventory, 'dealer_registration_level_id')):
+            sold = {}
+            for obj in objs:
+                if obj.status in Registration.INVENTORY_STATUSES and getattr(obj, field):
+                    sold[getattr(obj, field)] = sold.get(getattr(obj, field), 0) + 1
+            for level_id, count in sold.items():
+                inventory.objects.adjust(level_id, count)
+        for obj in objs:
+            # Start change tracking afresh now the rows exist
+            obj._state.adding = False
+            post_init.send(sender=self.model, instance=obj)
+        Job.objects.bulk_create([Job(kind='check_holds', object_id=obj.id) for obj in objs])
+        return objs
+
+    def matching_hold(self, hold):
+        """Registrations matching every filled-in field of a hold, as screen_holds() does."""
+        conditions = {}
+        queryset = self
+        for field in RegistrationHold.CI_FIELDS:
+            value = getattr(hold, field)
+            if value:
+                # Compared as Lower() so the functional indexes apply
+                queryset = queryset.alias(**{field + '_lower': Lower(field)})
+                conditions[field + '_lower'] = value.lower()
+        for field in RegistrationHold.EXACT_FIELDS:
+            value = getattr(hold, field)
+            if value:
+                conditions[field] = value
+        if not conditions:
+            return self.none()
+        return queryset.filter(**conditions)
+
+    def duplicate_clusters(self):
+        """Groups of registration ids that look like the same person, see cluster_duplicates()."""
+        return cluster_duplicates(self.values_list('id', 'first_name', 'last_name', 'birthday', 'email').iterator())
+
+    def refresh_badge_numbers(self):
+        """Recompute the stored badge number for every registration in the queryset."""
+        conventions = self.values('convention')
+        for settings in RegistrationSettings.objects.filter(convention__in=conventions):
+            registrations = self.model.all_registrations.filter(
+                pk__in=self.values('pk'), convention=settings.convention_id,
+            )
+            if settings.badge_number_style == 1:
+                # Latest badge assignment
+                number = models.Subquery(
+                    BadgeAssignment.objects.filter(registration=models.OuterRef('pk')).order_by('-id').values('id')[:1]
+                )
+            elif settings.badge_number_style == 2:
+                # Registration ID, once printed
+                number = models.Case(
+                    models.When(needs_print=1, then=models.Value(None)),
+                    default=models.F('id') - settings.badge_offset,
+                    output_field=models.IntegerField(),
+                )
+            else:
+                number = models.Value(None, output_field=models.IntegerField())
+            registrations.update(assigned_badge_number=number)
+
+
+class RegistrationActiveManager(models.Manager.from_queryset(RegistrationQuerySet)):
     """By default, only return current convention's active registrations."""
 
     # TODO: Double check how this should handle yet unpaid cash reg and such.
@@ -38,16 +243,19 @@ class RegistrationActiveManager(models.Manager):
         registrations = super(RegistrationActiveManager, self).get_queryset() \
             .filter(status=1)
         # Try to determine current convention, may return None if unable to
-        convention = Convention.objects.current()
+        from .catalog import get_current_convention
+        convention = get_current_convention()
         if convention:
             registrations = registrations.filter(
-                registration_level__convention=convention,
+                convention=convention,
             )
         return registrations
 
 
 class Registration(models.Model):
     external_id = models.CharField(max_length=20, blank=True, null=True, unique=True, verbose_name='Confirmation code')
+    # Copied from registration_level, so filtering by convention skips the join
+    convention = models.ForeignKey(Convention, null=True, blank=True, editable=False, on_delete=models.PROTECT)
     user = models.ForeignKey(get_user_model(), null=True, blank=True, on_delete=models.SET_NULL)
     registration_date = models.DateTimeField(null=True, blank=True, auto_now_add=True)
     first_name = models.CharField(max_length=255)
@@ -84,6 +292,8 @@ class Registration(models.Model):
         (3, 'Refunded'),
         (4, 'Reg Rejected'),
     )
+    # Paid, and payments still with the gateway, take up level capacity
+    INVENTORY_STATUSES = (1, 2)
     status = models.IntegerField(default=0, choices=STATUS_OPTIONS)
     swag = models.ManyToManyField('Swag', through='RegistrationSwag')
     NEEDS_PRINT_REASONS = (
@@ -94,12 +304,39 @@ class Registration(models.Model):
     needs_print = models.IntegerField(default=1, choices=NEEDS_PRINT_REASONS, verbose_name='Badge needs printed?')
     reported_on = models.DateTimeField(null=True, blank=True, verbose_name='Included in paper report on')
     ip = models.GenericIPAddressField()
-    avatar = models.ImageField(upload_to='reg_avatars/', null=True, blank=True)
+    avatar = models.ImageField(upload_to='reg_avatars/', storage=avatar_storage, null=True, blank=True)
+    # Storage names of the avatar's sized copies, kept up to date by update_avatar_derivatives()
+    avatar_derivatives = models.TextField(blank=True, default='', editable=False)
     emergency_contact = models.CharField(max_length=255, blank=True, null=True,
                                          help_text='Optionally, provide an contact person in case of emergency')
+    # Payment ledger, kept up to date by update_ledger()
+    amount_paid = models.DecimalField(max_digits=10, decimal_places=2, default=0)
+    discount_applied = models.DecimalField(max_digits=10, decimal_places=2, default=0)
+    amount_due = models.DecimalField(max_digits=10, decimal_places=2, default=0)
+    verified = models.BooleanField(default=False, verbose_name='Payments verified')
+    # Effective badge number, kept up to date by update_badge_number()
+    assigned_badge_number = models.IntegerField(null=True, blank=True, db_index=True, editable=False)
+    # Blocking keys for duplicate detection, from duplicate_keys()
+    name_key = models.CharField(max_length=255, blank=True, default='', editable=False)
+    birthday_key = models.CharField(max_length=255, blank=True, default='', editable=False)
+    email_key = models.CharField(max_length=255, blank=True, default='', editable=False)
 
     objects = RegistrationActiveManager()
-    all_registrations = models.Manager()
+    all_registrations = RegistrationQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['convention', 'status']),
+            models.Index(fields=['convention', 'checked_in']),
+            models.Index(fields=['convention', 'needs_print']),
+            # For matching holds against existing registrations
+            models.Index(Lower('last_name'), name='registration_last_name_ci'),
+            models.Index(Lower('badge_name'), name='registration_badge_name_ci'),
+            models.Index(Lower('email'), name='registration_email_ci'),
+            models.Index(fields=['convention', 'name_key']),
+            models.Index(fields=['convention', 'birthday_key']),
+            models.Index(fields=['convention', 'email_key']),
+        ]
 
     def _get_full_name(self, last_first=False):
         if last_first:
@@ -110,6 +347,14 @@ class Registration(models.Model):
 
     name = property(_get_full_name)
 
+    def _get_registration_level_price(self):
+        # Prefer the price annotated by with_current_price()
+        if 'current_price' in self.__dict__:
+            return self.__dict__['current_price']
+        return self.registration_level.price
+
+    registration_level_price = property(_get_registration_level_price)
+
     def paid(self):
         return self.status == 1
 
@@ -117,53 +362,288 @@ class Registration(models.Model):
     paid.short_description = 'Paid?'
 
     def verify(self):
-        coupon = None
-        try:
-            coupon_use = CouponUse.objects.get(registration=self)
-            coupon = coupon_use.coupon
-            if (coupon and ((coupon.percent and coupon.discount == 100) or
-                            (coupon.percent == False and coupon.discount == self.registration_level.price))):
-                return True
-        except ObjectDoesNotExist:
-            pass
-
-        try:
-            payments = Payment.objects.filter(registration=self, refunded_by=None)
-            payment_amount = 0
-            for payment in payments:
-                payment_amount += payment.payment_amount
-            if (payment_amount >= self.registration_level.price):
-                return True
-            if (coupon and ((coupon.percent and ((
-                                                         self.registration_level.price * coupon.discount) + payment_amount) >= self.registration_level.price) or
-                            (coupon.percent == False and (
-                                    (payment_amount + coupon.discount) >= self.registration_level.price)))):
-                return True
-        except ObjectDoesNotExist:
-            pass
-
-        return False
+        return self.verified
 
     verify.boolean = True
     verify.short_description = 'Verify Payments'
 
+    LEDGER_FIELDS = ['amount_paid', 'discount_applied', 'amount_due', 'verified']
+
+    def computed_ledger(self):
+        """Ledger values from the totals annotated by with_ledger_totals()."""
+        price = self.registration_level_price or Decimal('0.00')
+        discount = self.fixed_discount_total + \
+            (price * self.percent_discount_total / 100).quantize(Decimal('0.01'))
+        discount = min(discount, price)
+        amount_due = max(price - discount - self.payments_total, Decimal('0.00'))
+        return {
+            'amount_paid': self.payments_total,
+            'discount_applied': discount,
+            'amount_due': amount_due,
+            'verified': amount_due == 0,
+        }
+
+    def update_ledger(self):
+        """Rebuild the payment ledger from this registration's payments and coupons."""
+        with transaction.atomic():
+            # Lock the row so concurrent payments are totalled one at a time
+            totals = Registration.all_registrations.select_for_update().with_ledger_totals() \
+                .only('id', 'registration_level').filter(pk=self.pk).first()
+            if totals is None:
+                return
+            ledger = totals.computed_ledger()
+            Registration.all_registrations.filter(pk=self.pk).update(**ledger)
+        for field, value in ledger.items():
+            setattr(self, field, value)
+
     def badge_number(self):
-        if self.registration_level.convention.registrationsettings.badge_number_style == 1:
-            badges = self.badgeassignment_set.order_by('-id')
-            if (badges.count() >= 1):
-                return '{0:05d}'.format(badges[0].id)
+        if self.assigned_badge_number is None:
             return None
-        elif self.registration_level.convention.registrationsettings.badge_number_style == 2:
-            if self.needs_print == 1:
-                return None
-            return '{0:05d}'.format(self.id - self.registration_level.convention.registrationsettings.badge_offset)
+        return '{0:05d}'.format(self.assigned_badge_number)
+
+    badge_number.admin_order_field = 'assigned_badge_number'
+
+    def update_badge_number(self):
+        """Recompute the stored badge number from the convention's numbering style."""
+        registrations = Registration.all_registrations.filter(pk=self.pk)
+        registrations.refresh_badge_numbers()
+        self.assigned_badge_number = registrations.values_list('assigned_badge_number', flat=True).first()
+
+    def initial_badge_number(self, settings=None):
+        # Only style 2 numbers a badge before it has been assigned one
+        if settings is None:
+            settings = RegistrationSettings.objects.filter(convention=self.convention_id).first()
+        if settings and settings.badge_number_style == 2 and self.needs_print != 1:
+            return self.id - settings.badge_offset
+        return None
+
+    def prepare_insert(self, badge_settings=None):
+        """
+        Fill in what is derived from a new registration before it is
+        inserted, so it goes in with a single write: its IDs, convention,
+        ledger, badge number and duplicate keys. Holds are checked by a
+        job afterwards, see check_holds(). Where the ID can't be reserved
+        ahead, what derives from it is left for save() to fill in.
+        """
+        if self.pk is None and Registration.all_registrations.can_reserve_ids():
+            self.reserve_id()
+        if not self.external_id and self.pk is not None:
+            self.external_id = stringify_integer(simple_feistel(self.id))
+        if self.convention_id is None:
+            self.convention_id = self.registration_level.convention_id
+
+        # Nothing paid yet
+        price = self.registration_level.price or Decimal('0.00')
+        self.amount_paid = self.discount_applied = Decimal('0.00')
+        self.amount_due = price
+        self.verified = price == 0
+
+        if self.pk is not None:
+            if badge_settings is None:
+                self.assigned_badge_number = self.initial_badge_number()
+            else:
+                if self.convention_id not in badge_settings:
+                    badge_settings[self.convention_id] = \
+                        RegistrationSettings.objects.filter(convention=self.convention_id).first()
+                self.assigned_badge_number = self.initial_badge_number(badge_settings[self.convention_id])
+
+        self.update_duplicate_keys()
+
+    def screen_holds(self):
+        """
+        Check a registration against the holds list and for likely
+        duplicates, adding any notes to it. Holds already applied to it
+        are skipped. Returns the matches and who to notify about them.
+        """
+        matched = []
+        notes_addition = ''
+        private_notes_addition = ''
+        private_check_in = False
+        notify_registration_group = False
+        notify_board_group = False
+
+        for hold in RegistrationHold.objects.matching(self).exclude(matches__registration=self):
+            if hold.notes_addition:
+                notes_addition += 'Registration notes:\n{}\n\n'.format(hold.notes_addition)
+            if hold.private_notes_addition:
+                private_notes_addition += 'Registration flagged:\n{}\n\n'.format(hold.private_notes_addition)
+            if hold.private_check_in:
+                private_check_in = True
+            matched.append(hold)
+            if hold.notify_registration_group:
+                notify_registration_group = True
+            if hold.notify_board_group:
+                notify_board_group = True
+
+        # Look for duplicates matching last name, and either first name or
+        # birthday. Anything that does shares a blocking key, so narrow
+        # it down by those first.
+        candidates = Registration.objects.exclude(pk=self.pk)
+        if self.name_key and self.birthday_key:
+            candidates = candidates.filter(Q(name_key=self.name_key) | Q(birthday_key=self.birthday_key))
+        elif self.name_key:
+            candidates = candidates.filter(name_key=self.name_key)
+        for other_reg in candidates.filter(
+            Q(last_name=self.last_name),
+            Q(first_name=self.first_name) | Q(birthday=self.birthday)
+        ):
+            duplicate_note = 'Possible duplicate registration received, matching:\n{id} {external_id}\n{last_name} and {first_name} or {birthday}\n\n'.format(
+                id=other_reg.id,
+                external_id=other_reg.external_id,
+                badge_name=other_reg.badge_name,
+                last_name=other_reg.last_name,
+                first_name=other_reg.first_name,
+                birthday=other_reg.birthday,
+            )
+            notes_addition += duplicate_note
+            matched.append(FakeHold(duplicate_note))
+            notify_registration_group = True
+
+        notification_list = []
+        if matched:
+            notes = self.notes or ''
+            self.notes = notes + notes_addition
+            private_notes = self.private_notes or ''
+            self.private_notes = private_notes + private_notes_addition
+            if not self.private_check_in and private_check_in:
+                self.private_check_in = True
+
+            if notify_registration_group:
+                notification_list.append('registration@yourconvention.org')
+            if notify_board_group:
+                notification_list.append('board@yourconvention.org')
+
+        return matched, notification_list
+
+    def check_holds(self):
+        """
+        Screen a saved registration against the holds and for duplicates,
+        store any notes and send the notification. Run as a job once the
+        registration is committed, so none of this holds up registering.
+        """
+        matched, notification_list = self.screen_holds()
+        if matched:
+            Registration.all_registrations.filter(pk=self.pk).update(
+                notes=self.notes,
+                private_notes=self.private_notes,
+                private_check_in=self.private_check_in,
+            )
+            # So a rescan won't apply them again
+            RegistrationHoldMatch.objects.bulk_create([
+                RegistrationHoldMatch(hold=hold, registration=self)
+                for hold in matched if isinstance(hold, RegistrationHold)
+            ], ignore_conflicts=True)
+
+        if notification_list:
+            c = {
+                'registration': self,
+                'holds': matched,
+            }
+            email_subject = loader.render_to_string(
+                'registration/held_registration_subject.txt', c
+            )
+            # Email subject *must not* contain newlines
+            email_subject = ''.join(email_subject.splitlines())
+            email_body = loader.render_to_string(
+                'registration/held_registration_body.txt', c
+            )
+            OutboxMessage.objects.queue(email_subject, email_body,
+                                        'registration@yourconvention.org',
+                                        notification_list)
+
+    def reserve_id(self):
+        """Take an ID for this registration ahead of saving it, see RegistrationQuerySet.reserve_ids()."""
+        self.id = Registration.all_registrations.reserve_ids(1)[0]
+        self._id_reserved = True
+        return self.id
+
+    def update_duplicate_keys(self):
+        self.name_key, self.birthday_key, self.email_key = duplicate_keys(
+            self.first_name, self.last_name, self.birthday, self.email
+        )
+
+    def save(self, *args, **kwargs):
+        numbered_by_insert = False
+        if self._state.adding and not kwargs.get('force_update'):
+            self.prepare_insert()
+            numbered_by_insert = self.pk is None
+            if getattr(self, '_id_reserved', False):
+                # Nobody else can have this ID, so skip checking for an existing row
+                kwargs['force_insert'] = True
+        else:
+            self.update_duplicate_keys()
+            if kwargs.get('update_fields') is not None:
+                kwargs['update_fields'] = set(kwargs['update_fields']) | {'name_key', 'birthday_key', 'email_key'}
+        super(Registration, self).save(*args, **kwargs)
+        self._id_reserved = False
+        if numbered_by_insert:
+            # The database only just handed out the ID these derive from
+            if not self.external_id:
+                self.external_id = stringify_integer(simple_feistel(self.id))
+            self.assigned_badge_number = self.initial_badge_number()
+            Registration.all_registrations.filter(pk=self.pk).update(
+                external_id=self.external_id, assigned_badge_number=self.assigned_badge_number)
+
+    def take_avatar(self, field_file):
+        """
+        Move the image behind another model's avatar field, such as a
+        RegistrationTempAvatar's, over to this registration without
+        copying it where the storage allows. field_file is left empty;
+        the avatar is kept when the registration is saved.
+        """
+        name = '{0}_{1}'.format(self.id, os.path.basename(field_file.name))
+        self.avatar = promote(field_file, self._meta.get_field('avatar').generate_filename(self, name))
+        # Holds its own reference now, whatever the name
+        self._avatar_new = True
+
+    def avatar_derivative_names(self):
+        return json.loads(self.avatar_derivatives or '{}')
+
+    def _get_avatar_urls(self):
+        # Derivatives not made yet are sized on the fly instead
+        names = self.avatar_derivative_names()
+        urls = {}
+        for name, (size, exact) in AVATAR_DERIVATIVES.items():
+            if name in names:
+                urls[name] = self.avatar.storage.url(names[name])
+            else:
+                urls[name] = reverse('avatar_thumbnail', args=['r', self.id, size[0], size[1]])
+        return urls
+
+    avatar_urls = property(_get_avatar_urls)
+
+    def avatar_image(self, name):
+        """PIL image of the named avatar derivative, or of the original if it hasn't been made yet."""
+        names = self.avatar_derivative_names()
+        if name in names:
+            return Image.open(self.avatar.storage.open(names[name]))
+        return Image.open(self.avatar)
+
+    def update_avatar_derivatives(self, rendered=None):
+        """
+        Store the sized copies of the avatar listed in AVATAR_DERIVATIVES,
+        and clear out those of any earlier avatar. rendered is the output
+        of avatars.render_derivatives() if it's been made already,
+        otherwise the work is handed to the avatar process pool.
+        """
+        storage = self.avatar.storage
+        previous = self.avatar_derivative_names()
+        names = {}
+        if self.avatar:
+            if rendered is None:
+                with self.avatar.open('rb') as original:
+                    rendered = next(process_avatars([original.read()]))
+            for name, (data, size) in rendered.items():
+                names[name] = storage.save(derivative_name(self.id, self.avatar.name, name), ContentFile(data))
+        self.avatar_derivatives = json.dumps(names) if names else ''
+        Registration.all_registrations.filter(pk=self.pk).update(avatar_derivatives=self.avatar_derivatives)
+        # Each save took a reference, so give back every earlier one
+        for storage_name in previous.values():
+            storage.delete(storage_name)
 
     def avatar_preview(self):
-        # return u'<img src="{0}">'.format(self.avatar.url)
         if self.avatar:
-            return mark_safe('<img src="{0}">'.format(reverse('avatar_thumbnail', args=[
-                'r', self.id, 200, 200
-            ])))
+            return mark_safe('<img src="{0}">'.format(self.avatar_urls['preview']))
         else:
             return '-'
 
@@ -186,7 +666,35 @@ class RegistrationSwag(models.Model):
                                   'Backordered' if self.backordered else 'Received' if self.received else 'Not received')
 
 
+class RegistrationHoldQuerySet(models.QuerySet):
+    def matching(self, registration):
+        """
+        Holds that match a registration: at least one of the hold's
+        fields is filled in, and every one that is matches. Candidates
+        come from the RegistrationHoldKey index rather than a scan.
+        """
+        keys = list(filter(None, [
+            RegistrationHold.match_key(field, getattr(registration, field, None))
+            for field in RegistrationHold.MATCH_FIELDS
+        ]))
+        if not keys:
+            return self.none()
+        return self.filter(
+            id__in=RegistrationHoldKey.objects.filter(key__in=keys).values('hold')
+        ).annotate(
+            matched_keys=models.Count('keys', filter=Q(keys__key__in=keys)),
+            total_keys=models.Count('keys'),
+        ).filter(matched_keys=models.F('total_keys')).order_by('id')
+
+
 class RegistrationHold(models.Model):
+    # Compared case-insensitively
+    CI_FIELDS = ['first_name', 'last_name', 'badge_name', 'email',
+                 'address', 'city', 'state', 'postal_code']
+    # Compared exactly
+    EXACT_FIELDS = ['birthday', 'ip']
+    MATCH_FIELDS = CI_FIELDS + EXACT_FIELDS
+
     first_name = models.CharField(blank=True, null=True, max_length=255)
     last_name = models.CharField(blank=True, null=True, max_length=255)
     badge_name = models.CharField(blank=True, null=True, max_length=32)
@@ -203,12 +711,165 @@ class RegistrationHold(models.Model):
     notify_registration_group = models.BooleanField(default=True)
     notify_board_group = models.BooleanField(default=False)
 
+    objects = RegistrationHoldQuerySet.as_manager()
+
     def __str__(self):
         fields = ['first_name', 'last_name', 'badge_name', 'email',
                   'address', 'city', 'state', 'postal_code', 'birthday']
         values = [str(getattr(self, field)) for field in fields if getattr(self, field, False)]
         return ' / '.join(values)
 
+    @classmethod
+    def match_key(cls, field, value):
+        """Normalized, hashed form of a field value, or None if there's nothing to match on."""
+        if not value:
+            return None
+        value = str(value)
+        if field in cls.CI_FIELDS:
+            value = value.lower()
+        return hashlib.sha1('{}:{}'.format(field, value).encode('utf-8')).hexdigest()
+
+    def rescan(self, convention):
+        """
+        Apply this hold to a convention's existing registrations that it
+        matches and hasn't been applied to yet, then send one notification
+        covering all of them. Returns the registrations flagged.
+        """
+        registrations = Registration.all_registrations.filter(convention=convention) \
+            .matching_hold(self).exclude(hold_matches__hold=self)
+
+        updates = {}
+        if self.notes_addition:
+            updates['notes'] = Concat(
+                Coalesce('notes', models.Value('')),
+                models.Value('Registration notes:\n{}\n\n'.format(self.notes_addition)),
+                output_field=models.TextField(),
+            )
+        if self.private_notes_addition:
+            updates['private_notes'] = Concat(
+                Coalesce('private_notes', models.Value('')),
+                models.Value('Registration flagged:\n{}\n\n'.format(self.private_notes_addition)),
+                output_field=models.TextField(),
+            )
+        if self.private_check_in:
+            updates['private_check_in'] = True
+
+        with transaction.atomic():
+            ids = list(registrations.select_for_update().order_by('id').values_list('id', flat=True))
+            if not ids:
+                return []
+            RegistrationHoldMatch.objects.bulk_create([
+                RegistrationHoldMatch(hold=self, registration_id=registration_id)
+                for registration_id in ids
+            ], ignore_conflicts=True)
+            if updates:
+                Registration.all_registrations.filter(id__in=ids).update(**updates)
+        flagged = list(Registration.all_registrations.filter(id__in=ids).order_by('id'))
+
+        notification_list = []
+        if self.notify_registration_group:
+            notification_list.append('registration@yourconvention.org')
+        if self.notify_board_group:
+            notification_list.append('board@yourconvention.org')
+        if notification_list:
+            c = {
+                'registrations': flagged,
+                'hold': self,
+            }
+            email_subject = loader.render_to_string(
+                'registration/held_registrations_subject.txt', c
+            )
+            # Email subject *must not* contain newlines
+            email_subject = ''.join(email_subject.splitlines())
+            email_body = loader.render_to_string(
+                'registration/held_registrations_body.txt', c
+            )
+            OutboxMessage.objects.queue(email_subject, email_body,
+                                        'registration@yourconvention.org',
+                                        notification_list)
+        return flagged
+
+    def update_keys(self):
+        """Rebuild this hold's entries in the RegistrationHoldKey index."""
+        self.keys.all().delete()
+        RegistrationHoldKey.objects.bulk_create([
+            RegistrationHoldKey(hold=self, field=field, key=key)
+            for field, key in ((field, self.match_key(field, getattr(self, field)))
+                               for field in self.MATCH_FIELDS)
+            if key
+        ])
+
+
+class RegistrationHoldKey(models.Model):
+    """Index of RegistrationHold field values, one row per filled-in field."""
+    hold = models.ForeignKey(RegistrationHold, on_delete=models.CASCADE, related_name='keys')
+    field = models.CharField(max_length=32)
+    key = models.CharField(max_length=40, db_index=True)
+
+
+class RegistrationHoldMatch(models.Model):
+    """Record of a hold applied to a registration, so it's only applied once."""
+    hold = models.ForeignKey(RegistrationHold, on_delete=models.CASCADE, related_name='matches')
+    registration = models.ForeignKey('Registration', on_delete=models.CASCADE, related_name='hold_matches')
+    matched = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ('hold', 'registration')
+
+
+class DuplicateClusterManager(models.Manager):
+    def sweep(self, convention):
+        """
+        Replace a convention's unreviewed clusters with those from a fresh
+        sweep of its registrations, leaving alone any cluster staff have
+        already reviewed. Returns the new clusters.
+        """
+        found = Registration.all_registrations.filter(convention=convention) \
+            .exclude(status__in=[3, 4]).duplicate_clusters()
+        members = self.model.registrations.through
+        reviewed = {}
+        for cluster_id, registration_id in members.objects.filter(
+                duplicatecluster__convention=convention, duplicatecluster__reviewed=True
+        ).values_list('duplicatecluster_id', 'registration_id'):
+            reviewed.setdefault(cluster_id, set()).add(registration_id)
+        reviewed = set(frozenset(ids) for ids in reviewed.values())
+        found = [ids for ids in found if frozenset(ids) not in reviewed]
+
+        with transaction.atomic():
+            self.filter(convention=convention, reviewed=False).delete()
+            # Created one by one for their ids, the members in bulk
+            clusters = [self.create(convention=convention) for ids in found]
+            members.objects.bulk_create([
+                members(duplicatecluster_id=cluster.id, registration_id=registration_id)
+                for cluster, ids in zip(clusters, found) for registration_id in ids
+            ])
+        return clusters
+
+
+class DuplicateCluster(models.Model):
+    """Registrations the duplicate sweep thinks are the same person, for staff to review."""
+    convention = models.ForeignKey(Convention, on_delete=models.CASCADE)
+    registrations = models.ManyToManyField('Registration', related_name='duplicate_clusters')
+    found = models.DateTimeField(auto_now_add=True)
+    reviewed = models.BooleanField(default=False)
+    notes = models.TextField(blank=True, null=True)
+
+    objects = DuplicateClusterManager()
+
+    def members(self):
+        # Not self.registrations, which only sees paid registrations
+        return Registration.all_registrations.filter(duplicate_clusters=self).order_by('id')
+
+    def __str__(self):
+        return ' / '.join(str(registration) for registration in self.members())
+
+
+class FakeHold(object):
+    notes_addition = ''
+
+    def __init__(self, notes_addition):
+        self.notes_addition = notes_addition
+
 
 class RegistrationQueue(models.Model):
     # Represents an ordered queue of registrations, which may be useful
@@ -256,11 +917,61 @@ class RegistrationQueue(models.Model):
         q.save()
 
 
+class AvatarBlobManager(models.Manager):
+    def acquire(self, digest, name, size):
+        """
+        Take a reference on the file with this content digest, to be
+        stored as name if it's new. Returns the name it's stored as.
+        """
+        while True:
+            # Locked, so release() can't delete it between here and the update
+            blob = self.select_for_update().filter(digest=digest).first()
+            if blob is None:
+                try:
+                    with transaction.atomic():
+                        blob = self.create(digest=digest, name=name, size=size)
+                except IntegrityError:
+                    # Created meanwhile by someone else
+                    continue
+            if self.filter(pk=blob.pk).update(references=models.F('references') + 1):
+                return blob.name
+
+    def release(self, name):
+        """Give back a reference on the file stored as name. Returns whether it's no longer referenced."""
+        blob = self.select_for_update().filter(name=name).first()
+        if blob is None:
+            return True
+        if blob.references > 1:
+            self.filter(pk=blob.pk).update(references=models.F('references') - 1)
+            return False
+        blob.delete()
+        return True
+
+
+class AvatarBlob(models.Model):
+    """
+    An avatar image file, stored once under a hash of its content by
+    storage.AvatarStorage, and how many avatar fields (and derivatives)
+    refer to it.
+    """
+
+    digest = models.CharField(max_length=64, unique=True)
+    name = models.CharField(max_length=255, unique=True)
+    size = models.PositiveIntegerField(default=0)
+    references = models.PositiveIntegerField(default=0)
+    created = models.DateTimeField(auto_now_add=True)
+
+    objects = AvatarBlobManager()
+
+    def __str__(self):
+        return '{0} ({1} reference(s))'.format(self.name, self.references)
+
+
 class RegistrationTempAvatar(models.Model):
     """Used primarily for image uploads during registration.
        May also be used for badge renames."""
 
-    avatar = models.ImageField(upload_to='tmp_avatars/', null=True, blank=True)
+    avatar = models.ImageField(upload_to='tmp_avatars/', storage=avatar_storage, null=True, blank=True)
     new_badge_name = models.CharField(max_length=32, null=True, blank=True)
     uploaded = models.DateTimeField(auto_now_add=True)
 
@@ -288,7 +999,7 @@ class StaffRegistration(models.Model):
     )
     sort_order = models.IntegerField(default=5, choices=SORT_ORDER_CHOICES)
     avatar_virtual_filename = models.CharField(blank=True, null=True, max_length=50)
-    avatar = models.ImageField(upload_to='staff_avatars/', null=True, blank=True)
+    avatar = models.ImageField(upload_to='staff_avatars/', storage=avatar_storage, null=True, blank=True)
     approved = models.BooleanField(default=False)
     extra = models.TextField(blank=True, null=True)
 
@@ -310,9 +1021,9 @@ class StaffRegistration(models.Model):
 
     # Delete the processed image along with this object
     def delete(self, using=None):
-        if self.avatar:
-            name = self.avatar.name
-            super(RegistrationTempAvatar, self).delete(using)
+        name = self.avatar.name
+        super(StaffRegistration, self).delete(using)
+        if name:
             self.avatar.storage.delete(name)
 
     def __str__(self):
@@ -337,8 +1048,72 @@ class ShirtSize(models.Model):
         return self.size
 
 
+class PaymentManager(models.Manager):
+    def refunds_requested(self, before):
+        """Payments with refunds requested before then, with what the refund report shows."""
+        return self.filter(payment_state=2, refund_requested__lt=before) \
+            .select_related('registration__registration_level__convention', 'payment_method') \
+            .order_by('refund_requested', 'id')
+
+    def process_refunds(self, before, workers=4, rate=None, dry_run=False):
+        """
+        Refund card payments whose refunds were requested before then.
+        Gateway calls run on up to workers threads, at most rate a
+        second between them, while the database is only touched from
+        the calling thread. Each refund is saved as soon as the gateway
+        confirms it, and is keyed on the charge, so a run that dies part
+        way can simply be run again. With dry_run, charges are only
+        looked up. Returns lists of 'refunded' payments and 'errors'.
+        """
+        results = {'refunded': [], 'errors': []}
+        payments = [payment for payment in self.refunds_requested(before)
+                    if payment.payment_method.is_credit and payment.payment_extra]
+        if not payments:
+            return results
+
+        gateways = {}
+        limiter = RateLimiter(rate)
+
+        def refund(gateway, charge_id):
+            limiter.wait()
+            if dry_run:
+                return gateway.retrieve(charge_id)
+            try:
+                return gateway.refund(charge_id, idempotency_key='refund-{}'.format(charge_id))
+            except PaymentError:
+                # Refunded by an earlier run the key no longer covers?
+                limiter.wait()
+                charge = gateway.retrieve(charge_id)
+                if getattr(charge, 'refunded', False):
+                    return charge
+                raise
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {}
+            for payment in payments:
+                secret_key = payment.registration.registration_level.convention.stripe_secret_key
+                if secret_key not in gateways:
+                    gateways[secret_key] = get_gateway(secret_key=secret_key)
+                futures[executor.submit(refund, gateways[secret_key], payment.payment_extra)] = payment
+            for future in as_completed(futures):
+                payment = futures[future]
+                try:
+                    future.result()
+                except Exception as e:
+                    results['errors'].append((payment, e.args[0] if e.args else type(e).__name__))
+                    continue
+                if not dry_run:
+                    payment.refund_processed = timezone.now()
+                    payment.payment_state = 3
+                    payment.save()
+                results['refunded'].append(payment)
+        return results
+
+
 class Payment(models.Model):
     registration = models.ForeignKey('Registration', on_delete=models.CASCADE)
+    # Copied from the registration
+    convention = models.ForeignKey(Convention, null=True, blank=True, editable=False, on_delete=models.PROTECT)
     PAYMENT_STATES = (
         (1, 'Paid'),
         (2, 'Refund Requested'),
@@ -357,11 +1132,191 @@ class Payment(models.Model):
     refund_requested = models.DateTimeField(blank=True, null=True)
     refund_processed = models.DateTimeField(blank=True, null=True)
 
+    objects = PaymentManager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['convention', 'payment_state']),
+        ]
+
+    def save(self, *args, **kwargs):
+        # Keep the registration's ledger update in the same transaction
+        with transaction.atomic():
+            super(Payment, self).save(*args, **kwargs)
+
     def __str__(self):
         return self.registration.name + ' [' + "%.02f" % (self.payment_amount) + ']'
 
 
-class RegistrationLevelCurrentManager(models.Manager):
+class PendingPaymentManager(models.Manager):
+    def reconcile(self, minutes=30, gateway=None):
+        """
+        Settle registrations left in status 2 for more than minutes,
+        after a lost webhook or a worker dying mid-payment. Charges the
+        gateway has settled are finalized, ones never made are submitted
+        again under the same idempotency key, and status 2 registrations
+        without a pending payment go by their Payment rows. Returns
+        counts of 'paid', 'released' and 'waiting' registrations.
+        """
+        gateway = gateway or get_gateway()
+        cutoff = timezone.now() - timedelta(minutes=minutes)
+        counts = {'paid': 0, 'released': 0, 'waiting': 0}
+        stuck = Registration.all_registrations.filter(status=2) \
+            .exclude(pending_payments__updated__gte=cutoff).values_list('id', flat=True)
+        for registration_id in stuck:
+            with transaction.atomic():
+                registration = Registration.all_registrations.select_for_update().get(pk=registration_id)
+                if registration.status != 2:
+                    # Settled while we were getting to it
+                    continue
+                pending = registration.pending_payments.filter(finalized__isnull=True).order_by('-id').first()
+                if pending is None:
+                    paid = Payment.objects.filter(registration=registration).exclude(payment_state=3).exists()
+                    registration.status = 1 if paid else 0
+                    registration.save()
+                    counts['paid' if paid else 'released'] += 1
+                    continue
+                if pending.status == 0:
+                    pending.submit(gateway)
+                elif pending.status == 1:
+                    if Payment.objects.filter(payment_extra=pending.charge_id).exists():
+                        pending.record_result('succeeded')
+                    else:
+                        try:
+                            charge = gateway.retrieve(pending.charge_id)
+                        except PaymentError:
+                            charge = None
+                        if charge is not None and charge.status in ('succeeded', 'failed'):
+                            pending.record_result(charge.status)
+                if pending.status in (2, 3):
+                    pending.finalize()
+                    counts['paid' if pending.status == 2 else 'released'] += 1
+                else:
+                    # Touch it so it isn't retried on every pass
+                    pending.save()
+                    counts['waiting'] += 1
+        return counts
+
+
+class PendingPayment(models.Model):
+    """
+    A card payment taken off the web request in async payment mode
+    (settings.REGISTRATION_ASYNC_PAYMENTS). The registration is saved
+    with status 2 and a submit_payment job charges the card; the result
+    comes back with the charge or later through the gateway's webhook,
+    and finalize() turns it into a Payment or releases the registration.
+    """
+    STATUS_OPTIONS = (
+        (0, 'Submitting'),
+        (1, 'Awaiting Result'),
+        (2, 'Succeeded'),
+        (3, 'Failed'),
+    )
+
+    registration = models.ForeignKey('Registration', on_delete=models.CASCADE, related_name='pending_payments')
+    payment_method = models.ForeignKey('PaymentMethod', on_delete=models.PROTECT)
+    amount = models.DecimalField(max_digits=10, decimal_places=2)
+    description = models.CharField(max_length=255)
+    # Single use card token, cleared once the charge is made
+    token = models.CharField(max_length=255, blank=True)
+    charge_id = models.CharField(max_length=255, blank=True, null=True, db_index=True)
+    # Sent with the charge, so a retried submit can't charge twice
+    idempotency_key = models.UUIDField(default=uuid.uuid4, unique=True, editable=False)
+    status = models.IntegerField(default=0, choices=STATUS_OPTIONS)
+    error = models.TextField(blank=True, null=True)
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+    finalized = models.DateTimeField(null=True, blank=True)
+
+    objects = PendingPaymentManager()
+
+    def __str__(self):
+        return '{0} [{1}]'.format(self.registration, self.get_status_display())
+
+    def submit(self, gateway=None):
+        """Charge the card. Safe to repeat, the gateway sees the same idempotency key."""
+        if self.status != 0:
+            return
+        gateway = gateway or get_gateway()
+        try:
+            charge = gateway.charge(self.amount, self.token, self.description,
+                                    idempotency_key=str(self.idempotency_key))
+        except PaymentError as e:
+            self.record_result('failed', e.args[0])
+            return
+        self.charge_id = charge.id
+        self.token = ''
+        self.status = 1
+        self.save()
+        if charge.status in ('succeeded', 'failed'):
+            self.record_result(charge.status)
+
+    def record_result(self, status, error=None):
+        """Note the gateway's outcome. Repeats (say, a webhook after the charge returned) are ignored."""
+        if self.status in (2, 3):
+            return False
+        self.status = 2 if status == 'succeeded' else 3
+        self.error = error
+        self.token = ''
+        self.save()
+        return True
+
+    def finalize(self):
+        """
+        Move the registration out of status 2: paid with a Payment row and
+        the confirmation email if the charge succeeded, otherwise back to
+        unpaid, which gives up its capacity, with a note to the registrant.
+        """
+        if self.finalized or self.status not in (2, 3):
+            return
+        registration = Registration.all_registrations.select_for_update().get(pk=self.registration_id)
+        payment = None
+        if self.status == 2:
+            # A Payment for the charge means an earlier attempt got this far
+            payment = Payment.objects.filter(payment_extra=self.charge_id).first()
+            if payment is None:
+                payment = Payment.objects.create(registration=registration,
+                                                 payment_method=self.payment_method,
+                                                 payment_amount=self.amount,
+                                                 payment_level_comment=registration.registration_level.title,
+                                                 payment_extra=self.charge_id)
+        if registration.status == 2:
+            if self.status == 2:
+                registration.status = 1
+                templates = ('registration/registration_confirm_subject.txt',
+                             'registration/registration_confirm_body.txt')
+            else:
+                registration.status = 0
+                # Give the coupon back for another try
+                CouponUse.objects.filter(registration=registration).delete()
+                templates = ('registration/registration_payment_failed_subject.txt',
+                             'registration/registration_payment_failed_body.txt')
+            registration.save()
+
+            c = {
+                'convention': registration.convention,
+                'registration': registration,
+                'payment': payment,
+                'error': self.error,
+            }
+            email_subject = loader.render_to_string(templates[0], c)
+            # Email subject *must not* contain newlines
+            email_subject = ''.join(email_subject.splitlines())
+            email_body = loader.render_to_string(templates[1], c)
+            OutboxMessage.objects.queue(email_subject, email_body,
+                                        registration.convention.contact_email,
+                                        [registration.email])
+        self.finalized = timezone.now()
+        self.save()
+
+
+class RegistrationLevelQuerySet(models.QuerySet):
+    def with_current_price(self, when=None):
+        """Annotate current_price, the price in effect at when (default now)."""
+        return self.annotate(current_price=current_price(RegistrationLevelPrice, 'registration_level', when=when))
+
+
+class RegistrationLevelCurrentManager(models.Manager.from_queryset(RegistrationLevelQuerySet)):
     """Return current convention's active levels."""
 
     def get_queryset(self):
@@ -370,7 +1325,8 @@ class RegistrationLevelCurrentManager(models.Manager):
             .exclude(opens__gt=timezone.now()) \
             .exclude(deadline__lt=timezone.now())
         # Try to determine current convention, may return None if unable to
-        convention = Convention.objects.current()
+        from .catalog import get_current_convention
+        convention = get_current_convention()
         if convention:
             levels = levels.filter(
                 convention=convention,
@@ -392,10 +1348,15 @@ class RegistrationLevel(models.Model):
     active = models.BooleanField(default=True)
     swag = models.ManyToManyField('Swag', through='RegistrationLevelSwag')
 
-    objects = models.Manager()
+    objects = RegistrationLevelQuerySet.as_manager()
     current = RegistrationLevelCurrentManager()
 
     def _get_current_price(self):
+        if 'current_price' in self.__dict__:
+            return self.__dict__['current_price']
+        if self.pk:
+            from .catalog import get_catalog
+            return get_catalog(self.convention_id).level_price(self.pk)
         current_active_price = self.registrationlevelprice_set.filter(
             active_date__lt=timezone.now()
         ).order_by('-active_date').first()
@@ -406,6 +1367,21 @@ class RegistrationLevel(models.Model):
 
     price = property(_get_current_price)
 
+    def _get_sold(self):
+        return RegistrationLevelInventory.objects.for_level(self).sold
+
+    sold = property(_get_sold)
+
+    def _get_held(self):
+        return RegistrationLevelInventory.objects.for_level(self).held
+
+    held = property(_get_held)
+
+    def sold_out(self, hold=None):
+        # Capacity set aside by hold, the buyer's own, is theirs to take
+        held = self.held - (hold is not None and hold.registration_level_id == self.pk)
+        return bool(self.limit) and self.sold + held >= self.limit
+
     def __str__(self):
         return '{0} [{1}]'.format(self.title, self.convention.name)
 
@@ -443,10 +1419,230 @@ class DealerRegistrationLevel(models.Model):
     number_tables = models.IntegerField()
     price = models.DecimalField(max_digits=10, decimal_places=2)
 
+    def _get_sold(self):
+        return DealerRegistrationLevelInventory.objects.for_level(self).sold
+
+    sold = property(_get_sold)
+
+    def _get_held(self):
+        return DealerRegistrationLevelInventory.objects.for_level(self).held
+
+    held = property(_get_held)
+
+    def sold_out(self, hold=None):
+        dealer_limit = self.convention.dealer_limit
+        held = self.held - (hold is not None and hold.dealer_registration_level_id == self.pk)
+        return bool(dealer_limit) and self.sold + held + self.number_tables > dealer_limit
+
     def __str__(self):
         return str(self.number_tables) + ' [' + "%.02f" % self.price + ']'
 
 
+class InventoryManager(models.Manager):
+    """Maintains the per-level counters of paid registrations."""
+
+    def count_registrations(self, level):
+        return Registration.all_registrations.filter(
+            status__in=Registration.INVENTORY_STATUSES, **{self.model.registration_field: level}
+        ).count()
+
+    def counter(self, level):
+        counter = self.filter(level=level).first()
+        if counter is None:
+            # No counter yet (e.g. level predates them), build it from scratch
+            counter, created = self.get_or_create(
+                level=level,
+                defaults={'sold': self.count_registrations(level)},
+            )
+        return counter
+
+    def for_level(self, level):
+        # Use a counter pulled in by select_related('inventory') if present
+        try:
+            return level.inventory
+        except ObjectDoesNotExist:
+            return self.counter(level)
+
+    def attach(self, levels):
+        """Pull fresh counters onto a batch of levels in one query."""
+        counters = {counter.level_id: counter for counter in self.filter(level__in=levels)}
+        for level in levels:
+            if level.pk in counters:
+                level.inventory = counters[level.pk]
+        return levels
+
+    def adjust(self, level_id, delta, field='sold'):
+        if not self.filter(level_id=level_id).update(**{field: models.F(field) + delta}):
+            self.counter(level_id)
+
+    def recount(self):
+        """Rebuild every counter from the registrations and holds tables."""
+        field = '{}_id'.format(self.model.registration_field)
+        counts = dict(
+            Registration.all_registrations.filter(status__in=Registration.INVENTORY_STATUSES,
+                                                  **{field + '__isnull': False})
+            .values_list(field).annotate(models.Count('id')).order_by()
+        )
+        holds = dict(
+            InventoryHold.objects.filter(**{field + '__isnull': False})
+            .values_list(field).annotate(models.Count('id')).order_by()
+        )
+        level_model = self.model._meta.get_field('level').related_model
+        with transaction.atomic():
+            for level_id in level_model.objects.values_list('id', flat=True):
+                self.update_or_create(level_id=level_id, defaults={
+                    'sold': counts.get(level_id, 0),
+                    'held': holds.get(level_id, 0),
+                })
+
+    def reserve(self, level):
+        """
+        Lock the level's counter until the current transaction ends and
+        raise SoldOut if it has no capacity left. Concurrent buyers of the
+        same level queue up behind the lock, so whoever saves the paid
+        registration or places the hold first takes the last slot.
+        """
+        if not transaction.get_connection().in_atomic_block:
+            raise transaction.TransactionManagementError('reserve() must be called inside transaction.atomic()')
+        self.counter(level)
+        level.inventory = self.select_for_update().get(level=level)
+        if level.inventory.held:
+            # Capacity may be tied up in lapsed holds the sweeper hasn't reached yet
+            if InventoryHold.objects.expired().filter(**{self.model.registration_field: level}).delete()[0]:
+                level.inventory.refresh_from_db()
+        if level.sold_out():
+            raise SoldOut('That {} is no longer available.'.format(self.model.description))
+        return level.inventory
+
+
+class RegistrationLevelInventory(models.Model):
+    """Count of paid registrations held against RegistrationLevel.limit"""
+
+    level = models.OneToOneField(RegistrationLevel, on_delete=models.CASCADE, related_name='inventory')
+    sold = models.IntegerField(default=0)
+    held = models.IntegerField(default=0)
+
+    objects = InventoryManager()
+
+    registration_field = 'registration_level'
+    description = 'registration level'
+
+    def __str__(self):
+        return '{0}: {1} sold, {2} held'.format(self.level, self.sold, self.held)
+
+
+class DealerRegistrationLevelInventory(models.Model):
+    """Count of paid registrations holding a dealer level, for dealer_limit"""
+
+    level = models.OneToOneField(DealerRegistrationLevel, on_delete=models.CASCADE, related_name='inventory')
+    sold = models.IntegerField(default=0)
+    held = models.IntegerField(default=0)
+
+    objects = InventoryManager()
+
+    registration_field = 'dealer_registration_level'
+    description = 'dealer registration level'
+
+    def __str__(self):
+        return '{0}: {1} sold, {2} held'.format(self.level, self.sold, self.held)
+
+
+class InventoryHoldManager(models.Manager):
+    def live(self):
+        return self.filter(expires__gt=timezone.now())
+
+    def expired(self):
+        return self.filter(expires__lte=timezone.now())
+
+    def live_counts(self, field='registration_level'):
+        """Number of unexpired holds per level, as a dict keyed by level id."""
+        return dict(
+            self.live().filter(**{field + '__isnull': False})
+            .values_list(field).annotate(models.Count('id')).order_by()
+        )
+
+    def place(self, registration_level=None, dealer_registration_level=None, minutes=15):
+        """Set aside one unit of each level given, or raise SoldOut."""
+        with transaction.atomic():
+            if registration_level:
+                RegistrationLevelInventory.objects.reserve(registration_level)
+            if dealer_registration_level:
+                DealerRegistrationLevelInventory.objects.reserve(dealer_registration_level)
+            return self.create(
+                registration_level=registration_level,
+                dealer_registration_level=dealer_registration_level,
+                expires=timezone.now() + timedelta(minutes=minutes),
+            )
+
+    def claim(self, hold_id):
+        """
+        Use up a hold as its registration is saved, in the same
+        transaction. Returns False if the hold is gone or has lapsed, in
+        which case the caller has to reserve capacity again.
+        """
+        hold = self.live().select_for_update().filter(pk=hold_id).first()
+        if hold is None:
+            return False
+        hold.delete()
+        return True
+
+
+class InventoryHold(models.Model):
+    """Capacity set aside for a buyer between the confirm and success steps"""
+
+    registration_level = models.ForeignKey(RegistrationLevel, null=True, blank=True, on_delete=models.CASCADE)
+    dealer_registration_level = models.ForeignKey(DealerRegistrationLevel, null=True, blank=True,
+                                                  on_delete=models.CASCADE)
+    created = models.DateTimeField(auto_now_add=True)
+    expires = models.DateTimeField(db_index=True)
+
+    objects = InventoryHoldManager()
+
+    def __str__(self):
+        levels = [str(level) for level in (self.registration_level, self.dealer_registration_level) if level]
+        return '{0} until {1}'.format(' + '.join(levels), self.expires)
+
+
+class RegistrationDraftManager(models.Manager):
+    def live(self):
+        return self.filter(expires__gt=timezone.now())
+
+    def expired(self):
+        return self.filter(expires__lte=timezone.now())
+
+    def store(self, cleaned_data, draft_id=None, minutes=60):
+        """Save a form's cleaned_data, over draft_id if it's still there. Returns the draft's id."""
+        data = json.dumps(compact_form_data(cleaned_data))
+        expires = timezone.now() + timedelta(minutes=minutes)
+        if draft_id and self.filter(pk=draft_id).update(data=data, expires=expires):
+            return draft_id
+        return self.create(data=data, expires=expires).pk
+
+    def load(self, draft_id):
+        """The form data saved as draft_id, or None if it's gone or lapsed."""
+        if not draft_id:
+            return None
+        data = self.live().filter(pk=draft_id).values_list('data', flat=True).first()
+        return json.loads(data) if data is not None else None
+
+
+class RegistrationDraft(models.Model):
+    """
+    A submitted form waiting on the confirm step, kept out of the
+    session, which only carries the id. Model choices are stored as
+    primary keys, and the form is bound to the data again to finish.
+    """
+
+    data = models.TextField()
+    created = models.DateTimeField(auto_now_add=True)
+    expires = models.DateTimeField(db_index=True)
+
+    objects = RegistrationDraftManager()
+
+    def __str__(self):
+        return 'Draft {0} until {1}'.format(self.id, self.expires)
+
+
 class CouponCode(models.Model):
     convention = models.ForeignKey(Convention, on_delete=models.CASCADE)
     code = models.CharField(max_length=255)
@@ -474,6 +1670,11 @@ class CouponUse(models.Model):
     registration = models.ForeignKey('Registration', on_delete=models.CASCADE)
     coupon = models.ForeignKey('CouponCode', on_delete=models.CASCADE)
 
+    def save(self, *args, **kwargs):
+        # Keep the registration's ledger update in the same transaction
+        with transaction.atomic():
+            super(CouponUse, self).save(*args, **kwargs)
+
     def __str__(self):
         return '%s - %s' % (self.registration, self.coupon)
 
@@ -488,6 +1689,12 @@ class PaymentMethod(models.Model):
         return self.name
 
 
+class RegistrationUpgradeQuerySet(models.QuerySet):
+    def with_current_price(self, when=None):
+        """Annotate current_price, the price in effect at when (default now)."""
+        return self.annotate(current_price=current_price(RegistrationUpgradePrice, 'registration_upgrade', when=when))
+
+
 class RegistrationUpgrade(models.Model):
     current_registration_level = models.ForeignKey(RegistrationLevel, related_name='upgrades', on_delete=models.CASCADE)
     upgrade_registration_level = models.ForeignKey(RegistrationLevel, related_name='upgrades_from',
@@ -495,7 +1702,15 @@ class RegistrationUpgrade(models.Model):
     description = models.TextField(blank=True)
     active = models.BooleanField(default=True)
 
+    objects = RegistrationUpgradeQuerySet.as_manager()
+
     def _get_current_price(self):
+        if 'current_price' in self.__dict__:
+            return self.__dict__['current_price']
+        if self.pk:
+            from .catalog import get_catalog
+            convention_id = self.current_registration_level.convention_id
+            return get_catalog(convention_id).upgrade_price(self.pk)
         current_active_price = self.registrationupgradeprice_set.filter(
             active_date__lt=timezone.now()
         ).order_by('-active_date').first()
@@ -524,3 +1739,375 @@ class RegistrationUpgradePrice(models.Model):
 
     def __str__(self):
         return '{0} as of {1}'.format(self.price, self.active_date)
+
+
+class JobManager(models.Manager):
+    def enqueue(self, kind, object_id, **payload):
+        """
+        Queue a job. It's saved in the caller's transaction, so the worker
+        only sees it once that commits, and never if it rolls back.
+        """
+        return self.create(kind=kind, object_id=object_id, payload=json.dumps(payload))
+
+    def due(self):
+        return self.filter(status=0, run_after__lte=timezone.now())
+
+    def run_pending(self, limit=None):
+        """Run due jobs one at a time until none are left or limit is reached. Returns how many ran."""
+        count = 0
+        while limit is None or count < limit:
+            with transaction.atomic():
+                # Other workers skip a job one of them has claimed
+                job = self.due().select_for_update(skip_locked=True).order_by('run_after', 'id').first()
+                if job is None:
+                    break
+                job.attempt()
+            count += 1
+        return count
+
+    def purge(self, days=7):
+        """Delete jobs that finished more than days ago."""
+        return self.filter(status=1, finished__lt=timezone.now() - timedelta(days=days)).delete()[0]
+
+
+class Job(models.Model):
+    """Work deferred until after commit, run by the run_jobs worker."""
+    KINDS = (
+        ('check_holds', 'Check registration against holds'),
+        ('rescan_hold', 'Apply hold to existing registrations'),
+        ('submit_payment', 'Charge a pending payment'),
+        ('finalize_payment', 'Finalize a pending payment'),
+        ('avatar_derivatives', 'Make avatar derivatives'),
+    )
+    STATUS_OPTIONS = (
+        (0, 'Pending'),
+        (1, 'Done'),
+        (2, 'Failed'),
+    )
+    MAX_ATTEMPTS = 5
+
+    kind = models.CharField(max_length=50, choices=KINDS)
+    object_id = models.IntegerField()
+    payload = models.TextField(blank=True, default='{}')
+    status = models.IntegerField(default=0, choices=STATUS_OPTIONS)
+    attempts = models.IntegerField(default=0)
+    run_after = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True, null=True)
+    created = models.DateTimeField(auto_now_add=True)
+    finished = models.DateTimeField(null=True, blank=True)
+
+    objects = JobManager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'run_after']),
+        ]
+
+    def __str__(self):
+        return '{0} {1} [{2}]'.format(self.get_kind_display(), self.object_id, self.get_status_display())
+
+    def run(self):
+        payload = json.loads(self.payload or '{}')
+        try:
+            if self.kind == 'check_holds':
+                Registration.all_registrations.select_for_update().get(pk=self.object_id).check_holds()
+            elif self.kind == 'rescan_hold':
+                RegistrationHold.objects.get(pk=self.object_id).rescan(payload['convention'])
+            elif self.kind == 'submit_payment':
+                pending = PendingPayment.objects.select_for_update().get(pk=self.object_id)
+                pending.submit()
+                pending.finalize()
+            elif self.kind == 'finalize_payment':
+                PendingPayment.objects.select_for_update().get(pk=self.object_id).finalize()
+            elif self.kind == 'avatar_derivatives':
+                Registration.all_registrations.get(pk=self.object_id).update_avatar_derivatives()
+        except ObjectDoesNotExist:
+            # Deleted since it was queued, nothing left to do
+            pass
+
+    def attempt(self):
+        """Run the job, backing off and retrying later if it fails."""
+        self.attempts += 1
+        try:
+            with transaction.atomic():
+                self.run()
+        except Exception as e:
+            self.last_error = '{0}: {1}'.format(type(e).__name__, e)
+            if self.attempts >= self.MAX_ATTEMPTS:
+                self.status = 2
+            else:
+                self.run_after = timezone.now() + timedelta(minutes=2 ** self.attempts)
+        else:
+            self.status = 1
+            self.finished = timezone.now()
+        self.save()
+
+
+class OutboxMessageManager(models.Manager):
+    def queue(self, subject, message, from_email, recipient_list):
+        """
+        Store an email for the deliver_mail worker to send, in place of
+        send_mail(). It's saved in the caller's transaction, so only goes
+        out if that commits.
+        """
+        return self.create(subject=subject[:255], body=message, from_email=from_email,
+                           to=json.dumps(list(recipient_list)))
+
+    def due(self):
+        return self.filter(status=0, send_after__lte=timezone.now())
+
+    def deliver(self, batch_size=50, rate=None, limit=None, connection=None):
+        """
+        Send due messages over one reused connection, batch_size at a time
+        and at most rate messages a second. Failed messages are retried
+        with backoff. Returns counts of what happened.
+
+        Each batch is claimed by putting it off for OutboxMessage.CLAIM,
+        and each message saved as sent before the next goes out, so a
+        worker that dies mid-batch leaves only what it hadn't sent to
+        come due again.
+        """
+        stats = {'sent': 0, 'retrying': 0, 'failed': 0}
+        connection = connection or get_connection()
+        interval = 1.0 / rate if rate else 0
+        last_send = 0
+        try:
+            while limit is None or stats['sent'] + stats['retrying'] + stats['failed'] < limit:
+                with transaction.atomic():
+                    # Other workers skip messages one of them is claiming
+                    batch = list(self.due().select_for_update(skip_locked=True).order_by('send_after', 'id')[:batch_size])
+                    self.filter(pk__in=[message.pk for message in batch]).update(
+                        send_after=timezone.now() + self.model.CLAIM)
+                if not batch:
+                    break
+                for message in batch:
+                    wait = last_send + interval - time.monotonic()
+                    if wait > 0:
+                        time.sleep(wait)
+                    last_send = time.monotonic()
+                    message.attempt(connection)
+                    if message.status == 1:
+                        stats['sent'] += 1
+                    elif message.status == 2:
+                        stats['failed'] += 1
+                    else:
+                        stats['retrying'] += 1
+        finally:
+            connection.close()
+        return stats
+
+    def purge(self, days=7):
+        """Delete messages sent more than days ago."""
+        return self.filter(status=1, sent__lt=timezone.now() - timedelta(days=days)).delete()[0]
+
+
+class OutboxMessage(models.Model):
+    """Email waiting to go out, see OutboxMessageManager.queue()"""
+    STATUS_OPTIONS = (
+        (0, 'Queued'),
+        (1, 'Sent'),
+        (2, 'Failed'),
+    )
+    MAX_ATTEMPTS = 5
+    # How long a worker's claim on a batch keeps others off it
+    CLAIM = timedelta(minutes=10)
+
+    subject = models.CharField(max_length=255)
+    body = models.TextField()
+    from_email = models.CharField(max_length=255)
+    to = models.TextField()
+    status = models.IntegerField(default=0, choices=STATUS_OPTIONS)
+    attempts = models.IntegerField(default=0)
+    send_after = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True, null=True)
+    created = models.DateTimeField(auto_now_add=True)
+    sent = models.DateTimeField(null=True, blank=True)
+
+    objects = OutboxMessageManager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'send_after']),
+        ]
+
+    def __str__(self):
+        return '{0} to {1} [{2}]'.format(self.subject, ', '.join(self.recipients()), self.get_status_display())
+
+    def recipients(self):
+        return json.loads(self.to)
+
+    def attempt(self, connection):
+        """Send the message, backing off and retrying later if it fails."""
+        self.attempts += 1
+        try:
+            # Opened by the first message, and again after a failure closed it
+            connection.open()
+            EmailMessage(self.subject, self.body, self.from_email, self.recipients(),
+                         connection=connection).send()
+        except Exception as e:
+            # Start over with a fresh connection for the next message
+            connection.close()
+            self.last_error = '{0}: {1}'.format(type(e).__name__, e)
+            if self.attempts >= self.MAX_ATTEMPTS:
+                self.status = 2
+            else:
+                self.send_after = timezone.now() + timedelta(minutes=2 ** self.attempts)
+        else:
+            self.status = 1
+            self.sent = timezone.now()
+        self.save()
+
+
+class Announcement(models.Model):
+    """
+    Email to everyone registered for a convention who opted in with
+    email_me, sent by the send_announcements command. Subject and body
+    are templates, rendered per recipient with registration and
+    convention in the context.
+    """
+    STATUS_OPTIONS = (
+        (0, 'Draft'),
+        (1, 'Queued'),
+        (2, 'Sending'),
+        (3, 'Sent'),
+    )
+
+    convention = models.ForeignKey(Convention, on_delete=models.CASCADE)
+    subject = models.CharField(max_length=255)
+    body = models.TextField()
+    from_email = models.CharField(max_length=255, blank=True,
+                                  help_text='Defaults to the convention contact email')
+    status = models.IntegerField(default=0, choices=STATUS_OPTIONS)
+    # Checkpoint: everyone up to this registration has been sent to
+    last_registration_id = models.IntegerField(default=0, editable=False)
+    sent_count = models.IntegerField(default=0, editable=False)
+    failed_count = models.IntegerField(default=0, editable=False)
+    last_error = models.TextField(blank=True, null=True, editable=False)
+    created = models.DateTimeField(auto_now_add=True)
+    started = models.DateTimeField(null=True, blank=True, editable=False)
+    finished = models.DateTimeField(null=True, blank=True, editable=False)
+    # Held by the run sending it, renewed at each checkpoint
+    lease_expires = models.DateTimeField(null=True, blank=True, editable=False)
+
+    LEASE = timedelta(minutes=10)
+    # Failures in a row that say the mail server, not the recipients,
+    # is the trouble
+    MAX_FAILURES_IN_A_ROW = 10
+
+    def __str__(self):
+        return '{0} [{1}]'.format(self.subject, self.get_status_display())
+
+    def recipients(self):
+        return Registration.all_registrations.filter(
+            convention=self.convention_id, status=1, email_me=True,
+        ).exclude(email='')
+
+    def claim(self):
+        """
+        Take the announcement for sending, unless another run holds it.
+        Picks up the checkpoint as that run left it. A run that dies
+        without letting go holds it until the lease lapses.
+        """
+        now = timezone.now()
+        claimed = Announcement.objects.filter(pk=self.pk, status__in=[1, 2]).filter(
+            Q(lease_expires__isnull=True) | Q(lease_expires__lte=now)
+        ).update(status=2, lease_expires=now + self.LEASE,
+                 started=Coalesce('started', models.Value(now), output_field=models.DateTimeField()))
+        self.refresh_from_db()
+        return bool(claimed)
+
+    def send(self, batch_size=100, rate=None, connection=None):
+        """
+        Send to every recipient after the checkpoint, in id order, over
+        one reused connection and at most rate messages a second.
+        Recipients are streamed, and the checkpoint saved after each
+        batch, so an interrupted send picks up where it left off.
+
+        Returns True once everyone's been sent to, False if it stopped
+        because the mail server is failing (the checkpoint is left
+        before the failures, to resume from), or None if another run
+        is sending it.
+        """
+        if not self.claim():
+            return None
+
+        subject_template = Template(self.subject)
+        body_template = Template(self.body)
+        from_email = self.from_email or self.convention.contact_email
+        connection = connection or get_connection()
+        interval = 1.0 / rate if rate else 0
+        last_send = 0
+
+        recipients = self.recipients().filter(id__gt=self.last_registration_id).order_by('id')
+        batch = []
+        # Failed recipients since the last one sent to, only given up on
+        # once the server has taken mail again
+        failures = []
+        finished = False
+        try:
+            for registration in recipients.iterator(chunk_size=batch_size):
+                c = Context({'registration': registration, 'convention': self.convention})
+                wait = last_send + interval - time.monotonic()
+                if wait > 0:
+                    time.sleep(wait)
+                last_send = time.monotonic()
+                try:
+                    # Opened by the first message, and again after a failure closed it
+                    connection.open()
+                    EmailMessage(''.join(subject_template.render(c).splitlines()), body_template.render(c),
+                                 from_email, [registration.email], connection=connection).send()
+                except Exception as e:
+                    # Start over with a fresh connection for the next message
+                    connection.close()
+                    self.last_error = '{0}: {1}'.format(type(e).__name__, e)
+                    failures.append(registration.id)
+                    if self.server_failed(e) or len(failures) >= self.MAX_FAILURES_IN_A_ROW:
+                        break
+                    continue
+                batch.extend([False] * len(failures) + [True])
+                failures = []
+                self.last_registration_id = registration.id
+                if len(batch) >= batch_size:
+                    if not self.checkpoint(batch):
+                        # Lease lost to another run, leave the rest to it
+                        return False
+                    batch = []
+            else:
+                if failures and (batch or self.sent_count):
+                    # The last few were the recipients' own failures
+                    batch.extend([False] * len(failures))
+                    self.last_registration_id = failures[-1]
+                    failures = []
+                finished = not failures
+            if not self.checkpoint(batch):
+                return False
+        finally:
+            connection.close()
+            release = {'lease_expires': None}
+            if finished:
+                release.update(status=3, finished=timezone.now())
+            Announcement.objects.filter(pk=self.pk, lease_expires=self.lease_expires).update(**release)
+            for field, value in release.items():
+                setattr(self, field, value)
+        return finished
+
+    def server_failed(self, e):
+        # Refused recipients or messages are down to them, anything else
+        # from the connection means nothing is getting through
+        return isinstance(e, OSError) and not isinstance(e, (smtplib.SMTPRecipientsRefused, smtplib.SMTPDataError))
+
+    def checkpoint(self, batch):
+        """Save progress and renew the lease. Returns False if another run has taken over since."""
+        lease_expires = timezone.now() + self.LEASE
+        held = Announcement.objects.filter(pk=self.pk, lease_expires=self.lease_expires).update(
+            last_registration_id=self.last_registration_id,
+            sent_count=self.sent_count + batch.count(True),
+            failed_count=self.failed_count + batch.count(False),
+            last_error=self.last_error,
+            lease_expires=lease_expires,
+        )
+        if held:
+            self.sent_count += batch.count(True)
+            self.failed_count += batch.count(False)
+            self.lease_expires = lease_expires
+        return bool(held)
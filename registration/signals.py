@@ -1,10 +1,15 @@
-from django.core.mail import send_mail
+from django.core.exceptions import ObjectDoesNotExist
+from django.core.files import File
 from django.dispatch import receiver
-from django.db.models import Q
-from django.db.models.signals import post_save
-from django.template import loader
-from .models import Registration, RegistrationHold, RegistrationSettings
-from .utils import simple_feistel, stringify_integer
+from django.db.models.signals import post_delete, post_init, post_save, pre_save
+from .models import (
+    Registration, RegistrationHold, RegistrationSettings,
+    RegistrationLevel, DealerRegistrationLevel,
+    RegistrationLevelInventory, DealerRegistrationLevelInventory, InventoryHold,
+    RegistrationLevelPrice, RegistrationUpgrade, RegistrationUpgradePrice,
+    PaymentMethod, ShirtSize, Payment, CouponUse, BadgeAssignment, Job,
+)
+from .catalog import get_current_convention, invalidate_catalog, invalidate_current_convention
 
 from convention import get_convention_model
 
@@ -16,113 +21,269 @@ def attach_conventionsettings(sender, **kwargs):
         con.registrationsettings = RegistrationSettings.objects.create(convention=con)
         con.save()
 
+# Keep the level inventory counters in step with paid registrations
+def inventory_state(registration):
+    # Read through __dict__ so deferred fields don't trigger a query
+    return (registration.__dict__.get('registration_level_id'),
+            registration.__dict__.get('dealer_registration_level_id'),
+            registration.__dict__.get('status') in Registration.INVENTORY_STATUSES)
+
+@receiver(post_init, sender=Registration)
+def remember_inventory_state(sender, instance, **kwargs):
+    if instance.get_deferred_fields() & {'registration_level_id', 'dealer_registration_level_id', 'status'}:
+        instance._inventory_state = None
+    elif instance.pk:
+        instance._inventory_state = inventory_state(instance)
+    else:
+        instance._inventory_state = (None, None, False)
+
 @receiver(post_save, sender=Registration)
-def compute_external_id_field(sender, **kwargs):
-    # Compute external_id for newly created registrations
+def update_inventory(sender, instance, **kwargs):
+    previous = instance._inventory_state
+    current = inventory_state(instance)
+    if previous == current:
+        return
+    if previous is None:
+        # Unknown starting point, rebuild the affected counters
+        for level_id, inventory in zip(current[:2], (RegistrationLevelInventory, DealerRegistrationLevelInventory)):
+            if level_id:
+                inventory.objects.filter(level_id=level_id).delete()
+                inventory.objects.counter(level_id)
+    else:
+        for position, inventory in enumerate((RegistrationLevelInventory, DealerRegistrationLevelInventory)):
+            if (previous[position], previous[2]) == (current[position], current[2]):
+                continue
+            if previous[2] and previous[position]:
+                inventory.objects.adjust(previous[position], -1)
+            if current[2] and current[position]:
+                inventory.objects.adjust(current[position], 1)
+    instance._inventory_state = current
+
+@receiver(post_delete, sender=Registration)
+def release_inventory(sender, instance, **kwargs):
+    level_id, dealer_level_id, counted = instance._inventory_state or inventory_state(instance)
+    if counted:
+        RegistrationLevelInventory.objects.adjust(level_id, -1)
+        if dealer_level_id:
+            DealerRegistrationLevelInventory.objects.adjust(dealer_level_id, -1)
+
+@receiver(post_save, sender=InventoryHold)
+def count_inventory_hold(sender, **kwargs):
+    if kwargs.get('created', False):
+        hold = kwargs.get('instance')
+        if hold.registration_level_id:
+            RegistrationLevelInventory.objects.adjust(hold.registration_level_id, 1, 'held')
+        if hold.dealer_registration_level_id:
+            DealerRegistrationLevelInventory.objects.adjust(hold.dealer_registration_level_id, 1, 'held')
+
+@receiver(post_delete, sender=InventoryHold)
+def release_inventory_hold(sender, instance, **kwargs):
+    if instance.registration_level_id:
+        RegistrationLevelInventory.objects.adjust(instance.registration_level_id, -1, 'held')
+    if instance.dealer_registration_level_id:
+        DealerRegistrationLevelInventory.objects.adjust(instance.dealer_registration_level_id, -1, 'held')
+
+@receiver(post_save, sender=RegistrationLevel)
+def attach_registrationlevel_inventory(sender, **kwargs):
     if kwargs.get('created', False):
-        registration = kwargs.get('instance')
-        registration.external_id = stringify_integer(simple_feistel(registration.id))
-        registration.save()
+        RegistrationLevelInventory.objects.get_or_create(level=kwargs.get('instance'))
+
+@receiver(post_save, sender=DealerRegistrationLevel)
+def attach_dealerregistrationlevel_inventory(sender, **kwargs):
+    if kwargs.get('created', False):
+        DealerRegistrationLevelInventory.objects.get_or_create(level=kwargs.get('instance'))
+
+# Keep the copied convention on registrations and payments in step with the level
+@receiver(post_init, sender=Registration)
+def remember_convention_level(sender, instance, **kwargs):
+    instance._convention_level_id = instance.__dict__.get('registration_level_id')
+
+@receiver(pre_save, sender=Registration)
+def copy_registration_convention(sender, instance, **kwargs):
+    if 'registration_level_id' not in instance.__dict__:
+        return
+    if instance.convention_id is None or instance.registration_level_id != instance._convention_level_id:
+        instance.convention_id = instance.registration_level.convention_id
+
+@receiver(post_save, sender=Registration)
+def copy_registration_convention_to_payments(sender, instance, **kwargs):
+    if instance._convention_level_id != instance.__dict__.get('registration_level_id'):
+        if not kwargs.get('created', False):
+            Payment.objects.filter(registration=instance).exclude(convention=instance.convention_id) \
+                .update(convention=instance.convention_id)
+        instance._convention_level_id = instance.__dict__.get('registration_level_id')
+
+@receiver(pre_save, sender=Payment)
+def copy_payment_convention(sender, instance, **kwargs):
+    if instance.convention_id is None:
+        instance.convention_id = instance.registration.convention_id
+
+@receiver(post_save, sender=RegistrationLevel)
+def copy_level_convention(sender, instance, **kwargs):
+    # A level moved between conventions takes its registrations along
+    if not kwargs.get('created', False):
+        Registration.all_registrations.filter(registration_level=instance) \
+            .exclude(convention=instance.convention_id).update(convention=instance.convention_id)
+        Payment.objects.filter(registration__registration_level=instance) \
+            .exclude(convention=instance.convention_id).update(convention=instance.convention_id)
+
+# Keep the index used for matching holds current
+@receiver(post_save, sender=RegistrationHold)
+def update_registration_hold_keys(sender, instance, **kwargs):
+    instance.update_keys()
+
+# Catch registrations made before the hold was added or changed
+@receiver(post_save, sender=RegistrationHold)
+def rescan_registration_hold(sender, instance, **kwargs):
+    convention = get_current_convention()
+    if convention is not None:
+        Job.objects.enqueue('rescan_hold', instance.id, convention=convention.id)
+
+# Keep the payment ledger on registrations current
+@receiver(post_init, sender=Registration)
+def remember_ledger_level(sender, instance, **kwargs):
+    instance._ledger_level_id = instance.__dict__.get('registration_level_id')
+
+@receiver(post_save, sender=Registration)
+def update_ledger_for_level(sender, instance, **kwargs):
+    # The level sets the price, so a level change moves the amount due.
+    # New registrations were inserted with their ledger already filled in.
+    level_id = instance.__dict__.get('registration_level_id')
+    if not kwargs.get('created', False) and level_id != instance._ledger_level_id:
+        instance.update_ledger()
+    instance._ledger_level_id = level_id
+
+@receiver(post_save, sender=Payment)
+@receiver(post_delete, sender=Payment)
+@receiver(post_save, sender=CouponUse)
+@receiver(post_delete, sender=CouponUse)
+def update_ledger_for_payment(sender, instance, **kwargs):
+    try:
+        registration = instance.registration
+    except ObjectDoesNotExist:
+        # Registration itself is being deleted
+        return
+    registration.update_ledger()
+
+# Keep the stored badge number on registrations current
+def badge_number_state(registration):
+    return (registration.__dict__.get('registration_level_id'), registration.__dict__.get('needs_print'))
+
+@receiver(post_init, sender=Registration)
+def remember_badge_number_state(sender, instance, **kwargs):
+    instance._badge_number_state = badge_number_state(instance)
+
+@receiver(post_save, sender=Registration)
+def update_badge_number_for_registration(sender, instance, **kwargs):
+    state = badge_number_state(instance)
+    if not kwargs.get('created', False) and state != instance._badge_number_state:
+        instance.update_badge_number()
+    instance._badge_number_state = state
+
+@receiver(post_save, sender=BadgeAssignment)
+@receiver(post_delete, sender=BadgeAssignment)
+def update_badge_number_for_assignment(sender, instance, **kwargs):
+    try:
+        registration = instance.registration
+    except ObjectDoesNotExist:
+        # Registration itself is being deleted
+        return
+    registration.update_badge_number()
+
+def badge_settings_state(settings):
+    return (settings.__dict__.get('badge_number_style'), settings.__dict__.get('badge_offset'))
+
+@receiver(post_init, sender=RegistrationSettings)
+def remember_badge_settings_state(sender, instance, **kwargs):
+    instance._badge_settings_state = badge_settings_state(instance)
+
+@receiver(post_save, sender=RegistrationSettings)
+def update_badge_numbers_for_settings(sender, instance, **kwargs):
+    # Only when the numbering style or offset changed
+    state = badge_settings_state(instance)
+    if state != instance._badge_settings_state:
+        Registration.all_registrations.filter(
+            convention=instance.convention_id,
+        ).refresh_badge_numbers()
+    instance._badge_settings_state = state
+
+# Retire catalog snapshots when anything they were built from changes
+CATALOG_CONVENTION_PATHS = {
+    get_convention_model(): lambda instance: instance.pk,
+    RegistrationLevel: lambda instance: instance.convention_id,
+    DealerRegistrationLevel: lambda instance: instance.convention_id,
+    RegistrationLevelPrice: lambda instance: instance.registration_level.convention_id,
+    RegistrationUpgrade: lambda instance: instance.current_registration_level.convention_id,
+    RegistrationUpgradePrice: lambda instance:
+        instance.registration_upgrade.current_registration_level.convention_id,
+}
+
+def invalidate_convention_catalog(sender, instance, **kwargs):
+    try:
+        convention_id = CATALOG_CONVENTION_PATHS[sender](instance)
+    except ObjectDoesNotExist:
+        # Parent already gone in a cascade, play it safe
+        convention_id = None
+    invalidate_catalog(convention_id)
+
+def invalidate_all_catalogs(sender, **kwargs):
+    invalidate_catalog()
+
+for catalog_model in CATALOG_CONVENTION_PATHS:
+    post_save.connect(invalidate_convention_catalog, sender=catalog_model)
+    post_delete.connect(invalidate_convention_catalog, sender=catalog_model)
+for catalog_model in (PaymentMethod, ShirtSize):
+    post_save.connect(invalidate_all_catalogs, sender=catalog_model)
+    post_delete.connect(invalidate_all_catalogs, sender=catalog_model)
+
+# Likewise the cached current convention and its settings
+@receiver(post_save, sender=get_convention_model())
+@receiver(post_delete, sender=get_convention_model())
+@receiver(post_save, sender=RegistrationSettings)
+@receiver(post_delete, sender=RegistrationSettings)
+def invalidate_cached_convention(sender, **kwargs):
+    invalidate_current_convention()
+
+# Make the sized copies of a new or replaced avatar in the background
+def avatar_state(registration):
+    avatar = registration.__dict__.get('avatar')
+    return getattr(avatar, 'name', avatar) or None
+
+@receiver(post_init, sender=Registration)
+def remember_avatar_state(sender, instance, **kwargs):
+    instance._avatar_state = avatar_state(instance)
+    instance._avatar_new = False
+
+@receiver(pre_save, sender=Registration)
+def remember_new_avatar(sender, instance, **kwargs):
+    # A newly assigned file takes a reference on its stored blob when
+    # saved, even when it's the same image as before
+    avatar = instance.__dict__.get('avatar')
+    if isinstance(avatar, File) and not getattr(avatar, '_committed', False):
+        instance._avatar_new = True
 
 @receiver(post_save, sender=Registration)
-def check_registration_holds(sender, **kwargs):
-    # Check new registrations against the list of holds
-    ci_fields = ['first_name', 'last_name', 'badge_name', 'email',
-                 'address', 'city', 'state', 'postal_code']
-    exact_fields = ['birthday', 'ip']
+def queue_avatar_derivatives(sender, instance, **kwargs):
+    state = avatar_state(instance)
+    if 'avatar' in instance.__dict__ and state != instance._avatar_state:
+        Job.objects.enqueue('avatar_derivatives', instance.id)
+    if instance._avatar_state and (state != instance._avatar_state or instance._avatar_new):
+        # Give back the replaced avatar's reference
+        instance.avatar.storage.delete(instance._avatar_state)
+    instance._avatar_state = state
+    instance._avatar_new = False
 
+@receiver(post_delete, sender=Registration)
+def release_avatar(sender, instance, **kwargs):
+    storage = instance.avatar.storage
+    if instance.avatar:
+        storage.delete(instance.avatar.name)
+    for name in instance.avatar_derivative_names().values():
+        storage.delete(name)
+
+@receiver(post_save, sender=Registration)
+def queue_registration_hold_check(sender, instance, **kwargs):
+    # Check new registrations against the list of holds, in the
+    # background once they're committed
     if kwargs.get('created', False):
-        registration = kwargs.get('instance')
-        holds = RegistrationHold.objects.all()
-        matched = []
-        notes_addition = ''
-        private_notes_addition = ''
-        private_check_in = False
-        notify_registration_group = False
-        notify_board_group = False
-
-        # XXX: Any more efficient way of doing this?
-        for hold in holds:
-            any_matched = False
-            all_matched = True
-            for field in ci_fields:
-                if getattr(hold, field):
-                    if getattr(registration, field).lower() == getattr(hold, field).lower():
-                        any_matched = True
-                    else:
-                        all_matched = False
-            for field in exact_fields:
-                if getattr(hold, field):
-                    if getattr(registration, field) == getattr(hold, field):
-                        any_matched = True
-                    else:
-                        all_matched = False
-
-            if any_matched and all_matched:
-                if hold.notes_addition:
-                    notes_addition += 'Registration notes:\n{}\n\n'.format(hold.notes_addition)
-                if hold.private_notes_addition:
-                    private_notes_addition += 'Registration flagged:\n{}\n\n'.format(hold.private_notes_addition)
-                if hold.private_check_in:
-                    private_check_in = True
-                matched.append(hold)
-                if hold.notify_registration_group:
-                    notify_registration_group = True
-                if hold.notify_board_group:
-                    notify_board_group = True
-
-        # Look for duplicates matching last name, and either first name or birthday
-        for other_reg in Registration.objects.exclude(pk=registration.pk).filter(
-            Q(last_name=registration.last_name),
-            Q(first_name=registration.first_name) | Q(birthday=registration.birthday)
-        ):
-            duplicate_note = 'Possible duplicate registration received, matching:\n{id} {external_id}\n{last_name} and {first_name} or {birthday}\n\n'.format(
-                id=other_reg.id,
-                external_id=other_reg.external_id,
-                badge_name=other_reg.badge_name,
-                last_name=other_reg.last_name,
-                first_name=other_reg.first_name,
-                birthday=other_reg.birthday,
-            )
-            notes_addition += duplicate_note
-            matched.append(FakeHold(duplicate_note))
-            notify_registration_group = True
-
-        if matched:
-            notes = registration.notes or ''
-            registration.notes = notes + notes_addition
-            private_notes = registration.private_notes or ''
-            registration.private_notes = private_notes + private_notes_addition
-            if not registration.private_check_in and private_check_in:
-                registration.private_check_in = True
-            registration.save()
-
-            notification_list = []
-            if notify_registration_group:
-                notification_list.append('registration@yourconvention.org')
-            if notify_board_group:
-                notification_list.append('board@yourconvention.org')
-
-            if notification_list:
-                c = {
-                    'registration': registration,
-                    'holds': matched,
-                }
-                email_subject = loader.render_to_string(
-                    'registration/held_registration_subject.txt', c
-                )
-                # Email subject *must not* contain newlines
-                email_subject = ''.join(email_subject.splitlines())
-                email_body = loader.render_to_string(
-                    'registration/held_registration_body.txt', c
-                )
-                send_mail(email_subject, email_body,
-                          'registration@yourconvention.org',
-                          notification_list, fail_silently=True)
-
-
-class FakeHold(object):
-    notes_addition = ''
-
-    def __init__(self, notes_addition):
-        self.notes_addition = notes_addition
+        Job.objects.enqueue('check_holds', instance.id)
@@ -0,0 +1,85 @@
+from django.core.files.storage import FileSystemStorage
+from django.db import transaction
+from django.utils.deconstruct import deconstructible
+
+import hashlib
+import os
+
+
+@deconstructible
+class AvatarStorage(FileSystemStorage):
+    """
+    Keeps each distinct avatar image once, named for a hash of its
+    content, so storing a duplicate writes nothing. Every save() takes
+    a reference on the file, kept as an AvatarBlob, and every delete()
+    gives one back; the file itself goes once giving back the last
+    reference is committed. Files stored before this, which have no
+    AvatarBlob, are deleted outright.
+    """
+
+    def _save(self, name, content):
+        from .models import AvatarBlob
+
+        digest = hashlib.sha256()
+        for chunk in content.chunks():
+            digest.update(chunk)
+        digest = digest.hexdigest()
+        extension = os.path.splitext(name)[1].lower()
+        with transaction.atomic():
+            name = AvatarBlob.objects.acquire(digest, 'avatars/{0}/{1}{2}'.format(digest[:2], digest, extension),
+                                              content.size)
+            if not self.exists(name):
+                saved = super(AvatarStorage, self)._save(name, content)
+                if saved != name:
+                    # Written meanwhile by someone else
+                    super(AvatarStorage, self).delete(saved)
+        return name
+
+    def delete(self, name):
+        from .models import AvatarBlob
+
+        def remove():
+            # Unless it was stored again after the release
+            if not AvatarBlob.objects.filter(name=name).exists():
+                super(AvatarStorage, self).delete(name)
+
+        with transaction.atomic():
+            if AvatarBlob.objects.release(name):
+                # A rollback would bring the reference back, so keep the file until then
+                transaction.on_commit(remove)
+
+
+avatar_storage = AvatarStorage()
+
+
+def promote(field_file, name):
+    """
+    Move the file behind field_file over to another model, which should
+    store it under the returned name, and leave field_file empty. Under
+    AvatarStorage the file and its reference are handed over as they
+    are, on other file system storage it's hard linked as name, and
+    anywhere else it's copied. The original is only deleted once the
+    transaction commits, so a rollback still finds it.
+    """
+    from .models import AvatarBlob
+
+    storage = field_file.storage
+    current = field_file.name
+    if isinstance(storage, AvatarStorage) and AvatarBlob.objects.filter(name=current).exists():
+        field_file.name = None
+        return current
+    promoted = None
+    if isinstance(storage, FileSystemStorage):
+        promoted = storage.get_available_name(name)
+        os.makedirs(os.path.dirname(storage.path(promoted)), exist_ok=True)
+        try:
+            os.link(storage.path(current), storage.path(promoted))
+        except OSError:
+            # Across file systems, or taken meanwhile
+            promoted = None
+    if promoted is None:
+        with storage.open(current) as content:
+            promoted = storage.save(name, content)
+    transaction.on_commit(lambda: storage.delete(current))
+    field_file.name = None
+    return promoted
@@ -1,24 +1,44 @@
-from django.test import TestCase
+from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 
 from datetime import timedelta
+from decimal import Decimal
 from django.conf import settings
+from django.contrib import admin as django_admin
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import Group
 from django.core import mail
 from django.core.cache import cache
 from django.core.exceptions import ValidationError
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection, transaction
 from django.urls import reverse
 from django.utils import timezone
-from io import BytesIO
+from io import BytesIO, StringIO
 from unittest import mock
 from PIL import Image
+import json
 import random
 import re
+import shutil
+import smtplib
+import tempfile
 
 from convention.tests import create_test_convention
 
 from . import models
-from .utils import simple_feistel, stringify_integer
+from .admin import JobAdmin, OutboxMessageAdmin, RegistrationAdmin
+from .avatars import (AVATAR_DERIVATIVES, DERIVATIVE_EXTENSION, STORED_AVATAR_SIZE,
+                      check_avatar, crop_avatar, open_avatar, render_thumbnail)
+from .catalog import (CONVENTION_GENERATION_KEY, CURRENT_CONVENTION_GENERATION_KEY, get_catalog,
+                      get_current_convention, get_current_settings)
+from .gateways import FakeGateway, StripeGateway, get_gateway
+from .storage import AvatarStorage
+from .utils import simple_feistel, stringify_integer, AvatarError, PaymentError, SoldOut
 
 # TODO: Form tests
 
@@ -57,6 +77,11 @@ def create_test_registration(registration_level, **kwargs):
         **defaults
     )
 
+def run_workers():
+    # Do what the run_jobs and deliver_mail workers would in the background
+    models.Job.objects.run_pending()
+    models.OutboxMessage.objects.deliver()
+
 def create_test_registrationlevels(convention, names=['basic', 'sponsor', 'supersponsor']):
     levels = {}
     seq = 0
@@ -168,13 +193,20 @@ class RegistrationHoldModelTest(TestCase):
         self.convention = create_test_convention()
         self.levels = create_test_registrationlevels(self.convention)
 
+    def register(self, **kwargs):
+        # Holds are checked by a background job after the registration is saved
+        registration = create_test_registration(self.levels['sponsor'], **kwargs)
+        run_workers()
+        registration.refresh_from_db()
+        return registration
+
     def test_flag_badgename(self):
         # No holds...
-        create_test_registration(self.levels['sponsor'], badge_name='Drykath')
+        self.register(badge_name='Drykath')
         self.assertEqual(len(mail.outbox), 0)
 
         hold = models.RegistrationHold.objects.create(badge_name='DRYKATH', notes_addition='Test', notify_registration_group=True)
-        create_test_registration(self.levels['sponsor'], badge_name='Drykath')
+        self.register(badge_name='Drykath')
         self.assertEqual(len(mail.outbox), 1)
         self.assertEqual(mail.outbox[0].to, ['registration@yourconvention.org'])
 
@@ -183,10 +215,10 @@ class RegistrationHoldModelTest(TestCase):
     def test_flag_realname(self):
         hold = models.RegistrationHold.objects.create(first_name='DRYKATH', last_name='DRAGON', notes_addition='Test', notify_registration_group=True)
         # All specified fields must match, if some don't, don't flag registration
-        self.reg = create_test_registration(self.levels['sponsor'], first_name='Drykath', last_name='Different')
+        self.reg = self.register(first_name='Drykath', last_name='Different')
         self.assertEqual(len(mail.outbox), 0)
         self.assertEqual(self.reg.notes, None)
-        self.reg = create_test_registration(self.levels['sponsor'], first_name='Drykath', last_name='Dragon')
+        self.reg = self.register(first_name='Drykath', last_name='Dragon')
         self.assertEqual(len(mail.outbox), 1)
         self.assertTrue('Test' in self.reg.notes)
 
@@ -196,38 +228,771 @@ class RegistrationHoldModelTest(TestCase):
         birthday = (timezone.now() - timedelta(days=18*366)).date()
         models.RegistrationHold.objects.create(birthday=birthday, notes_addition='Test', notify_registration_group=True, notify_board_group=True)
         # All specified fields must match, if some don't, don't flag registration
-        create_test_registration(self.levels['sponsor'], birthday=birthday)
+        self.register(birthday=birthday)
         self.assertEqual(len(mail.outbox), 1)
         self.assertTrue('registration@yourconvention.org' in mail.outbox[0].to)
         self.assertTrue('board@yourconvention.org' in mail.outbox[0].to)
 
     def test_flag_private(self):
         models.RegistrationHold.objects.create(first_name='DRYKATH', last_name='DRAGON', private_notes_addition='Test', private_check_in=True)
-        self.reg = create_test_registration(self.levels['sponsor'], first_name='Drykath', last_name='Dragon')
+        self.reg = self.register(first_name='Drykath', last_name='Dragon')
         self.assertFalse(self.reg.notes)
         self.assertTrue('Test' in self.reg.private_notes)
         self.assertTrue(self.reg.private_check_in)
 
     def test_flag_duplicate_detection(self):
-        self.reg = create_test_registration(self.levels['sponsor'], first_name='Drykath', last_name='Dragon',
+        self.reg = self.register(first_name='Drykath', last_name='Dragon',
             birthday=(timezone.now() - timedelta(days=18*366)).date())
         self.reg.status = 1
         self.reg.save()
         self.assertEqual(self.reg.notes, None)
 
         # Different enough doesn't flag
-        self.reg = create_test_registration(self.levels['sponsor'], first_name='Drykath', last_name='Different')
+        self.reg = self.register(first_name='Drykath', last_name='Different')
         self.assertEqual(self.reg.notes, None)
 
         # If birthday and last_name match, flag it
-        self.reg = create_test_registration(self.levels['sponsor'], first_name='Foobar', last_name='Dragon',
+        self.reg = self.register(first_name='Foobar', last_name='Dragon',
             birthday=(timezone.now() - timedelta(days=18*366)).date())
         self.assertTrue('duplicate registration' in self.reg.notes)
         # Or if first_name and last_name match, flag it
-        self.reg = create_test_registration(self.levels['sponsor'], first_name='Drykath', last_name='Dragon',
+        self.reg = self.register(first_name='Drykath', last_name='Dragon',
             birthday=(timezone.now() - timedelta(days=19*366)).date())
         self.assertTrue('duplicate registration' in self.reg.notes)
 
+    def test_hold_index_follows_edits(self):
+        hold = models.RegistrationHold.objects.create(first_name='DRYKATH', last_name='DRAGON', notes_addition='Test')
+        self.assertEqual(hold.keys.count(), 2)
+        reg = self.register(first_name='Drykath', last_name='Dragon', badge_name='Other')
+        self.assertEqual(list(models.RegistrationHold.objects.matching(reg)), [hold])
+
+        # Narrowing the hold means the registration no longer matches all of it
+        hold.email = 'someone@example.com'
+        hold.save()
+        self.assertEqual(hold.keys.count(), 3)
+        self.assertEqual(list(models.RegistrationHold.objects.matching(reg)), [])
+
+        hold.first_name = hold.last_name = None
+        hold.email = 'DRYKATH@example.com'
+        hold.save()
+        self.assertEqual(list(models.RegistrationHold.objects.matching(reg)), [hold])
+
+        hold.delete()
+        self.assertEqual(models.RegistrationHoldKey.objects.count(), 0)
+
+    def test_hold_rescan(self):
+        earlier = self.register(badge_name='Drykath')
+        other = self.register(badge_name='Other', first_name='Other')
+        self.assertEqual(len(mail.outbox), 0)
+
+        # A new hold catches registrations made before it
+        hold = models.RegistrationHold.objects.create(badge_name='DRYKATH', notes_addition='Test',
+                                                      private_check_in=True, notify_registration_group=True)
+        run_workers()
+        earlier.refresh_from_db()
+        self.assertTrue('Test' in earlier.notes)
+        self.assertTrue(earlier.private_check_in)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertTrue(earlier.first_name in mail.outbox[0].body)
+
+        # Registrations flagged since, or already, aren't flagged again
+        later = self.register(badge_name='drykath', first_name='Later')
+        self.assertEqual(len(mail.outbox), 2)
+        hold.notes_addition = 'Changed'
+        hold.save()
+        run_workers()
+        earlier.refresh_from_db()
+        later.refresh_from_db()
+        self.assertEqual(earlier.notes.count('Registration notes'), 1)
+        self.assertEqual(later.notes.count('Registration notes'), 1)
+        self.assertEqual(len(mail.outbox), 2)
+        other.refresh_from_db()
+        self.assertEqual(other.notes, None)
+
+    def test_hold_check_retried(self):
+        models.RegistrationHold.objects.create(badge_name='DRYKATH', notes_addition='Test', notify_registration_group=True)
+        # Just the registration's own check, not the hold's rescan
+        models.Job.objects.all().delete()
+        # Nothing happens until the worker picks up the job
+        reg = create_test_registration(self.levels['sponsor'], badge_name='Drykath')
+        self.assertEqual(reg.notes, None)
+        self.assertEqual(models.OutboxMessage.objects.count(), 0)
+
+        with mock.patch('registration.models.RegistrationHoldQuerySet.matching', side_effect=OSError('Lost the database')):
+            models.Job.objects.run_pending()
+        job = models.Job.objects.get(kind='check_holds')
+        self.assertEqual(job.status, 0)
+        self.assertEqual(job.attempts, 1)
+        self.assertIn('Lost the database', job.last_error)
+        # Nothing saved from the failed attempt, and not due yet
+        reg.refresh_from_db()
+        self.assertEqual(reg.notes, None)
+        self.assertEqual(models.Job.objects.run_pending(), 0)
+
+        models.Job.objects.filter(pk=job.pk).update(run_after=timezone.now())
+        self.assertEqual(models.Job.objects.run_pending(), 1)
+        reg.refresh_from_db()
+        self.assertEqual(reg.notes.count('Registration notes'), 1)
+        self.assertEqual(models.OutboxMessage.objects.count(), 1)
+        self.assertEqual(models.Job.objects.get(pk=job.pk).status, 1)
+
+    def test_retry_failed_job(self):
+        job = models.Job.objects.create(kind='check_holds', object_id=0, status=2,
+                                        attempts=models.Job.MAX_ATTEMPTS, last_error='OSError: Lost the database')
+        job_admin = JobAdmin(models.Job, django_admin.site)
+        with mock.patch.object(job_admin, 'message_user'):
+            job_admin.retry_jobs(None, models.Job.objects.filter(pk=job.pk))
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts, job.last_error), (0, 0, None))
+
+    def test_flag_bulk_create(self):
+        models.RegistrationHold.objects.create(badge_name='DRYKATH', notes_addition='Test', notify_registration_group=True)
+        shirt_size = create_test_shirtsizes()['small']
+        birthday = (timezone.now() - timedelta(days=18*366)).date()
+        registrations = models.Registration.all_registrations.bulk_create([
+            models.Registration(registration_level=self.levels['sponsor'], first_name=first_name,
+                                last_name=first_name, badge_name=first_name, email='', birthday=birthday,
+                                shirt_size=shirt_size, status=1, ip='127.0.0.1')
+            for first_name in ['Drykath', 'Foobar']
+        ])
+        run_workers()
+
+        # Held registration flagged and notified, same as one at a time
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertTrue('Test' in models.Registration.all_registrations.get(badge_name='Drykath').notes)
+        self.assertEqual(models.Registration.all_registrations.get(badge_name='Foobar').notes, None)
+
+        for reg in registrations:
+            self.assertEqual(reg.external_id, stringify_integer(simple_feistel(reg.id)))
+            self.assertEqual(reg.convention_id, self.convention.id)
+            self.assertEqual(reg.amount_due, self.levels['sponsor'].price)
+        self.assertEqual(models.RegistrationLevelInventory.objects.get(level=self.levels['sponsor']).sold, 2)
+
+
+class DuplicateClusterTest(TestCase):
+    def setUp(self):
+        self.convention = create_test_convention()
+        self.levels = create_test_registrationlevels(self.convention)
+        self.birthday = (timezone.now() - timedelta(days=18*366)).date()
+
+    def test_duplicate_keys(self):
+        reg = create_test_registration(self.levels['sponsor'], first_name='José', last_name="O'Brien",
+                                       email='Jose+con@example.com')
+        self.assertEqual(reg.name_key, 'obrien:j')
+        self.assertEqual(reg.birthday_key, 'obrien:{}'.format(self.birthday.isoformat()))
+        self.assertEqual(reg.email_key, 'jose')
+
+        # Kept current as the registration changes
+        reg.last_name = 'Dragon'
+        reg.save()
+        reg.refresh_from_db()
+        self.assertEqual(reg.name_key, 'dragon:j')
+
+    def test_sweep(self):
+        first = create_test_registration(self.levels['sponsor'], first_name='Drykath', last_name='Dragon',
+                                         email='a@example.com', birthday=self.birthday)
+        # Same last name and birthday, first name differs
+        second = create_test_registration(self.levels['basic'], first_name='Dry', last_name='DRAGON',
+                                          email='b@example.com', birthday=self.birthday)
+        # Same mailbox and last name, nothing else
+        third = create_test_registration(self.levels['basic'], first_name='Other', last_name='Dragon',
+                                         email='a+second@example.org', birthday=self.birthday - timedelta(days=1))
+        # Same first initial only
+        create_test_registration(self.levels['basic'], first_name='Dave', last_name='Dragon',
+                                 email='c@example.com', birthday=self.birthday - timedelta(days=2))
+
+        clusters = models.DuplicateCluster.objects.sweep(self.convention)
+        self.assertEqual(len(clusters), 1)
+        self.assertEqual(set(clusters[0].members()), {first, second, third})
+
+        # Reviewed clusters survive the next sweep and aren't found again
+        clusters[0].reviewed = True
+        clusters[0].save()
+        self.assertEqual(models.DuplicateCluster.objects.sweep(self.convention), [])
+        self.assertEqual(models.DuplicateCluster.objects.count(), 1)
+
+        out = StringIO()
+        call_command('find_duplicates', stdout=out)
+        self.assertIn('Found 0 cluster', out.getvalue())
+
+
+class OutboxMessageTest(TestCase):
+    def test_deliver(self):
+        for n in range(3):
+            models.OutboxMessage.objects.queue('Subject {}'.format(n), 'Body', 'from@example.com', ['to@example.com'])
+        self.assertEqual(len(mail.outbox), 0)
+
+        stats = models.OutboxMessage.objects.deliver(batch_size=2)
+        self.assertEqual(stats, {'sent': 3, 'retrying': 0, 'failed': 0})
+        self.assertEqual(len(mail.outbox), 3)
+        self.assertEqual(models.OutboxMessage.objects.filter(status=1).count(), 3)
+
+    @override_settings(EMAIL_BACKEND='django.core.mail.backends.smtp.EmailBackend')
+    def test_deliver_connections(self):
+        messages = [
+            models.OutboxMessage.objects.queue('Subject {}'.format(n), 'Body', 'from@example.com', ['to@example.com'])
+            for n in range(5)
+        ]
+        with mock.patch('smtplib.SMTP') as smtp:
+            stats = models.OutboxMessage.objects.deliver(batch_size=2)
+        self.assertEqual(stats['sent'], 5)
+        # One connection for the lot
+        self.assertEqual(smtp.call_count, 1)
+        self.assertEqual(smtp.return_value.sendmail.call_count, 5)
+
+        # And a fresh one after a failure
+        models.OutboxMessage.objects.filter(pk__in=[message.pk for message in messages]).update(status=0)
+        with mock.patch('smtplib.SMTP') as smtp:
+            smtp.return_value.sendmail.side_effect = [None, smtplib.SMTPServerDisconnected('Gone'), None, None, None]
+            stats = models.OutboxMessage.objects.deliver(batch_size=2)
+        self.assertEqual(stats, {'sent': 4, 'retrying': 1, 'failed': 0})
+        self.assertEqual(smtp.call_count, 2)
+
+    def test_claimed_batches(self):
+        for n in range(2):
+            models.OutboxMessage.objects.queue('Subject {}'.format(n), 'Body', 'from@example.com', ['to@example.com'])
+        sent = []
+
+        def send(*args, **kwargs):
+            # Each message is saved as sent before the next goes out
+            sent.append(models.OutboxMessage.objects.filter(status=1).count())
+            # and the rest of the batch stays claimed from other workers
+            self.assertFalse(models.OutboxMessage.objects.due().exists())
+            return 1
+        with mock.patch('django.core.mail.backends.locmem.EmailBackend.send_messages', side_effect=send):
+            stats = models.OutboxMessage.objects.deliver()
+        self.assertEqual(stats['sent'], 2)
+        self.assertEqual(sent, [0, 1])
+
+    def test_retry(self):
+        message = models.OutboxMessage.objects.queue('Subject', 'Body', 'from@example.com', ['to@example.com'])
+        with mock.patch('django.core.mail.backends.locmem.EmailBackend.send_messages', side_effect=OSError('Refused')):
+            stats = models.OutboxMessage.objects.deliver()
+        self.assertEqual(stats['retrying'], 1)
+        message.refresh_from_db()
+        self.assertEqual(message.attempts, 1)
+        self.assertIn('Refused', message.last_error)
+        self.assertGreater(message.send_after, timezone.now())
+
+        # Not due again until the backoff passes
+        self.assertEqual(models.OutboxMessage.objects.deliver()['sent'], 0)
+        models.OutboxMessage.objects.filter(pk=message.pk).update(send_after=timezone.now())
+        out = StringIO()
+        call_command('deliver_mail', '--once', stdout=out)
+        self.assertIn('Sent 1', out.getvalue())
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_retry_failed_message(self):
+        message = models.OutboxMessage.objects.queue('Subject', 'Body', 'from@example.com', ['to@example.com'])
+        models.OutboxMessage.objects.filter(pk=message.pk).update(
+            status=2, attempts=models.OutboxMessage.MAX_ATTEMPTS, last_error='OSError: Refused')
+        outbox_admin = OutboxMessageAdmin(models.OutboxMessage, django_admin.site)
+        with mock.patch.object(outbox_admin, 'message_user'):
+            outbox_admin.retry_messages(None, models.OutboxMessage.objects.filter(pk=message.pk))
+        message.refresh_from_db()
+        self.assertEqual((message.status, message.attempts, message.last_error), (0, 0, None))
+        self.assertEqual(models.OutboxMessage.objects.deliver()['sent'], 1)
+
+
+class AnnouncementTest(TestCase):
+    def setUp(self):
+        self.convention = create_test_convention()
+        self.levels = create_test_registrationlevels(self.convention)
+        self.registrations = [
+            create_test_registration(self.levels['sponsor'], badge_name=badge_name, email_me=True, status=1)
+            for badge_name in ['One', 'Two', 'Three']
+        ]
+        # Didn't opt in, or hasn't paid
+        create_test_registration(self.levels['sponsor'], badge_name='Four', status=1)
+        create_test_registration(self.levels['sponsor'], badge_name='Five', email_me=True)
+        self.announcement = models.Announcement.objects.create(
+            convention=self.convention,
+            subject='News for {{ registration.badge_name }}',
+            body='Hello {{ registration.first_name }}, see you at {{ convention.name }}',
+            status=1,
+        )
+
+    def test_send(self):
+        call_command('send_announcements', '--rate', '0', stdout=StringIO())
+        self.assertEqual([message.subject for message in mail.outbox], ['News for One', 'News for Two', 'News for Three'])
+        self.assertIn(self.convention.name, mail.outbox[0].body)
+        self.announcement.refresh_from_db()
+        self.assertEqual(self.announcement.status, 3)
+        self.assertEqual(self.announcement.sent_count, 3)
+
+    def test_resume(self):
+        send = mail.EmailMessage.send
+        sent = []
+
+        def interrupted(message, *args, **kwargs):
+            if len(sent) == 2:
+                raise KeyboardInterrupt
+            sent.append(message)
+            return send(message, *args, **kwargs)
+
+        with mock.patch.object(mail.EmailMessage, 'send', interrupted):
+            with self.assertRaises(KeyboardInterrupt):
+                self.announcement.send(batch_size=2)
+        self.announcement.refresh_from_db()
+        self.assertEqual(self.announcement.status, 2)
+        self.assertEqual(self.announcement.last_registration_id, self.registrations[1].id)
+
+        # Picks up after the checkpoint
+        call_command('send_announcements', '--rate', '0', stdout=StringIO())
+        self.assertEqual([message.subject for message in mail.outbox], ['News for One', 'News for Two', 'News for Three'])
+        self.announcement.refresh_from_db()
+        self.assertEqual(self.announcement.sent_count, 3)
+
+    def test_claimed(self):
+        # Another run holds it
+        models.Announcement.objects.filter(pk=self.announcement.pk).update(
+            status=2, lease_expires=timezone.now() + timedelta(minutes=1))
+        out = StringIO()
+        call_command('send_announcements', '--rate', '0', stdout=out)
+        self.assertIn('Already being sent', out.getvalue())
+        self.assertEqual(len(mail.outbox), 0)
+
+        # Until its lease lapses
+        models.Announcement.objects.filter(pk=self.announcement.pk).update(lease_expires=timezone.now())
+        call_command('send_announcements', '--rate', '0', stdout=StringIO())
+        self.assertEqual(len(mail.outbox), 3)
+        self.announcement.refresh_from_db()
+        self.assertEqual((self.announcement.status, self.announcement.lease_expires), (3, None))
+
+    def test_server_down(self):
+        with mock.patch.object(mail.EmailMessage, 'send', side_effect=smtplib.SMTPServerDisconnected('Gone')):
+            self.assertFalse(self.announcement.send(rate=0))
+        self.announcement.refresh_from_db()
+        self.assertEqual(self.announcement.status, 2)
+        self.assertEqual((self.announcement.last_registration_id, self.announcement.failed_count), (0, 0))
+        self.assertIn('Gone', self.announcement.last_error)
+
+        call_command('send_announcements', '--rate', '0', stdout=StringIO())
+        self.assertEqual(len(mail.outbox), 3)
+
+    @override_settings(EMAIL_BACKEND='django.core.mail.backends.smtp.EmailBackend')
+    def test_connections(self):
+        with mock.patch('smtplib.SMTP') as smtp:
+            self.assertTrue(self.announcement.send(rate=0))
+        # One connection for everyone
+        self.assertEqual(smtp.call_count, 1)
+        self.assertEqual(smtp.return_value.sendmail.call_count, 3)
+
+        # And a fresh one after a failure
+        self.announcement.pk = None
+        self.announcement.status = 1
+        self.announcement.last_registration_id = self.announcement.sent_count = 0
+        self.announcement.save()
+        with mock.patch('smtplib.SMTP') as smtp:
+            smtp.return_value.sendmail.side_effect = [None, smtplib.SMTPRecipientsRefused({}), None]
+            self.assertTrue(self.announcement.send(rate=0))
+        self.assertEqual(smtp.call_count, 2)
+        self.assertEqual((self.announcement.sent_count, self.announcement.failed_count), (2, 1))
+
+    def test_failures_in_a_row(self):
+        send = mail.EmailMessage.send
+        refused = smtplib.SMTPRecipientsRefused({})
+
+        def failing(message, *args, **kwargs):
+            if message.subject != 'News for Three':
+                raise refused
+            return send(message, *args, **kwargs)
+
+        with mock.patch.object(models.Announcement, 'MAX_FAILURES_IN_A_ROW', 2), \
+                mock.patch.object(mail.EmailMessage, 'send', failing):
+            self.assertFalse(self.announcement.send(rate=0))
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(self.announcement.last_registration_id, 0)
+
+        # Fewer than that are put down to the recipients
+        def first_fails(message, *args, **kwargs):
+            if message.subject == 'News for One':
+                raise refused
+            return send(message, *args, **kwargs)
+
+        with mock.patch.object(mail.EmailMessage, 'send', first_fails):
+            self.assertTrue(self.announcement.send(rate=0))
+        self.announcement.refresh_from_db()
+        self.assertEqual((self.announcement.sent_count, self.announcement.failed_count), (2, 1))
+
+
+class PaymentGatewayTest(TestCase):
+    def test_default_gateway(self):
+        with self.settings(STRIPE_SECRET_KEY='sk_test'):
+            gateway = get_gateway()
+        self.assertIsInstance(gateway, StripeGateway)
+        self.assertEqual(gateway.secret_key, 'sk_test')
+        self.assertEqual(get_gateway(secret_key='sk_convention').secret_key, 'sk_convention')
+
+    @override_settings(REGISTRATION_PAYMENT_GATEWAY='registration.gateways.FakeGateway',
+                       REGISTRATION_PAYMENT_GATEWAY_OPTIONS={'failure_rate': 1})
+    def test_fake_gateway(self):
+        gateway = get_gateway()
+        self.assertIsInstance(gateway, FakeGateway)
+        with self.assertRaises(PaymentError):
+            gateway.charge(Decimal('10.00'), 'tok', 'Always declined')
+
+        gateway = get_gateway(failure_rate=0)
+        charge = gateway.charge(Decimal('10.00'), 'tok', 'Test')
+        self.assertEqual(gateway.retrieve(charge.id).amount, Decimal('10.00'))
+        gateway.refund(charge.id)
+        self.assertTrue(gateway.retrieve(charge.id).refunded)
+        with self.assertRaises(PaymentError):
+            gateway.refund(charge.id)
+        with self.assertRaises(PaymentError):
+            gateway.retrieve('fake_ch_missing')
+
+        # Refunds work from another process, as refund_payments runs in,
+        # even one that doesn't share the cache
+        charge = gateway.charge(Decimal('10.00'), 'tok', 'Test')
+        cache.clear()
+        other = get_gateway(failure_rate=0)
+        other.refund(charge.id)
+        self.assertTrue(other.retrieve(charge.id).refunded)
+        with self.assertRaises(PaymentError):
+            other.refund(charge.id)
+
+
+@override_settings(REGISTRATION_PAYMENT_GATEWAY='registration.gateways.FakeGateway')
+class RefundPaymentsTest(TestCase):
+    def setUp(self):
+        self.convention = create_test_convention()
+        self.levels = create_test_registrationlevels(self.convention)
+        self.card = create_test_paymentmethod('Card', is_credit=True)
+        self.cash = create_test_paymentmethod('Cash')
+        self.requested = timezone.now() - timedelta(days=5)
+
+    def request_refund(self, method, charge_id=None):
+        reg = create_test_registration(self.levels['basic'], status=1)
+        if charge_id is None and method.is_credit:
+            charge_id = get_gateway().charge(self.levels['basic'].price, 'tok', 'Test').id
+        return models.Payment.objects.create(registration=reg, payment_method=method,
+                                             payment_amount=self.levels['basic'].price,
+                                             payment_extra=charge_id, payment_state=2,
+                                             refund_requested=self.requested, refund_reason='Level cancelled')
+
+    def test_refund_payments(self):
+        refunds = [self.request_refund(self.card) for i in range(5)]
+        missing = self.request_refund(self.card, 'fake_ch_missing')
+        cash = self.request_refund(self.cash)
+
+        out = StringIO()
+        call_command('refund_payments', dry_run=True, stdout=out, stderr=StringIO())
+        self.assertTrue('would be processed' in out.getvalue())
+        self.assertEqual(models.Payment.objects.filter(payment_state=2).count(), 7)
+        self.assertFalse(get_gateway().retrieve(refunds[0].payment_extra).refunded)
+        self.assertEqual(models.OutboxMessage.objects.count(), 0)
+
+        err = StringIO()
+        call_command('refund_payments', workers=3, rate=1000, stderr=err)
+        for payment in refunds:
+            payment.refresh_from_db()
+            self.assertEqual(payment.payment_state, 3)
+            self.assertTrue(get_gateway().retrieve(payment.payment_extra).refunded)
+        self.assertEqual(models.Registration.all_registrations.get(pk=refunds[0].registration_id).amount_paid, 0)
+        self.assertEqual(models.Payment.objects.get(pk=missing.pk).payment_state, 2)
+        self.assertEqual(models.Payment.objects.get(pk=cash.pk).payment_state, 2)
+        self.assertTrue('payment ID {}'.format(missing.pk) in err.getvalue())
+        report = models.OutboxMessage.objects.get()
+        self.assertEqual(report.body.count('reason: Level cancelled'), 7)
+
+    def test_resume_after_crash(self):
+        payment = self.request_refund(self.card)
+        models.Payment.objects.process_refunds(timezone.now())
+        # As if the run died between the gateway and saving
+        models.Payment.objects.filter(pk=payment.pk).update(payment_state=2)
+        results = models.Payment.objects.process_refunds(timezone.now())
+        self.assertEqual(results['errors'], [])
+        self.assertEqual(results['refunded'], [payment])
+        self.assertEqual(models.Payment.objects.get(pk=payment.pk).payment_state, 3)
+
+    def test_report_query_count(self):
+        for i in range(5):
+            self.request_refund(self.cash)
+        with self.assertNumQueries(1):
+            for payment in models.Payment.objects.refunds_requested(timezone.now()):
+                payment.registration.registration_level.title, payment.payment_method.is_credit
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+class AvatarDerivativeTest(TestCase):
+    def setUp(self):
+        self.convention = create_test_convention()
+        self.levels = create_test_registrationlevels(self.convention)
+        self.reg = create_test_registration(self.levels['sponsor'])
+
+    def tearDown(self):
+        shutil.rmtree(settings.MEDIA_ROOT, ignore_errors=True)
+
+    def set_avatar(self, size, color='red'):
+        im_output = BytesIO()
+        Image.new('RGBA', size, color=color).save(im_output, format='png')
+        self.reg.avatar = File(im_output, '{}_avatar.png'.format(self.reg.id))
+        self.reg.save()
+
+    def test_derivatives(self):
+        self.set_avatar((800, 400))
+        # Sized on the fly until the worker gets to it
+        self.assertTrue('/avatar/r/' in self.reg.avatar_preview())
+        run_workers()
+        self.reg.refresh_from_db()
+        names = self.reg.avatar_derivative_names()
+        self.assertEqual(set(names), set(AVATAR_DERIVATIVES))
+        self.assertTrue(self.reg.avatar_urls['checkin'].endswith('.' + DERIVATIVE_EXTENSION))
+        self.assertTrue(self.reg.avatar_urls['preview'] in self.reg.avatar_preview())
+        self.assertEqual(self.reg.avatar_image('checkin').size, (400, 200))
+        self.assertEqual(self.reg.avatar_image('badge').size, (240, 240))
+
+        # A new avatar replaces them
+        with self.captureOnCommitCallbacks(execute=True):
+            self.set_avatar((300, 300), 'blue')
+            run_workers()
+        self.reg.refresh_from_db()
+        self.assertEqual(self.reg.avatar_image('preview').size, (200, 200))
+        for name in names.values():
+            self.assertFalse(self.reg.avatar.storage.exists(name))
+
+    def test_generate_command(self):
+        self.set_avatar((100, 100))
+        models.Job.objects.all().delete()
+        call_command('generate_avatar_derivatives', stdout=StringIO())
+        self.reg.refresh_from_db()
+        self.assertEqual(set(self.reg.avatar_derivative_names()), set(AVATAR_DERIVATIVES))
+        out = StringIO()
+        call_command('generate_avatar_derivatives', stdout=out)
+        self.assertTrue('for 0 avatar(s)' in out.getvalue())
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+class AvatarThumbnailViewTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.convention = create_test_convention()
+        self.levels = create_test_registrationlevels(self.convention)
+        self.reg = create_test_registration(self.levels['sponsor'])
+        im_output = BytesIO()
+        Image.new('RGBA', (500, 500), color='red').save(im_output, format='png')
+        self.reg.avatar = File(im_output, '{}_avatar.png'.format(self.reg.id))
+        self.reg.save()
+        self.url = reverse('avatar_thumbnail', args=['r', self.reg.id, 200, 200])
+
+    def tearDown(self):
+        shutil.rmtree(settings.MEDIA_ROOT, ignore_errors=True)
+
+    def test_conditional_get(self):
+        with mock.patch('registration.avatars.render_thumbnail', wraps=render_thumbnail) as render:
+            response = self.client.get(self.url)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(Image.open(BytesIO(response.content)).size, (200, 200))
+            etag = response['ETag']
+            self.assertTrue(response.has_header('Last-Modified'))
+
+            # Cached, and the browser's copy is good
+            response = self.client.get(self.url)
+            self.assertEqual(response.status_code, 200)
+            response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(render.call_count, 1)
+
+        # A new image means a new tag
+        im_output = BytesIO()
+        Image.new('RGBA', (100, 100), color='blue').save(im_output, format='png')
+        self.reg.avatar = File(im_output, '{}_avatar.png'.format(self.reg.id))
+        self.reg.save()
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_allowed_sizes(self):
+        response = self.client.get(reverse('avatar_thumbnail', args=['r', self.reg.id, 123, 456]))
+        self.assertEqual(response.status_code, 404)
+        with self.settings(REGISTRATION_AVATAR_THUMBNAIL_SIZES=[(123, 456)]):
+            response = self.client.get(reverse('avatar_thumbnail', args=['r', self.reg.id, 123, 456]))
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(self.client.get(self.url).status_code, 404)
+
+    def test_over_budget(self):
+        # An avatar stored before the decoding budget is too large to thumbnail
+        with self.settings(REGISTRATION_AVATAR_MAX_PIXELS=10000):
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 404)
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+class AvatarStorageTest(TestCase):
+    def setUp(self):
+        self.convention = create_test_convention()
+        self.levels = create_test_registrationlevels(self.convention)
+        self.reg = create_test_registration(self.levels['sponsor'])
+
+    def tearDown(self):
+        shutil.rmtree(settings.MEDIA_ROOT, ignore_errors=True)
+
+    def image(self, color='red'):
+        im_output = BytesIO()
+        Image.new('RGBA', (100, 100), color=color).save(im_output, format='png')
+        return im_output
+
+    def test_deduplicated(self):
+        first = models.RegistrationTempAvatar.objects.create(avatar=File(self.image(), 'first.png'))
+        second = models.RegistrationTempAvatar.objects.create(avatar=File(self.image(), 'second.png'))
+        self.assertEqual(first.avatar.name, second.avatar.name)
+        blob = models.AvatarBlob.objects.get()
+        self.assertEqual(blob.references, 2)
+
+        storage = first.avatar.storage
+        with self.captureOnCommitCallbacks(execute=True):
+            first.delete()
+        self.assertTrue(storage.exists(blob.name))
+        with self.captureOnCommitCallbacks(execute=True):
+            second.delete()
+        self.assertFalse(storage.exists(blob.name))
+        self.assertFalse(models.AvatarBlob.objects.exists())
+
+    def test_registration_references(self):
+        temp = models.RegistrationTempAvatar.objects.create(avatar=File(self.image(), 'upload.png'))
+        self.reg.avatar = File(temp.avatar, 'upload.png')
+        self.reg.save()
+        temp.delete()
+        other = create_test_registration(self.levels['sponsor'])
+        other.avatar = File(self.image(), 'other.png')
+        other.save()
+        run_workers()
+        name = self.reg.avatar.name
+        self.assertEqual(models.AvatarBlob.objects.get(name=name).references, 2)
+        # Both share the derivatives too
+        self.reg.refresh_from_db()
+        other.refresh_from_db()
+        self.assertEqual(self.reg.avatar_derivative_names(), other.avatar_derivative_names())
+
+        # The same image again holds no extra reference
+        self.reg.avatar = File(self.image(), 'again.png')
+        self.reg.save()
+        self.assertEqual(models.AvatarBlob.objects.get(name=name).references, 2)
+
+        # Replacing and deleting give theirs back
+        self.reg.avatar = File(self.image('blue'), 'blue.png')
+        self.reg.save()
+        run_workers()
+        self.assertEqual(models.AvatarBlob.objects.get(name=name).references, 1)
+        with self.captureOnCommitCallbacks(execute=True):
+            other.delete()
+        self.assertFalse(models.AvatarBlob.objects.filter(name=name).exists())
+        self.assertFalse(self.reg.avatar.storage.exists(name))
+        self.reg.refresh_from_db()
+        # Derivatives that come out identical share a blob as well
+        derivatives = list(self.reg.avatar_derivative_names().values())
+        for derivative in derivatives:
+            self.assertEqual(models.AvatarBlob.objects.get(name=derivative).references, derivatives.count(derivative))
+
+    def test_take_avatar(self):
+        temp = models.RegistrationTempAvatar.objects.create(avatar=File(self.image(), 'upload.png'))
+        name = temp.avatar.name
+        with mock.patch.object(AvatarStorage, '_save') as save, mock.patch.object(AvatarStorage, 'open') as open_:
+            self.reg.take_avatar(temp.avatar)
+            self.reg.save()
+            temp.delete()
+            self.assertFalse(save.called or open_.called)
+        self.assertEqual(self.reg.avatar.name, name)
+        self.assertEqual(models.AvatarBlob.objects.get(name=name).references, 1)
+
+        # The same image again still leaves the one reference
+        temp = models.RegistrationTempAvatar.objects.create(avatar=File(self.image(), 'upload.png'))
+        self.reg.take_avatar(temp.avatar)
+        self.reg.save()
+        temp.delete()
+        self.assertEqual(models.AvatarBlob.objects.get(name=name).references, 1)
+
+        # Files from before content addressing are moved
+        legacy = FileSystemStorage().save('tmp_avatars/legacy.png', self.image('blue'))
+        temp = models.RegistrationTempAvatar.objects.create(avatar=legacy)
+        # The original is deleted on commit, and that's deferred to commit in turn
+        with self.captureOnCommitCallbacks(execute=True):
+            with self.captureOnCommitCallbacks(execute=True):
+                self.reg.take_avatar(temp.avatar)
+                self.reg.save()
+                temp.delete()
+            self.assertTrue(self.reg.avatar.storage.exists(legacy))
+        self.assertEqual(self.reg.avatar.name, 'reg_avatars/{}_legacy.png'.format(self.reg.id))
+        self.assertTrue(self.reg.avatar.storage.exists(self.reg.avatar.name))
+        self.assertFalse(self.reg.avatar.storage.exists(legacy))
+        self.assertFalse(models.AvatarBlob.objects.filter(name=name).exists())
+
+    def test_take_avatar_rolled_back(self):
+        legacy = FileSystemStorage().save('tmp_avatars/legacy.png', self.image('blue'))
+        temp = models.RegistrationTempAvatar.objects.create(avatar=legacy)
+        with self.captureOnCommitCallbacks(execute=True):
+            try:
+                with transaction.atomic():
+                    self.reg.take_avatar(temp.avatar)
+                    self.reg.save()
+                    raise RuntimeError
+            except RuntimeError:
+                pass
+        # Still there for the upload to be taken again
+        self.assertTrue(FileSystemStorage().exists(legacy))
+        self.assertEqual(models.RegistrationTempAvatar.objects.get().avatar.name, legacy)
+
+    def test_legacy_files(self):
+        storage = self.reg.avatar.storage
+        name = FileSystemStorage().save('reg_avatars/legacy.png', self.image())
+        with self.captureOnCommitCallbacks(execute=True):
+            storage.delete(name)
+        self.assertFalse(storage.exists(name))
+
+    def test_delete_rolled_back(self):
+        temp = models.RegistrationTempAvatar.objects.create(avatar=File(self.image(), 'upload.png'))
+        name = temp.avatar.name
+        with self.captureOnCommitCallbacks(execute=True):
+            try:
+                with transaction.atomic():
+                    temp.delete()
+                    raise RuntimeError
+            except RuntimeError:
+                pass
+        # The reference is back, so the file has to be too
+        self.assertEqual(models.AvatarBlob.objects.get(name=name).references, 1)
+        self.assertTrue(temp.avatar.storage.exists(name))
+
+    def test_stored_again_before_commit(self):
+        temp = models.RegistrationTempAvatar.objects.create(avatar=File(self.image(), 'upload.png'))
+        name = temp.avatar.name
+        with self.captureOnCommitCallbacks(execute=True):
+            temp.delete()
+            again = models.RegistrationTempAvatar.objects.create(avatar=File(self.image(), 'again.png'))
+        self.assertEqual(again.avatar.name, name)
+        self.assertTrue(again.avatar.storage.exists(name))
+
+
+class AvatarDecodeTest(TestCase):
+    def image_file(self, size, format, mode='RGB'):
+        output = BytesIO()
+        Image.new(mode, size, color='red').save(output, format=format)
+        return SimpleUploadedFile('avatar.' + format.lower(), output.getvalue())
+
+    def test_budgets(self):
+        with self.settings(REGISTRATION_AVATAR_MAX_PIXELS=1000000):
+            self.assertRaises(AvatarError, check_avatar, self.image_file((2000, 1000), 'PNG'))
+            # JPEGs can be decoded at an eighth of the size
+            check_avatar(self.image_file((4000, 2000), 'JPEG'))
+            self.assertRaises(AvatarError, open_avatar, self.image_file((4000, 2000), 'JPEG'))
+        with self.settings(REGISTRATION_AVATAR_MAX_BYTES=100):
+            self.assertRaises(AvatarError, check_avatar, self.image_file((100, 100), 'PNG'))
+        self.assertRaises(AvatarError, check_avatar, SimpleUploadedFile('avatar.png', b'not an image'))
+
+    def test_jpeg_draft(self):
+        image, peak = open_avatar(self.image_file((4000, 3000), 'JPEG'), (200, 200))
+        self.assertEqual(image.size, (500, 375))
+        self.assertEqual(peak, 500 * 375 * 3)
+        # Cropping keeps enough resolution to cover the target
+        image, peak = open_avatar(self.image_file((4000, 3000), 'JPEG'), (200, 200), (0, 0, 400, 400))
+        self.assertEqual(image.size, (200, 200))
+
+    def test_crop(self):
+        cropped = Image.open(BytesIO(crop_avatar(self.image_file((3000, 2000), 'PNG'), (500, 0, 2500, 2000))))
+        self.assertEqual(cropped.size, STORED_AVATAR_SIZE)
+        self.assertEqual(cropped.mode, 'RGBA')
+
 
 class RegistrationModelTest(TestCase):
     def setUp(self):
@@ -235,6 +1000,20 @@ class RegistrationModelTest(TestCase):
         self.levels = create_test_registrationlevels(self.convention)
         self.reg = create_test_registration(self.levels['sponsor'])
 
+    def test_admin_convention_check(self):
+        for n in range(3):
+            create_test_registration(self.levels['sponsor'], badge_name='Other {}'.format(n))
+        registration_admin = RegistrationAdmin(models.Registration, django_admin.site)
+        request = RequestFactory().post('/')
+        request.user = create_test_user()
+        level_table = '"{}"'.format(models.RegistrationLevel._meta.db_table)
+        with mock.patch.object(registration_admin, 'message_user'), \
+                CaptureQueriesContext(connection) as queries:
+            registration_admin.mark_checked_in(request, models.Registration.all_registrations.all())
+        # Told apart by the registration's own convention, not its level's
+        self.assertFalse([query for query in queries.captured_queries if level_table in query['sql']])
+        self.assertEqual(models.Registration.all_registrations.filter(checked_in=True).count(), 4)
+
     def test_registration_name(self):
         reg = self.reg
         self.assertEqual(reg.name, reg.first_name + ' ' + reg.last_name)
@@ -264,6 +1043,13 @@ class RegistrationModelTest(TestCase):
         )
         self.assertEqual(reg.verify(), True)
 
+    def test_registration_with_current_price(self):
+        reg = models.Registration.all_registrations.with_current_price().get(pk=self.reg.pk)
+        self.assertEqual(reg.registration_level_price, self.levels['sponsor'].price)
+        # Answered from the annotation, no lookup of the level needed
+        with self.assertNumQueries(0):
+            reg.registration_level_price
+
     def test_registration_coupon_percent(self):
         reg = self.reg
         self.assertFalse(reg.verify())
@@ -306,6 +1092,134 @@ class RegistrationModelTest(TestCase):
         # Should now verify as valid
         self.assertTrue(reg.verify())
 
+    def test_registration_ledger(self):
+        reg = self.reg
+        self.assertEqual((reg.amount_paid, reg.discount_applied, reg.amount_due), (0, 0, 2))
+
+        coupon = models.CouponCode.objects.create(
+            convention=self.convention,
+            code='half-off',
+            discount=50,
+            percent=True,
+        )
+        models.CouponUse.objects.create(registration=reg, coupon=coupon)
+        self.assertEqual((reg.discount_applied, reg.amount_due), (1, 1))
+        self.assertFalse(reg.verify())
+
+        payment = models.Payment.objects.create(
+            registration=reg,
+            payment_method=create_test_paymentmethod('Cash'),
+            payment_amount=1,
+        )
+        reg.refresh_from_db()
+        self.assertEqual((reg.amount_paid, reg.amount_due), (1, 0))
+        self.assertTrue(reg.verify())
+
+        # Payments up for refund don't count
+        payment.payment_state = 2
+        payment.refund_requested = timezone.now()
+        payment.save()
+        reg.refresh_from_db()
+        self.assertEqual((reg.amount_paid, reg.amount_due), (0, 1))
+        self.assertFalse(reg.verify())
+
+        # Refunded payments no longer count
+        payment.payment_state = 3
+        payment.save()
+        reg.refresh_from_db()
+        self.assertEqual((reg.amount_paid, reg.amount_due), (0, 1))
+
+        # Moving to a pricier level moves the amount due
+        reg.registration_level = self.levels['supersponsor']
+        reg.save()
+        reg.refresh_from_db()
+        self.assertEqual(reg.amount_due, Decimal('1.50'))
+
+    def test_registration_ledger_drift(self):
+        models.Payment.objects.create(
+            registration=self.reg,
+            payment_method=create_test_paymentmethod('Cash'),
+            payment_amount=2,
+        )
+        models.Registration.all_registrations.update(amount_paid=0, verified=False)
+
+        drift = list(models.Registration.all_registrations.ledger_drift())
+        self.assertEqual(len(drift), 1)
+        self.assertEqual(drift[0][1]['amount_paid'], 2)
+        self.assertRaises(CommandError, call_command, 'check_ledger', stdout=StringIO())
+
+        call_command('recompute_ledger', stdout=StringIO())
+        self.reg.refresh_from_db()
+        self.assertTrue(self.reg.verified)
+        call_command('check_ledger', stdout=StringIO())
+
+    def test_registration_ledger_price_change(self):
+        models.Payment.objects.create(
+            registration=self.reg,
+            payment_method=create_test_paymentmethod('Cash'),
+            payment_amount=2,
+        )
+        self.reg.refresh_from_db()
+        self.assertTrue(self.reg.verified)
+
+        # A price rise after registering doesn't reopen the ledger
+        models.RegistrationLevelPrice.objects.create(
+            registration_level=self.levels['sponsor'],
+            price=20,
+            active_date=timezone.now(),
+        )
+        self.assertEqual(list(models.Registration.all_registrations.ledger_drift()), [])
+        self.reg.update_ledger()
+        self.assertTrue(self.reg.verified)
+        self.assertEqual(self.reg.amount_due, 0)
+
+    def test_verify_payments_command(self):
+        self.reg.status = 1
+        self.reg.save()
+        previous_year = create_test_convention('Last Year', site_id=None)
+        previous_year_levels = create_test_registrationlevels(previous_year)
+        old_registration = create_test_registration(previous_year_levels['basic'], status=1)
+        covered = create_test_registration(previous_year_levels['basic'], status=1)
+        models.Payment.objects.create(
+            registration=covered,
+            payment_method=create_test_paymentmethod('Cash'),
+            payment_amount=1,
+        )
+
+        out = StringIO()
+        call_command('verify_payments', '--convention', str(self.convention.id),
+                     '--convention', str(previous_year.id), '--format', 'jsonl',
+                     stdout=out, stderr=StringIO())
+        rows = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual([row['id'] for row in rows], [self.reg.id, old_registration.id])
+        self.assertEqual(rows[0]['due'], '2.00')
+
+    def test_registration_convention_follows_level(self):
+        payment = models.Payment.objects.create(
+            registration=self.reg,
+            payment_method=create_test_paymentmethod('Cash'),
+            payment_amount=1,
+        )
+        self.assertEqual(self.reg.convention_id, self.convention.id)
+        self.assertEqual(payment.convention_id, self.convention.id)
+
+        # Moving to another convention's level brings payments along
+        next_year = create_test_convention('Next Year', site_id=None)
+        next_year_levels = create_test_registrationlevels(next_year)
+        self.reg.registration_level = next_year_levels['basic']
+        self.reg.save()
+        payment.refresh_from_db()
+        self.assertEqual(self.reg.convention_id, next_year.id)
+        self.assertEqual(payment.convention_id, next_year.id)
+
+        # As does moving the level itself
+        level = next_year_levels['basic']
+        level.convention = self.convention
+        level.save()
+        self.reg.refresh_from_db()
+        self.assertEqual(self.reg.convention_id, self.convention.id)
+        self.assertEqual(models.Payment.objects.get().convention_id, self.convention.id)
+
     def test_registration_manager_current_convention(self):
         """Test manager default filter on active registrations"""
 
@@ -335,6 +1249,28 @@ class RegistrationModelTest(TestCase):
         self.assertEqual(self.reg.external_id,
             stringify_integer(simple_feistel(self.reg.id)))
 
+    def test_registration_single_insert(self):
+        """New registrations go in with one write, derived fields included"""
+        table = models.Registration._meta.db_table
+        with CaptureQueriesContext(connection) as queries:
+            reg = create_test_registration(self.levels['sponsor'], badge_name='Other')
+        writes = [query['sql'] for query in queries.captured_queries
+                  if re.match(r'(INSERT INTO|UPDATE) "{}" '.format(table), query['sql'])]
+        if connection.vendor == 'postgresql':
+            self.assertEqual(len(writes), 1)
+        else:
+            # Without a sequence the ID comes from the insert, and
+            # external_id follows it
+            self.assertEqual(len(writes), 2)
+            self.assertTrue(writes[1].startswith('UPDATE'))
+
+        reg.refresh_from_db()
+        self.assertEqual(reg.external_id, stringify_integer(simple_feistel(reg.id)))
+        self.assertEqual(reg.amount_due, self.levels['sponsor'].price)
+
+        # IDs carry on from the last one handed out
+        self.assertEqual(create_test_registration(self.levels['sponsor']).id, reg.id + 1)
+
     def test_registration_badge_number_style_1(self):
         "Badge numbering style used in 2015-2016"
         self.convention.badge_number_style = 1
@@ -383,11 +1319,52 @@ class RegistrationModelTest(TestCase):
 
         # But if we set an offset...
         self.convention.registrationsettings.badge_offset = self.reg.id - 1
-        self.convention.save()
+        self.convention.registrationsettings.save()
+        self.reg.refresh_from_db()
         # Our badge numbering should start at 1
         string_id = '{0:05d}'.format(1)
         self.assertEqual(self.reg.badge_number(), string_id)
 
+        # The stored number can be rebuilt in bulk
+        models.Registration.all_registrations.update(assigned_badge_number=None)
+        call_command('refresh_badge_numbers', stdout=StringIO())
+        self.reg.refresh_from_db()
+        self.assertEqual(self.reg.badge_number(), string_id)
+
+    def test_registration_badge_number_stored(self):
+        settings = self.convention.registrationsettings
+        settings.badge_number_style = 1
+        settings.save()
+        self.reg.status = 1
+        self.reg.save()
+
+        badge = models.BadgeAssignment.objects.create(
+            registration=self.reg,
+            printed_by=create_test_user(),
+            registration_level=self.reg.registration_level,
+        )
+        self.assertEqual(models.Registration.objects.get().badge_number(), '{0:05d}'.format(badge.id))
+        badge.delete()
+        self.assertEqual(models.Registration.objects.get().badge_number(), None)
+
+        # Badge numbers are read without touching levels or settings
+        self.reg.needs_print = 0
+        self.reg.save()
+        settings.badge_number_style = 2
+        settings.save()
+        with self.assertNumQueries(1):
+            numbers = [reg.badge_number() for reg in models.Registration.all_registrations.all()]
+        self.assertEqual(numbers, ['{0:05d}'.format(self.reg.id)])
+
+        # Settings that don't touch numbering leave the numbers alone
+        with mock.patch.object(models.RegistrationQuerySet, 'refresh_badge_numbers') as refresh:
+            settings.registration_open = not settings.registration_open
+            settings.save()
+            self.assertFalse(refresh.called)
+            settings.badge_offset = 10
+            settings.save()
+            self.assertEqual(refresh.call_count, 1)
+
     # TODO: More validation tests
     def test_registration_validation_extralongname(self):
         self.reg.clean_fields(exclude=['address', 'city', 'state', 'postal_code', 'country'])
@@ -438,6 +1415,200 @@ class RegistrationLevelModelTest(TestCase):
         # They should still appear through the objects manager
         self.assertEqual(models.RegistrationLevel.objects.count(), 3)
 
+    def test_registration_level_with_current_price(self):
+        convention = create_test_convention()
+        levels = create_test_registrationlevels(convention)
+        models.RegistrationLevelPrice.objects.create(
+            registration_level=levels['basic'],
+            price=10,
+            active_date=timezone.now() + timedelta(days=1),
+        )
+
+        with self.assertNumQueries(1):
+            prices = {level.title: level.price for level in models.RegistrationLevel.objects.with_current_price()}
+        self.assertEqual(prices, {'basic': 1, 'sponsor': 2, 'supersponsor': 3})
+
+        # Prices can also be taken as of another point in time
+        tomorrow = timezone.now() + timedelta(days=2)
+        level = models.RegistrationLevel.objects.with_current_price(tomorrow).get(pk=levels['basic'].pk)
+        self.assertEqual(level.price, 10)
+
+
+class RegistrationLevelInventoryTest(TestCase):
+    def setUp(self):
+        self.convention = create_test_convention()
+        self.levels = create_test_registrationlevels(self.convention)
+
+    def sold(self, level):
+        return models.RegistrationLevelInventory.objects.get(level=level).sold
+
+    def test_inventory_counts_paid_registrations(self):
+        reg = create_test_registration(self.levels['basic'])
+        # Unpaid registrations don't take up a slot
+        self.assertEqual(self.sold(self.levels['basic']), 0)
+
+        reg.status = 1
+        reg.save()
+        self.assertEqual(self.sold(self.levels['basic']), 1)
+
+        # Upgrades move the slot to the new level
+        reg.registration_level = self.levels['sponsor']
+        reg.save()
+        self.assertEqual(self.sold(self.levels['basic']), 0)
+        self.assertEqual(self.sold(self.levels['sponsor']), 1)
+
+        # Refunds give it back
+        reg.status = 3
+        reg.save()
+        self.assertEqual(self.sold(self.levels['sponsor']), 0)
+
+        reg.status = 1
+        reg.save()
+        reg.delete()
+        self.assertEqual(self.sold(self.levels['sponsor']), 0)
+
+    def test_inventory_recount(self):
+        create_test_registration(self.levels['basic'], status=1)
+        models.RegistrationLevelInventory.objects.update(sold=10)
+        models.RegistrationLevelInventory.objects.recount()
+        self.assertEqual(self.sold(self.levels['basic']), 1)
+
+    def test_inventory_reserve(self):
+        level = self.levels['basic']
+        level.limit = 1
+        level.save()
+
+        with transaction.atomic():
+            models.RegistrationLevelInventory.objects.reserve(level)
+            create_test_registration(level, status=1)
+
+        level.refresh_from_db()
+        self.assertTrue(level.sold_out())
+        with transaction.atomic():
+            self.assertRaises(SoldOut, models.RegistrationLevelInventory.objects.reserve, level)
+
+    def test_inventory_hold(self):
+        level = self.levels['basic']
+        level.limit = 1
+        level.save()
+
+        hold = models.InventoryHold.objects.place(level)
+        self.assertEqual(models.InventoryHold.objects.live_counts(), {level.id: 1})
+        level.refresh_from_db()
+        self.assertTrue(level.sold_out())
+        self.assertRaises(SoldOut, models.InventoryHold.objects.place, level)
+
+        # Claiming the hold turns it into the registration's slot
+        with transaction.atomic():
+            self.assertTrue(models.InventoryHold.objects.claim(hold.id))
+            create_test_registration(level, status=1)
+        self.assertEqual(models.RegistrationLevelInventory.objects.get(level=level).held, 0)
+        self.assertEqual(self.sold(level), 1)
+        self.assertFalse(models.InventoryHold.objects.claim(hold.id))
+
+    def test_inventory_hold_lapsed(self):
+        level = self.levels['basic']
+        level.limit = 1
+        level.save()
+
+        hold = models.InventoryHold.objects.place(level)
+        models.InventoryHold.objects.filter(pk=hold.pk).update(expires=timezone.now())
+        # A lapsed hold doesn't stop the next buyer
+        models.InventoryHold.objects.place(level)
+        self.assertEqual(models.InventoryHold.objects.count(), 1)
+        self.assertEqual(models.RegistrationLevelInventory.objects.get(level=level).held, 1)
+
+
+class CatalogTest(TestCase):
+    def setUp(self):
+        self.convention = create_test_convention()
+        self.levels = create_test_registrationlevels(self.convention)
+        self.upgrades = create_test_registrationupgrades([
+            (self.levels['basic'], self.levels['supersponsor']),
+            (self.levels['basic'], self.levels['sponsor']),
+        ])
+
+    def test_catalog_contents(self):
+        catalog = get_catalog(self.convention)
+        self.assertEqual([level.title for level in catalog.current_levels()],
+                         ['basic', 'sponsor', 'supersponsor'])
+        self.assertEqual(catalog.level_price(self.levels['sponsor'].id), 2)
+        # Upgrade paths are ordered by the target level
+        self.assertEqual([upgrade.upgrade_registration_level.title
+                          for upgrade in catalog.upgrades_from(self.levels['basic'].id)],
+                         ['sponsor', 'supersponsor'])
+        self.assertEqual(catalog.upgrades_from(self.levels['sponsor'].id), [])
+        # Served from the snapshot until something changes
+        self.assertIs(get_catalog(self.convention.id), catalog)
+
+    def test_catalog_invalidated_on_save(self):
+        catalog = get_catalog(self.convention)
+        level = self.levels['basic']
+        level.active = False
+        level.save()
+        self.assertIsNot(get_catalog(self.convention), catalog)
+        self.assertEqual([level.title for level in get_catalog(self.convention).current_levels()],
+                         ['sponsor', 'supersponsor'])
+
+        models.RegistrationLevelPrice.objects.create(
+            registration_level=self.levels['sponsor'],
+            price=20,
+            active_date=timezone.now() - timedelta(days=1),
+        )
+        self.assertEqual(models.RegistrationLevel.objects.get(pk=self.levels['sponsor'].pk).price, 20)
+
+    def test_generation_published_on_commit(self):
+        generation_key = CONVENTION_GENERATION_KEY.format(self.convention.id)
+        before = cache.get(generation_key)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.levels['basic'].active = False
+            self.levels['basic'].save()
+            # Other processes keep the old generation until the save commits
+            self.assertEqual(cache.get(generation_key), before)
+        self.assertNotEqual(cache.get(generation_key), before)
+
+    def test_catalog_expires_at_boundary(self):
+        price_change = timezone.now() + timedelta(hours=1)
+        models.RegistrationLevelPrice.objects.create(
+            registration_level=self.levels['sponsor'],
+            price=20,
+            active_date=price_change,
+        )
+        catalog = get_catalog(self.convention)
+        self.assertEqual(catalog.expires, price_change)
+        self.assertEqual(catalog.level_price(self.levels['sponsor'].id), 2)
+
+        with mock.patch('django.utils.timezone.now', return_value=price_change + timedelta(seconds=1)):
+            catalog = get_catalog(self.convention)
+            self.assertEqual(catalog.level_price(self.levels['sponsor'].id), 20)
+
+
+class CurrentConventionCacheTest(TestCase):
+    def test_current_convention_cached(self):
+        convention = create_test_convention()
+        self.assertEqual(get_current_convention(), convention)
+        with self.assertNumQueries(0):
+            current = get_current_convention()
+            self.assertFalse(current.registrationsettings.badge_offset)
+
+        # Saving the settings retires the cached copy
+        convention.registrationsettings.badge_offset = 100
+        convention.registrationsettings.save()
+        self.assertEqual(get_current_settings().badge_offset, 100)
+
+        # As does moving the convention to another site
+        convention.site_id = None
+        convention.save()
+        self.assertIsNone(get_current_convention())
+
+    def test_generation_published_on_commit(self):
+        create_test_convention()
+        before = cache.get(CURRENT_CONVENTION_GENERATION_KEY)
+        with self.captureOnCommitCallbacks(execute=True):
+            get_current_settings().save()
+            self.assertEqual(cache.get(CURRENT_CONVENTION_GENERATION_KEY), before)
+        self.assertNotEqual(cache.get(CURRENT_CONVENTION_GENERATION_KEY), before)
+
 
 class RegistrationUpgradeModelTest(TestCase):
     def test_upgrade_name(self):
@@ -457,6 +1628,15 @@ class RegistrationUpgradeModelTest(TestCase):
         )
         self.assertEqual(str(upgrade), 'basic to sponsor')
 
+    def test_upgrade_with_current_price(self):
+        convention = create_test_convention()
+        levels = create_test_registrationlevels(convention)
+        upgrade = create_test_registrationupgrades([(levels['basic'], levels['supersponsor'])])[0]
+
+        with self.assertNumQueries(1):
+            upgrade = models.RegistrationUpgrade.objects.with_current_price().get(pk=upgrade.pk)
+            self.assertEqual(upgrade.price, 2)
+
     def test_upgrade_deny_between_conventions(self):
         convention1 = create_test_convention('First Convention', site_id=None)
         levels1 = create_test_registrationlevels(convention1)
@@ -1031,6 +2211,7 @@ class UserRegChangeViewTest(TestCase):
                                     {'new_badge_name': new_badge_name})
         self.assertEqual(response.status_code, 200)
         self.assertTrue(b'Registration Update Confirmation' in response.content)
+        run_workers()
         self.assertEqual(len(mail.outbox), 1)
 
         # Extract the confirmation URL from the email message
@@ -1134,6 +2315,7 @@ class QRCodeViewTest(TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response['Content-Type'], 'image/png')
 
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp())
 class RegisterViewTest(TestCase):
     def setUp(self):
         self.convention = create_test_convention()
@@ -1176,6 +2358,9 @@ class RegisterViewTest(TestCase):
             percent=True,
         )
 
+    def tearDown(self):
+        shutil.rmtree(settings.MEDIA_ROOT, ignore_errors=True)
+
 #    def test_unauthenticated(self):
 #        response = self.client.get(reverse('convention_registration'))
 #        self.assertEqual(response.status_code, 200)
@@ -1271,6 +2456,8 @@ class RegisterViewTest(TestCase):
         response = self.client.post(reverse('convention_registration'), self.example_reg)
         self.assertEqual(response.status_code, 200)
         self.assertTrue(b'Please verify the following information is correct' in response.content)
+        # The chosen level is held while the user confirms
+        self.assertEqual(models.InventoryHold.objects.live_counts(), {self.levels['sponsor'].id: 1})
 
         # one-dollar coupon discount
         self.example_reg['coupon_code'] = self.coupon.code
@@ -1292,6 +2479,7 @@ class RegisterViewTest(TestCase):
         response = self.client.post(reverse('convention_registration'), {'confirm': '1'})
         self.assertEqual(response.status_code, 200)
         self.assertTrue(b'Successfully registered!' in response.content)
+        run_workers()
         self.assertEqual(len(mail.outbox), 1)
 
         # Should create a registration...
@@ -1301,6 +2489,59 @@ class RegisterViewTest(TestCase):
         self.assertEqual(reg.status, 0)
         self.assertEqual(reg.payment_set.count(), 0)
 
+    def test_post_step2_last_slot(self):
+        # The buyer's own hold on the last slot doesn't turn them away
+        self.levels['sponsor'].limit = 1
+        self.levels['sponsor'].save()
+        self.convention.dealer_limit = 1
+        self.convention.save()
+        dealer_registration_level = models.DealerRegistrationLevel.objects.create(
+            convention=self.convention,
+            number_tables=1,
+            price=1.00,
+        )
+        self.example_reg['dealer_registration_level'] = dealer_registration_level.id
+
+        response = self.client.post(reverse('convention_registration'), self.example_reg)
+        self.assertTrue(b'Please verify the following information is correct' in response.content)
+        response = self.client.post(reverse('convention_registration'), {'confirm': '1'})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(b'Successfully registered!' in response.content)
+        reg = models.Registration.all_registrations.get()
+        self.assertEqual(reg.registration_level, self.levels['sponsor'])
+        self.assertEqual(reg.dealer_registration_level, dealer_registration_level)
+        self.assertFalse(models.InventoryHold.objects.exists())
+
+    def test_post_step2_draft(self):
+        response = self.client.post(reverse('convention_registration'), self.example_reg)
+        # The session only points at the draft, which holds plain keys
+        draft = models.RegistrationDraft.objects.get()
+        self.assertEqual(self.client.session['regdraft'], draft.id)
+        data = json.loads(draft.data)
+        self.assertEqual(data['registration_level'], self.levels['sponsor'].id)
+        self.assertEqual(data['birthday'], '{birthday_year:04d}-{birthday_month:02d}-{birthday_day:02d}'.format(
+            **self.example_reg))
+
+        # Going back and changing the form reuses the draft
+        self.example_reg['badge_name'] = 'Second Try'
+        response = self.client.post(reverse('convention_registration'), self.example_reg)
+        self.assertEqual(json.loads(models.RegistrationDraft.objects.get().data)['badge_name'], 'Second Try')
+
+        response = self.client.post(reverse('convention_registration'), {'confirm': '1'})
+        self.assertTrue(b'Successfully registered!' in response.content)
+        self.assertEqual(models.Registration.all_registrations.get().badge_name, 'Second Try')
+        self.assertEqual(models.RegistrationDraft.objects.count(), 0)
+        self.assertFalse('regdraft' in self.client.session)
+
+        # A lapsed draft sends the user back to the form
+        response = self.client.post(reverse('convention_registration'), self.example_reg)
+        models.RegistrationDraft.objects.update(expires=timezone.now())
+        response = self.client.post(reverse('convention_registration'), {'confirm': '1'})
+        self.assertTrue(b'Please verify' not in response.content)
+        self.assertEqual(models.Registration.all_registrations.count(), 1)
+        call_command('purge_registration_drafts')
+        self.assertEqual(models.RegistrationDraft.objects.count(), 0)
+
     def test_post_step2_coupon(self):
         # Zero value registration due to coupon code
         self.assertEqual(models.Registration.objects.count(), 0)
@@ -1310,6 +2551,7 @@ class RegisterViewTest(TestCase):
         response = self.client.post(reverse('convention_registration'), {'confirm': '1'})
         self.assertEqual(response.status_code, 200)
         self.assertTrue(b'Successfully registered!' in response.content)
+        run_workers()
         self.assertEqual(len(mail.outbox), 1)
 
         # Should create a registration...
@@ -1318,6 +2560,9 @@ class RegisterViewTest(TestCase):
         # ... that is paid and has a coupon linked
         self.assertEqual(reg.status, 1)
         self.assertEqual(reg.couponuse_set.count(), 1)
+        # ... and has taken the held slot
+        self.assertEqual(models.InventoryHold.objects.count(), 0)
+        self.assertEqual(models.RegistrationLevelInventory.objects.get(level=self.levels['sponsor']).sold, 1)
 
     def test_post_step2_coupon_force_level(self):
         self.full_coupon.force_registration_level = self.levels['basic']
@@ -1383,6 +2628,166 @@ class RegisterViewTest(TestCase):
 #        self.assertEqual(reg.status, 1)
 #        self.assertEqual(reg.payment_set.count(), 1)
 
+    @override_settings(REGISTRATION_PAYMENT_GATEWAY='registration.gateways.FakeGateway')
+    def test_post_step2_fake_gateway(self):
+        self.payment_method.is_credit = True
+        self.payment_method.save()
+
+        # Declined, back to the form
+        response = self.client.post(reverse('convention_registration'), self.example_reg)
+        response = self.client.post(reverse('convention_registration'), {'confirm': '1', 'stripeToken': 'decline'})
+        self.assertTrue(b'Your card was declined' in response.content)
+        self.assertEqual(models.Registration.all_registrations.count(), 0)
+
+        response = self.client.post(reverse('convention_registration'), self.example_reg)
+        response = self.client.post(reverse('convention_registration'), {'confirm': '1', 'stripeToken': 'tok'})
+        self.assertTrue(b'Successfully registered!' in response.content)
+        reg = models.Registration.objects.get()
+        self.assertEqual(reg.status, 1)
+        charge = get_gateway().retrieve(reg.payment_set.get().payment_extra)
+        self.assertEqual(charge.amount, self.levels['sponsor'].price)
+
+    @override_settings(REGISTRATION_PAYMENT_GATEWAY='registration.gateways.FakeGateway')
+    def test_post_step2_charged_before_claim(self):
+        self.payment_method.is_credit = True
+        self.payment_method.save()
+        charge = FakeGateway.charge
+        held = []
+
+        def charging(gateway, *args, **kwargs):
+            # The capacity is held, but not yet claimed, while the card is charged
+            held.append(models.InventoryHold.objects.live_counts())
+            return charge(gateway, *args, **kwargs)
+
+        response = self.client.post(reverse('convention_registration'), self.example_reg)
+        # A lapsed hold is placed again before charging
+        models.InventoryHold.objects.update(expires=timezone.now())
+        with mock.patch.object(FakeGateway, 'charge', charging):
+            response = self.client.post(reverse('convention_registration'), {'confirm': '1', 'stripeToken': 'tok'})
+        self.assertTrue(b'Successfully registered!' in response.content)
+        self.assertEqual(held, [{self.levels['sponsor'].id: 1}])
+        self.assertFalse(models.InventoryHold.objects.exists())
+        self.assertEqual(models.RegistrationLevelInventory.objects.get(level=self.levels['sponsor']).sold, 1)
+
+    @override_settings(REGISTRATION_PAYMENT_GATEWAY='registration.gateways.FakeGateway')
+    def test_post_step2_sold_out_while_charging(self):
+        self.payment_method.is_credit = True
+        self.payment_method.save()
+        self.levels['sponsor'].limit = 1
+        self.levels['sponsor'].save()
+        charge = FakeGateway.charge
+        charges = []
+
+        def charging(gateway, *args, **kwargs):
+            # The hold lapses mid-charge, and someone else takes the slot
+            models.InventoryHold.objects.update(expires=timezone.now())
+            create_test_registration(self.levels['sponsor'], status=1)
+            charges.append(charge(gateway, *args, **kwargs))
+            return charges[-1]
+
+        response = self.client.post(reverse('convention_registration'), self.example_reg)
+        with mock.patch.object(FakeGateway, 'charge', charging):
+            response = self.client.post(reverse('convention_registration'), {'confirm': '1', 'stripeToken': 'tok'})
+        self.assertTrue(b'That registration level is no longer available' in response.content)
+        self.assertEqual(models.Registration.all_registrations.count(), 1)
+        self.assertTrue(get_gateway().retrieve(charges[0].id).refunded)
+
+    @override_settings(REGISTRATION_PAYMENT_GATEWAY='registration.gateways.FakeGateway',
+                       REGISTRATION_ASYNC_PAYMENTS=True)
+    def test_post_step2_async_payment(self):
+        self.payment_method.is_credit = True
+        self.payment_method.save()
+
+        response = self.client.post(reverse('convention_registration'), self.example_reg)
+        response = self.client.post(reverse('convention_registration'), {'confirm': '1', 'stripeToken': 'tok'})
+        self.assertTrue(b'Your payment is being processed' in response.content)
+        # Payment In Progress, but already holding its place
+        reg = models.Registration.all_registrations.get()
+        self.assertEqual(reg.status, 2)
+        self.assertEqual(models.RegistrationLevelInventory.objects.get(level=self.levels['sponsor']).sold, 1)
+        self.assertEqual(len(mail.outbox), 0)
+
+        run_workers()
+        reg.refresh_from_db()
+        self.assertEqual(reg.status, 1)
+        payment = reg.payment_set.get()
+        self.assertEqual(get_gateway().retrieve(payment.payment_extra).amount, self.levels['sponsor'].price)
+        self.assertEqual(reg.amount_paid, self.levels['sponsor'].price)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertTrue(payment.payment_extra in mail.outbox[0].body)
+
+    @override_settings(REGISTRATION_PAYMENT_GATEWAY='registration.gateways.FakeGateway',
+                       REGISTRATION_PAYMENT_GATEWAY_OPTIONS={'pending': True},
+                       REGISTRATION_ASYNC_PAYMENTS=True)
+    def test_async_payment_webhook(self):
+        self.payment_method.is_credit = True
+        self.payment_method.save()
+
+        response = self.client.post(reverse('convention_registration'), self.example_reg)
+        response = self.client.post(reverse('convention_registration'), {'confirm': '1', 'stripeToken': 'tok'})
+        run_workers()
+        # Charged, but the gateway hasn't settled it yet
+        pending = models.PendingPayment.objects.get()
+        self.assertEqual(pending.status, 1)
+        self.assertEqual(pending.token, '')
+        self.assertEqual(pending.registration.status, 2)
+
+        response = self.client.post(reverse('convention_payment_webhook'), 'not json',
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post(reverse('convention_payment_webhook'),
+                                    json.dumps({'charge': pending.charge_id, 'status': 'failed'}),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        run_workers()
+        reg = models.Registration.all_registrations.get()
+        self.assertEqual(reg.status, 0)
+        self.assertEqual(reg.payment_set.count(), 0)
+        self.assertEqual(models.RegistrationLevelInventory.objects.get(level=self.levels['sponsor']).sold, 0)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertTrue('Payment Not Completed' in mail.outbox[0].subject)
+
+        # A repeated webhook changes nothing
+        response = self.client.post(reverse('convention_payment_webhook'),
+                                    json.dumps({'charge': pending.charge_id, 'status': 'succeeded'}),
+                                    content_type='application/json')
+        run_workers()
+        self.assertEqual(models.Registration.all_registrations.get().status, 0)
+
+    @override_settings(REGISTRATION_PAYMENT_GATEWAY='registration.gateways.FakeGateway',
+                       REGISTRATION_PAYMENT_GATEWAY_OPTIONS={'pending': True},
+                       REGISTRATION_ASYNC_PAYMENTS=True)
+    def test_reconcile_payments(self):
+        self.payment_method.is_credit = True
+        self.payment_method.save()
+
+        response = self.client.post(reverse('convention_registration'), self.example_reg)
+        response = self.client.post(reverse('convention_registration'), {'confirm': '1', 'stripeToken': 'tok'})
+        run_workers()
+        pending = models.PendingPayment.objects.get()
+        # Too recent to be considered stuck
+        self.assertEqual(models.PendingPayment.objects.reconcile()['waiting'], 0)
+        stats = models.PendingPayment.objects.reconcile(minutes=0)
+        self.assertEqual(stats, {'paid': 0, 'released': 0, 'waiting': 1})
+
+        # The webhook went missing, but the gateway knows
+        get_gateway().settle(pending.charge_id, 'succeeded')
+        stats = models.PendingPayment.objects.reconcile(minutes=0)
+        self.assertEqual(stats, {'paid': 1, 'released': 0, 'waiting': 0})
+        reg = models.Registration.all_registrations.get()
+        self.assertEqual(reg.status, 1)
+        self.assertEqual(reg.payment_set.get().payment_extra, pending.charge_id)
+        run_workers()
+        self.assertEqual(len(mail.outbox), 1)
+
+        # Stuck without any pending payment, settled by its payments
+        reg.status = 2
+        reg.save()
+        out = StringIO()
+        call_command('reconcile_payments', minutes=0, stdout=out)
+        self.assertTrue('Paid 1, released 0' in out.getvalue())
+        self.assertEqual(models.Registration.all_registrations.get().status, 1)
+
     def test_post_avatar(self):
         # Usual process
         self.assertEqual(models.Registration.all_registrations.count(), 0)
@@ -1400,7 +2805,24 @@ class RegisterViewTest(TestCase):
         self.assertEqual(response.status_code, 200)
         reg = models.Registration.all_registrations.first()
         self.assertTrue(reg.avatar)
-        self.assertTrue(str(reg.id) in reg.avatar.path)
+        # Stored once under its content hash, the upload's reference handed over
+        blob = models.AvatarBlob.objects.get(name=reg.avatar.name)
+        self.assertEqual(blob.references, 1)
+        self.assertFalse(models.RegistrationTempAvatar.objects.exists())
+
+    def test_post_avatar_too_large(self):
+        im_output = BytesIO()
+        Image.new('RGBA', (400, 400)).save(im_output, format='png')
+        im_output.seek(0)
+        self.example_reg['avatar'] = im_output
+        with self.settings(REGISTRATION_AVATAR_MAX_PIXELS=10000):
+            response = self.client.post(reverse('convention_registration'), self.example_reg)
+        # Warned about once, by the form rather than the upload handler
+        warnings = [str(m) for m in response.context['messages']]
+        self.assertEqual(len(warnings), 1)
+        self.assertTrue('too large' in warnings[0])
+        self.assertFalse('avatar' in self.client.session)
+        self.assertFalse(models.RegistrationTempAvatar.objects.exists())
 
     def test_convention_closed(self):
         self.convention.registrationsettings.registration_open = False
@@ -1729,6 +3151,7 @@ class UpgradeViewTest(TestCase):
         response = self.client.post(reverse('convention_upgrade', kwargs={'external_id': self.reg.external_id}), data)
         self.assertEqual(response.status_code, 200)
         self.assertTrue(b'Successfully upgraded!' in response.content)
+        run_workers()
         self.assertEqual(len(mail.outbox), 1)
 
         # Should upgrade the registration
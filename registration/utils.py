@@ -1,10 +1,6 @@
-from django.core.mail import EmailMessage
-from django.db.models import Count
-from django.template import loader
-
-from datetime import datetime
-
-from .models import Convention, Payment, Registration
+from datetime import date
+from decimal import Decimal
+import unicodedata
 
 def simple_feistel(value):
     # A simple self-inverse Feistel cipher for ID obfuscation
@@ -34,5 +30,84 @@ def stringify_integer(value):
 
     return output
 
+def normalize_name(value):
+    # Casefolded letters and digits only, accents stripped, so names
+    # compare loosely
+    value = unicodedata.normalize('NFKD', value or '')
+    return ''.join(c for c in value if c.isalnum() and not unicodedata.combining(c)).casefold()
+
+def email_local_part(value):
+    # Mailbox without any +tag, lowercased
+    local = (value or '').rpartition('@')[0] if '@' in (value or '') else ''
+    return local.split('+')[0].lower()
+
+def duplicate_keys(first_name, last_name, birthday, email):
+    # Blocking keys for duplicate detection: likely duplicates share at
+    # least one. Last name and first initial, last name and birthday,
+    # email mailbox.
+    last_name = normalize_name(last_name)
+    first_name = normalize_name(first_name)
+    birthday = str(birthday)[:10] if birthday else ''
+    return (
+        '{}:{}'.format(last_name, first_name[:1]) if last_name else '',
+        '{}:{}'.format(last_name, birthday) if last_name and birthday else '',
+        email_local_part(email),
+    )
+
+def cluster_duplicates(rows):
+    # Group rows of (id, first_name, last_name, birthday, email) into
+    # likely duplicates: the same last name, and the same first name,
+    # birthday or mailbox. Rows are hashed into blocks on their blocking
+    # keys, and within a block on whatever the key leaves to confirm,
+    # so it's a single linear pass. Returns sorted lists of ids.
+    parent = {}
+
+    def find(x):
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    groups = {}
+    for id, first_name, last_name, birthday, email in rows:
+        parent[id] = id
+        name_key, birthday_key, email_key = duplicate_keys(first_name, last_name, birthday, email)
+        if name_key and normalize_name(first_name):
+            groups.setdefault(('name', name_key, normalize_name(first_name)), []).append(id)
+        if birthday_key:
+            groups.setdefault(('birthday', birthday_key), []).append(id)
+        if email_key and normalize_name(last_name):
+            groups.setdefault(('email', email_key, normalize_name(last_name)), []).append(id)
+
+    for group in groups.values():
+        for id in group[1:]:
+            parent[find(id)] = find(group[0])
+
+    clusters = {}
+    for id in parent:
+        clusters.setdefault(find(id), []).append(id)
+    return sorted(sorted(cluster) for cluster in clusters.values() if len(cluster) > 1)
+
+def compact_form_data(data):
+    # A form's cleaned_data boiled down to JSON-friendly values the form
+    # can be bound to again: model instances by primary key, dates and
+    # decimals as strings.
+    def compact(value):
+        if hasattr(value, '_meta') and hasattr(value, 'pk'):
+            return value.pk
+        if isinstance(value, (date, Decimal)):
+            return str(value)
+        if isinstance(value, (str, int, float, bool)) or value is None:
+            return value
+        # A multiple choice's list or queryset
+        return [compact(item) for item in value]
+    return {name: compact(value) for name, value in data.items()}
+
 class PaymentError(Exception):
     pass
+
+class SoldOut(Exception):
+    pass
+
+class AvatarError(Exception):
+    pass
@@ -11,14 +11,15 @@ from django.core.cache import cache
 from django.core.cache.utils import make_template_fragment_key
 from django.core.exceptions import PermissionDenied
 from django.core.files import File
-from django.core.mail import send_mail
 from django.core.signing import TimestampSigner, BadSignature
 from django.db import transaction
 from django.db.models import Q
 from django.template import loader
 from django.utils import timezone
 from django.utils.dateparse import parse_date
+from django.utils.cache import get_conditional_response, patch_cache_control
 from django.utils.encoding import force_str
+from django.utils.http import http_date
 from django.views.decorators.cache import cache_control
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_POST
@@ -30,18 +31,21 @@ from datetime import timedelta
 from io import BytesIO
 from PIL import Image, ImageDraw, ImageFont
 
+from .avatars import check_avatar, crop_avatar, get_thumbnail, thumbnail_key, thumbnail_sizes
+from .catalog import get_catalog, get_current_convention
+from .gateways import get_gateway
 from .forms import CIEditForm, CIPaymentForm, RegistrationForm, UpgradeForm, DealerUpgradeForm, UserRegUpdateForm
 from .models import (Convention, Registration, RegistrationLevel,
                      RegistrationUpgrade, DealerRegistrationLevel, RegistrationQueue,
                      Payment, PaymentMethod, CouponCode, CouponUse,
                      Swag, RegistrationSwag, ShirtSize,
-                     RegistrationTempAvatar, BadgeAssignment, StaffRegistration
+                     RegistrationTempAvatar, BadgeAssignment, StaffRegistration,
+                     RegistrationLevelInventory, DealerRegistrationLevelInventory, InventoryHold,
+                     OutboxMessage, PendingPayment, Job, RegistrationDraft,
                      )
-from .utils import PaymentError
+from .utils import AvatarError, PaymentError, SoldOut
 
 
-# TODO: Preserve step1 to step2 outside of the session, probably relaying back through hidden fields or such, or serializing the data
-
 class RegistrationDriver(View):
     '''
     Basic registration flow CBV, in a way that can be overridden for
@@ -52,14 +56,20 @@ class RegistrationDriver(View):
        form_initial is used to customize form defaults.
        form_context is additional context data for templates.
     2. Let the user confirm what they've submitted and take payment (step2_confirm)
-       If valid the submitted form is stored into the session.
+       If valid the submitted form is stored as a RegistrationDraft,
+       with only its id kept in the session.
        calculate_amount uses the submitted form and returns the amount.
        "amount" is injected into the context.
+       inventory_levels names the limited levels being bought, and a
+       hold is placed on them while the user confirms.
        Template's form needs only have "confirm".
     3. Show a success page (step3_success)
+       The hold is claimed, or capacity is reserved again if it lapsed.
        process_payment should look for and process any payment information.
        success_save_form should do whatever the user came here to do.
        A confirmation email is sent to address in context variable "email".
+       If defer_payment says so, the card is instead charged by a
+       background job, and the email sent once the payment settles.
 
     Subclasses can of course expand on those as needed.
     '''
@@ -99,6 +109,52 @@ class RegistrationDriver(View):
 
         raise NotImplementedError
 
+    def inventory_levels(self, **kwargs):
+        '''
+        Given the context from calculate_amount, returns a 2-tuple of
+        the RegistrationLevel and DealerRegistrationLevel being bought,
+        either of which may be None. Capacity on those is held from the
+        confirm step until the success step.
+        '''
+
+        return None, None
+
+    def hold_inventory(self, request, **kwargs):
+        self.release_inventory(request)
+        registration_level, dealer_registration_level = self.inventory_levels(**kwargs)
+        if registration_level or dealer_registration_level:
+            hold = InventoryHold.objects.place(registration_level, dealer_registration_level,
+                                               minutes=getattr(settings, 'REGISTRATION_HOLD_MINUTES', 15))
+            request.session['inventory_hold'] = hold.id
+
+    def claim_inventory(self, request, **kwargs):
+        # Must be called inside the transaction that saves the registration
+        hold_id = request.session.pop('inventory_hold', None)
+        if hold_id and InventoryHold.objects.claim(hold_id):
+            return
+        # The hold lapsed, so try to take the capacity outright
+        registration_level, dealer_registration_level = self.inventory_levels(**kwargs)
+        if registration_level:
+            RegistrationLevelInventory.objects.reserve(registration_level)
+        if dealer_registration_level:
+            DealerRegistrationLevelInventory.objects.reserve(dealer_registration_level)
+
+    def save_draft(self, request, form):
+        request.session['regdraft'] = RegistrationDraft.objects.store(
+            form.cleaned_data, draft_id=request.session.get('regdraft'),
+            minutes=getattr(settings, 'REGISTRATION_DRAFT_MINUTES', 60),
+        )
+
+    def discard_draft(self, request):
+        draft_id = request.session.pop('regdraft', None)
+        if draft_id:
+            RegistrationDraft.objects.filter(pk=draft_id).delete()
+
+    def release_inventory(self, request):
+        hold_id = request.session.pop('inventory_hold', None)
+        if hold_id:
+            InventoryHold.objects.filter(pk=hold_id).delete()
+
     def process_payment(self, request, amount, description):
         """
         User has confirmed, process payment.
@@ -113,19 +169,25 @@ class RegistrationDriver(View):
         successful.
         """
 
-        try:
-            stripe_token = request.POST['stripeToken']
-            import stripe
-            stripe.api_key = settings.STRIPE_SECRET_KEY
-            charge = stripe.Charge.create(amount=int(amount * 100),
-                                          currency="USD",
-                                          card=stripe_token,
-                                          description=description)
-        except stripe.error.CardError as e:
-            # Pass a "Payment Declined" error to the user
-            raise PaymentError('A payment error has occurred: {}'.format(e.json_body['error']['message']))
-        else:
-            return charge
+        return get_gateway().charge(amount, request.POST['stripeToken'], description)
+
+    def refund_payment(self, request, charge):
+        """
+        Give back a payment taken by process_payment, when what it paid
+        for sold out before it could be saved. Raise PaymentError if the
+        gateway won't.
+        """
+
+        return get_gateway().refund(charge.id, idempotency_key='refund-{}'.format(charge.id))
+
+    def defer_payment(self, request, amount):
+        """
+        Whether to leave the card payment to a background job, freeing
+        up the web worker, rather than charging it in process_payment.
+        success_save_form should then save things as awaiting payment.
+        """
+
+        return False
 
     def success_save_form(self, request, form, amount, charge, **kwargs):
         '''
@@ -140,7 +202,7 @@ class RegistrationDriver(View):
 
     def ensure_ready(self, request, *args, **kwargs):
         # Ensure convention registration system is ready
-        self.current_convention = Convention.objects.current()
+        self.current_convention = get_current_convention()
         if not self.current_convention.registrationsettings.registration_open:
             raise PermissionDenied()
 
@@ -157,12 +219,17 @@ class RegistrationDriver(View):
 
     def post(self, request, *args, **kwargs):
         if 'confirm' in request.POST.keys():
+            data = RegistrationDraft.objects.load(request.session.get('regdraft'))
+            if data is None:
+                # If there's no draft for the form, the user probably
+                # hit the back button after registering, or it lapsed.
+                return self.get(request, *args, **kwargs)
             try:
-                form = self.form_class(request.session['regformdata'])
+                form = self.form_class(data)
             except KeyError:
-                # If the form isn't serialized inside the session, the
-                # user probably hit the back button after registering.
+                # The form needs more than the draft kept
                 return self.get(request, *args, **kwargs)
+            form.inventory_hold = InventoryHold.objects.filter(pk=request.session.get('inventory_hold')).first()
             if not form.is_valid():
                 # Double check form validity
                 return self.get(request, *args, **kwargs)
@@ -183,10 +250,16 @@ class RegistrationDriver(View):
         return render(request, self.form_template, context)
 
     def step2_confirm(self, request, form, *args, **kwargs):
-        request.session['regformdata'] = form.cleaned_data
-
         amount, added_context, payment_description = self.calculate_amount(form, *args, **kwargs)
 
+        try:
+            self.hold_inventory(request, **added_context)
+        except SoldOut as e:
+            form.add_error(None, e.args[0])
+            return self.step1_form(request, form, *args, **kwargs)
+
+        self.save_draft(request, form)
+
         context = {
             'form': form,
         }
@@ -212,26 +285,61 @@ class RegistrationDriver(View):
         context = self.form_context(request, *args, **kwargs)
         context.update(added_context)
 
+        # Charged outside the transaction that claims the capacity, so
+        # the level's inventory row isn't locked for the gateway's round
+        # trip; a live hold already sets the capacity aside
+        if not InventoryHold.objects.live().filter(pk=request.session.get('inventory_hold')).exists():
+            try:
+                self.hold_inventory(request, **context)
+            except SoldOut as e:
+                form.add_error(None, e.args[0])
+                self.discard_draft(request)
+                return self.step1_form(request, form)
+
         charge = None
-        if 'stripeToken' in request.POST.keys():
+        deferred = 'stripeToken' in request.POST.keys() and self.defer_payment(request, amount)
+        if 'stripeToken' in request.POST.keys() and not deferred:
             # Process Stripe payment
             try:
                 charge = self.process_payment(request, amount, payment_description)
             except PaymentError as e:
                 # Pass a "Payment Declined" error to the user
                 form.add_error(None, e.args[0])
-                request.session.pop('regformdata')
+                self.discard_draft(request)
                 return self.step1_form(request, form)
 
-        context.update(
-            # success_save_form should return a dict, add that into context
-            self.success_save_form(request, form, amount, charge, **context)
-        )
+        try:
+            with transaction.atomic():
+                self.claim_inventory(request, **context)
+                context.update(
+                    # success_save_form should return a dict, add that into context
+                    self.success_save_form(request, form, amount, charge, **context)
+                )
+                if deferred:
+                    pending = PendingPayment.objects.create(registration=context['registration'],
+                                                            payment_method=form.cleaned_data['payment_method'],
+                                                            amount=amount,
+                                                            description=payment_description,
+                                                            token=request.POST['stripeToken'])
+                    Job.objects.enqueue('submit_payment', pending.id)
+        except SoldOut as e:
+            # The hold lapsed while charging, and the capacity went since
+            form.add_error(None, e.args[0])
+            if charge:
+                try:
+                    self.refund_payment(request, charge)
+                except PaymentError:
+                    form.add_error(None, 'Your payment could not be refunded automatically, '
+                                         'please contact us to have it refunded.')
+            self.discard_draft(request)
+            return self.step1_form(request, form)
         # Purge the old form from the session so it's no longer available
-        request.session.pop('regformdata')
+        self.discard_draft(request)
 
-        # TODO: May be a better place to store the email address?
-        self.send_confirmation_email(context['email'], context)
+        context['payment_pending'] = deferred
+        if not deferred:
+            # TODO: May be a better place to store the email address?
+            self.send_confirmation_email(context['email'], context)
         return render(request, self.success_template, context)
 
     def send_confirmation_email(self, destination, context):
@@ -243,9 +351,9 @@ class RegistrationDriver(View):
         email_body = loader.render_to_string(
             self.email_confirm_body_template, context
         )
-        send_mail(email_subject, email_body,
-                  self.current_convention.contact_email,
-                  [destination], fail_silently=True)
+        OutboxMessage.objects.queue(email_subject, email_body,
+                                    self.current_convention.contact_email,
+                                    [destination])
 
 
 class Register(RegistrationDriver):
@@ -267,12 +375,9 @@ class Register(RegistrationDriver):
 
         # Allow registration levels to be pre-selected
         if 'as' in request.GET:
-            candidates = RegistrationLevel.objects.filter(
-                active=True, convention=self.current_convention,
-                title__iexact=request.GET['as']
-            )
-            for level in candidates:
-                initial['registration_level'] = str(level.id)
+            for level in get_catalog(self.current_convention).levels():
+                if level.active and level.title.lower() == request.GET['as'].lower():
+                    initial['registration_level'] = str(level.id)
         initial['dealer_registration_level'] = str('')
 
         # TODO: Consider making this more generic by having initial inherit request.GET's dict
@@ -285,7 +390,9 @@ class Register(RegistrationDriver):
         # Check for avatar upload
         if 'avatar' in request.FILES:
             # Hand off to upload handler
-            handle_avatar_upload(request)
+            response = handle_avatar_upload(request)
+            if response.status_code != 200:
+                messages.warning(request, json.loads(response.content)['error'])
 
         if 'avatar' in request.session:
             avatar = RegistrationTempAvatar.objects.filter(id=request.session['avatar']).first()
@@ -295,7 +402,7 @@ class Register(RegistrationDriver):
         if request.user.is_authenticated:
             # Look for any existing registrations the user may have
             registrations = [reg for reg in request.user.registration_set.filter(
-                registration_level__convention=self.current_convention
+                convention=self.current_convention
             ) if reg.paid()]
         else:
             registrations = []
@@ -352,6 +459,12 @@ class Register(RegistrationDriver):
         }
         return amount, added_context, payment_description
 
+    def inventory_levels(self, **kwargs):
+        return kwargs['registration_level'], kwargs['dealer_registration_level']
+
+    def defer_payment(self, request, amount):
+        return getattr(settings, 'REGISTRATION_ASYNC_PAYMENTS', False) and amount > 0
+
     def success_save_form(self, request, form, amount, charge, **kwargs):
         '''Everything is successful, actually process the submitted form'''
 
@@ -361,10 +474,32 @@ class Register(RegistrationDriver):
             reg.user = request.user
         reg.registration_level = kwargs['registration_level']
         reg.dealer_registration_level = kwargs['dealer_registration_level']
-
         if charge or amount == 0:
             reg.status = 1
-            reg.save()
+        elif 'stripeToken' in request.POST.keys() and self.defer_payment(request, amount):
+            # Payment In Progress, until the payment job settles it
+            reg.status = 2
+        else:
+            reg.status = 0
+
+        if kwargs['avatar']:
+            del request.session['avatar']
+            if 'avatar_original' in request.session:
+                del request.session['avatar_original']
+            if Registration.all_registrations.can_reserve_ids():
+                # Avatar is named after the registration, so take its ID
+                # up front and insert everything in one go
+                reg.reserve_id()
+                reg.take_avatar(kwargs['avatar'].avatar)
+        reg.save()
+        if kwargs['avatar']:
+            if not reg.avatar:
+                # Named once the database has handed out the ID
+                reg.take_avatar(kwargs['avatar'].avatar)
+                reg.save(update_fields=['avatar'])
+            kwargs['avatar'].delete()
+
+        if reg.status == 1:
             method = form.cleaned_data['payment_method']
             payment = Payment(registration=reg,
                               payment_method=method,
@@ -374,21 +509,8 @@ class Register(RegistrationDriver):
             payment.save()
         else:
             # Unpaid cash registration
-            reg.status = 0
-            reg.save()
             payment = None
 
-        if kwargs['avatar']:
-            del request.session['avatar']
-            if 'avatar_original' in request.session:
-                del request.session['avatar_original']
-            reg.avatar = File(
-                kwargs['avatar'].avatar,
-                '{0}_{1}'.format(reg.id, os.path.basename(kwargs['avatar'].avatar.name))
-            )
-            reg.save()
-            kwargs['avatar'].delete()
-
         if kwargs['coupon_code']:
             couponuse = CouponUse(registration=reg,
                                   coupon=kwargs['coupon_code'])
@@ -442,12 +564,12 @@ class Upgrade(RegistrationDriver):
         # Kind of lame having to run this twice, in both initial and context
         if external_id:
             selected_registration = get_object_or_404(Registration, external_id=external_id, \
-                                                      registration_level__convention=self.current_convention)
+                                                      convention=self.current_convention)
         else:
             # Look up active registrations for current user
             if request.user.is_authenticated:
                 registrations = [reg for reg in request.user.registration_set.filter(
-                    registration_level__convention=self.current_convention) if reg.paid()]
+                    convention=self.current_convention) if reg.paid()]
             selected_registration = None
 
             # Try to figure out which registration to upgrade ...
@@ -461,12 +583,9 @@ class Upgrade(RegistrationDriver):
 
         if selected_registration:
             # Determine upgrade options and prices
-            upgrade_options = RegistrationUpgrade.objects.filter(active=True,
-                                                                 current_registration_level=selected_registration.registration_level,
-                                                                 # upgrade_registration_level__active=True,
-                                                                 ).exclude(
-                upgrade_registration_level__deadline__lt=timezone.now(),
-            ).order_by('upgrade_registration_level__seq')
+            upgrade_options = get_catalog(self.current_convention).upgrades_from(
+                selected_registration.registration_level_id
+            )
         else:
             upgrade_options = []
 
@@ -536,6 +655,9 @@ class Upgrade(RegistrationDriver):
         }
         return amount, added_context, description
 
+    def inventory_levels(self, **kwargs):
+        return kwargs['upgrade'].upgrade_registration_level, None
+
     def success_save_form(self, request, form, amount, charge, **kwargs):
         """Everything is successful, actually process the submitted form"""
 
@@ -633,6 +755,9 @@ class DealerUpgrade(Upgrade):
         }
         return amount, added_context, description
 
+    def inventory_levels(self, **kwargs):
+        return None, kwargs['dealer_registration_level']
+
     def success_save_form(self, request, form, amount, charge, **kwargs):
         '''Everything is successful, actually process the submitted form'''
 
@@ -667,6 +792,10 @@ class DealerUpgrade(Upgrade):
 @csrf_exempt
 def handle_avatar_upload(request):
     if 'avatar' in request.FILES:
+        try:
+            check_avatar(request.FILES['avatar'])
+        except AvatarError as e:
+            return JsonResponse({'error': str(e)}, status=400)
         avatar = RegistrationTempAvatar(avatar=request.FILES['avatar'])
         avatar.save()
         request.session['avatar_original'] = avatar.id
@@ -690,14 +819,12 @@ def handle_avatar_upload(request):
         scaleY = int(crop_data['scaleY'])
 
         # Crop the source image
-        avatar_img = Image.open(avatar.avatar)
-        avatar_img = avatar_img.crop((x, y, x + width, y + height))
+        try:
+            im_output = BytesIO(crop_avatar(avatar.avatar, (x, y, x + width, y + height)))
+        except AvatarError as e:
+            return JsonResponse({'error': str(e)}, status=400)
 
         # Save to a new temp avatar
-        im_output = BytesIO()
-        avatar_img.convert('RGBA').save(im_output, format='png')
-        im_output.seek(0)
-
         cropped_avatar = RegistrationTempAvatar()
         cropped_avatar.avatar.save(os.path.basename(avatar.avatar.name),
                                    File(im_output), save=True)
@@ -715,11 +842,32 @@ def handle_avatar_upload(request):
     return JsonResponse(data)
 
 
+@require_POST
+@csrf_exempt
+def payment_webhook(request):
+    """
+    Gateway's notice that a charge has settled. Records the result on
+    the pending payment and leaves finalizing it to the job worker.
+    """
+    try:
+        result = get_gateway().parse_webhook(request)
+    except PaymentError:
+        return HttpResponse(status=400)
+    if result is not None:
+        charge_id, status = result
+        with transaction.atomic():
+            pending = PendingPayment.objects.select_for_update().filter(charge_id=charge_id).first()
+            # Charges made outside async mode have nothing to settle
+            if pending is not None and status in ('succeeded', 'failed') and pending.record_result(status):
+                Job.objects.enqueue('finalize_payment', pending.id)
+    return HttpResponse(status=200)
+
+
 # TODO: Like check-in, change confirmation processes into a CBV
 @transaction.atomic
 def confirm(request, external_id):
     """Show confirmation for a registration, and allow for upgrades."""
-    current_convention = Convention.objects.current()
+    current_convention = get_current_convention()
 
     # Rate limit failures to this page to prevent scans for confirmation ID's
     # TODO: It'd kind of suck if the hotel's IP address got flagged here during the convention
@@ -737,18 +885,13 @@ def confirm(request, external_id):
     # Look up by external_id, but also force to current_convention
     try:
         reg = Registration.objects.get(external_id=external_id,
-                                       registration_level__convention=current_convention)
+                                       convention=current_convention)
     except Registration.DoesNotExist:
         cache.set(failure_cache_key, hits + 1, 1800)
         raise Http404("No Registration matches the given query.")
 
     # Determine upgrade availability
-    upgrade_options = RegistrationUpgrade.objects.filter(active=True,
-                                                         current_registration_level=reg.registration_level,
-                                                         # upgrade_registration_level__active=True,
-                                                         ).exclude(
-        upgrade_registration_level__deadline__lt=timezone.now(),
-    ).order_by('upgrade_registration_level__seq')
+    upgrade_options = get_catalog(current_convention).upgrades_from(reg.registration_level_id)
 
     upgrade_available = True
     if len(upgrade_options) == 0 or not reg.status == 1:
@@ -761,7 +904,7 @@ def confirm(request, external_id):
 @transaction.atomic
 def confirm_change(request, external_id, confirmation=None):
     """Show confirmation for a registration, and allow for upgrades."""
-    current_convention = Convention.objects.current()
+    current_convention = get_current_convention()
     confirmation_hours = 24
 
     # Rate limit failures to this page to prevent scans for confirmation ID's
@@ -780,7 +923,7 @@ def confirm_change(request, external_id, confirmation=None):
     # Look up by external_id, but also force to current_convention
     try:
         reg = Registration.objects.get(external_id=external_id,
-            registration_level__convention=current_convention)
+            convention=current_convention)
     except Registration.DoesNotExist:
         cache.set(failure_cache_key, hits + 1, 1800)
         raise Http404("No Registration matches the given query.")
@@ -810,12 +953,8 @@ def confirm_change(request, external_id, confirmation=None):
             updated_info += ' Badge name (was "{}").'.format(reg.badge_name)
             reg.badge_name = replacement.new_badge_name
         if replacement.avatar:
-            # TODO: Find a better way to not leave files dangling out there?
             updated_info += ' New avatar image (was "{}").'.format(reg.avatar)
-            reg.avatar = File(
-                replacement.avatar,
-                '{0}_{1}'.format(reg.id, os.path.basename(replacement.avatar.name))
-            )
+            reg.take_avatar(replacement.avatar)
         updated_info += ' On {}'.format(timezone.now())
         # Notes may be NULL, append gracefully
         note_update = reg.notes or ''
@@ -850,7 +989,9 @@ def confirm_change(request, external_id, confirmation=None):
         # Check for avatar upload
         if 'avatar' in request.FILES:
             # Hand off to upload handler
-            handle_avatar_upload(request)
+            response = handle_avatar_upload(request)
+            if response.status_code != 200:
+                messages.warning(request, json.loads(response.content)['error'])
 
         # Clean up
         if 'avatar_original' in request.session:
@@ -888,9 +1029,9 @@ def confirm_change(request, external_id, confirmation=None):
         email_body = loader.render_to_string(
             'registration/register_selfupdate_email_body.txt', confirm_context
         )
-        send_mail(email_subject, email_body,
-                  current_convention.contact_email,
-                  [reg.email], fail_silently=True)
+        OutboxMessage.objects.queue(email_subject, email_body,
+                                    current_convention.contact_email,
+                                    [reg.email])
         return render(request, 'registration/register_selfupdate_confirmation.html', confirm_context)
     else:
         update_form = UserRegUpdateForm()
@@ -904,7 +1045,7 @@ def confirm_change(request, external_id, confirmation=None):
 @transaction.atomic
 def confirm_claim(request, external_id):
     """Allow a reg without a user association to be claimed by a user"""
-    current_convention = Convention.objects.current()
+    current_convention = get_current_convention()
 
     # Rate limit failures to this page to prevent scans for confirmation ID's
     # TODO: It'd kind of suck if the hotel's IP address got flagged here during the convention
@@ -922,7 +1063,7 @@ def confirm_claim(request, external_id):
     # Look up by external_id, but also force to current_convention
     try:
         reg = Registration.objects.get(external_id=external_id,
-            registration_level__convention=current_convention)
+            convention=current_convention)
     except Registration.DoesNotExist:
         cache.set(failure_cache_key, hits + 1, 1800)
         raise Http404("No Registration matches the given query.")
@@ -982,7 +1123,7 @@ def check_in(request, registration_id=None, mode=None):
     # it's expected that may disappear in favor of the lead/raf split.
 
     # Only process for the currently active convention
-    current_convention = Convention.objects.current()
+    current_convention = get_current_convention()
 
     queue_name = 'regline'
     queued_registrations = []
@@ -1006,7 +1147,7 @@ def check_in(request, registration_id=None, mode=None):
     if regci_settings['regci_swag_stats']:
         for swag in Swag.objects.filter(convention=current_convention):
             if swag.sizes:
-                for size in ShirtSize.objects.all():
+                for size in get_catalog(current_convention).shirt_sizes():
                     needed = 0
                     for level in swag.registrationlevel_set.all():
                         needed = needed + level.registration_set.filter(shirt_size=size).count()
@@ -1055,7 +1196,7 @@ def check_in(request, registration_id=None, mode=None):
 
             # Only search registrations for current convention
             registrations = Registration.all_registrations.filter(
-                registration_level__convention=current_convention).order_by('id')
+                convention=current_convention).order_by('id')
 
             # Each parameter, apply as an additional filter
             for parameter in parameters:
@@ -1072,8 +1213,9 @@ def check_in(request, registration_id=None, mode=None):
                 try:
                     badge_number = int(parameter)
                     registrations = registrations | Registration.all_registrations.filter(
-                        registration_level__convention=current_convention,
-                        id=badge_number + current_convention.registrationsettings.badge_offset).order_by('id')
+                        Q(assigned_badge_number=badge_number) |
+                        Q(id=badge_number + current_convention.registrationsettings.badge_offset),
+                        convention=current_convention).order_by('id')
                 except ValueError:
                     pass
 
@@ -1088,11 +1230,11 @@ def check_in(request, registration_id=None, mode=None):
             # Stash items into session for usage later
             request.session['c_last'] = c_last
             request.session['c_first'] = c_first
-            request.session['c_birthday'] = c_birthday
+            request.session['c_birthday'] = c_birthday.isoformat() if c_birthday else None
 
             # Only search registrations for current convention
             registrations = Registration.all_registrations.filter(
-                registration_level__convention=current_convention).order_by('id')
+                convention=current_convention).order_by('id')
 
             # Progressive intelligent search
             # 1. First, Last, Birthday
@@ -1141,7 +1283,7 @@ def check_in(request, registration_id=None, mode=None):
 
     else:  # We were given a registration ID to process
         registration = get_object_or_404(Registration.all_registrations, id=registration_id, \
-                                         registration_level__convention=current_convention)
+                                         convention=current_convention)
 
         # Attempt to de-queue from any queue the reg might be in
         RegistrationQueue.dequeue(registration, queue_name)
@@ -1277,8 +1419,8 @@ def check_in(request, registration_id=None, mode=None):
                     context['name_match'] = True
             if 'c_birthday' in request.session:
                 context['attempt_birthday'] = True
-                context['c_birthday'] = request.session['c_birthday']
-                if registration.birthday == request.session['c_birthday']:
+                context['c_birthday'] = parse_date(request.session['c_birthday'] or '')
+                if registration.birthday == context['c_birthday']:
                     context['birthday_match'] = True
 
             # Immediately request badge be found and made available
@@ -1303,7 +1445,7 @@ def check_in(request, registration_id=None, mode=None):
                         owed_swag.append(swag.swag)
             context['received_swag'] = received_swag
             context['owed_swag'] = owed_swag
-            context['shirtsizes'] = ShirtSize.objects.all()
+            context['shirtsizes'] = get_catalog(current_convention).shirt_sizes()
             context['vax_cutoff'] = timezone.now() - timedelta(weeks=2)
             context['queued_registrations'] = queued_registrations
             context['queue'] = queue_name
@@ -1434,14 +1576,14 @@ def badge_puller(request, registration_id=None):
             return redirect('home')
 
     # Only process for the currently active convention
-    current_convention = Convention.objects.current()
+    current_convention = get_current_convention()
 
     queue_name = 'readybadge'
 
     if registration_id:
         # Find registration, remove from queue
         registration = get_object_or_404(Registration.all_registrations, id=registration_id, \
-                                         registration_level__convention=current_convention)
+                                         convention=current_convention)
 
         RegistrationQueue.dequeue(registration, queue_name)
 
@@ -1450,7 +1592,8 @@ def badge_puller(request, registration_id=None):
 
     # Fetch the top 10 items in the queue
     queued_registrations = []
-    registration_queue = RegistrationQueue.objects.filter(queue_name=queue_name)[:10]
+    registration_queue = RegistrationQueue.objects.filter(queue_name=queue_name) \
+        .select_related('registration__registration_level')[:10]
 
     # 'touch' each queue item, and add to the list
     for queue_item in registration_queue:
@@ -1501,18 +1644,32 @@ def avatar_thumbnail(request, avatar_type, avatar_id, maxwidth, maxheight):
         raise Http404()
 
     thumbnail_size = (int(maxwidth), int(maxheight))
+    if thumbnail_size not in thumbnail_sizes():
+        raise Http404()
 
     avatar_object = get_object_or_404(image_model, **query)
     # In both cases the field name is "avatar"
     if not avatar_object.avatar:
         raise Http404()
-    image_obj = Image.open(avatar_object.avatar)
-    image_obj.thumbnail(thumbnail_size, Image.BICUBIC)
 
-    thumbnail = BytesIO()
-    image_obj.convert('RGBA').save(thumbnail, format='png')
-
-    return HttpResponse(thumbnail.getvalue(), content_type='image/png')
+    # Thumbnails only change with the source image, so its name is
+    # enough to tell whether the browser's copy is current
+    key = thumbnail_key(avatar_type, avatar_id, thumbnail_size, avatar_object.avatar.name)
+    etag = '"{}"'.format(key.rpartition('_')[2])
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        try:
+            thumbnail, made = get_thumbnail(key, avatar_object.avatar, thumbnail_size)
+        except AvatarError:
+            # Stored before uploads were held to the decoding budget
+            raise Http404()
+        response = get_conditional_response(request, etag=etag, last_modified=made)
+        if response is None:
+            response = HttpResponse(thumbnail, content_type='image/png')
+            response['Last-Modified'] = http_date(made)
+    response['ETag'] = etag
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
 
 
 @user_passes_test(lambda u: u.is_staff)
@@ -1520,7 +1677,7 @@ def registration_qrcode(request, badge_number):
     """Create a QR code image of a badge ID"""
 
     # Last two digits of year is the indicator
-    current_convention = Convention.objects.current()
+    current_convention = get_current_convention()
     year_indicator = current_convention.name[-2:]
     template = "https://motorcityfurrycon.org/{year_indicator}#{badge_number}"
     # Be sure to set up a redirect to the schedule or some such
@@ -1535,7 +1692,7 @@ def registration_qrcode(request, badge_number):
 def staff_page(request):
     """Generates the staff list based on staff registration objects"""
 
-    current_convention = Convention.objects.current()
+    current_convention = get_current_convention()
     staff_list = StaffRegistration.objects.filter(
         approved=True, convention=current_convention,
     ).exclude(positions__exact='').exclude(positions__isnull=True)
@@ -1549,7 +1706,7 @@ def staff_page(request):
 
 @cache_control(max_age=60 * 60 * 24)
 def staff_page_image(request, avatar_virtual_filename):
-    current_convention = Convention.objects.current()
+    current_convention = get_current_convention()
     staff_object = get_object_or_404(StaffRegistration, convention=current_convention,
                                      avatar_virtual_filename=avatar_virtual_filename)
     if not staff_object.avatar:
@@ -1562,7 +1719,7 @@ def staff_page_image(request, avatar_virtual_filename):
         mask = Image.open('static/images/staff/mask.png')
         overlay = Image.open('static/images/staff/overlay.png')
         if staff_object.registration.avatar:
-            avatar = Image.open(staff_object.registration.avatar)
+            avatar = staff_object.registration.avatar_image('staff')
         else:
             avatar = Image.open('static/images/staff/generic.png')
 
@@ -1603,7 +1760,7 @@ def staff_badge_image(request, registration_id):
 
     # Overlay uploaded avatar image
     if reg.avatar:
-        badge_avatar = Image.open(reg.avatar)
+        badge_avatar = reg.avatar_image('badge')
     else:
         badge_avatar = Image.open('static/images/badges/Staff_Generic.png')
     # Calculate centered position on badge